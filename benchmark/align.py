@@ -0,0 +1,211 @@
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+import itertools
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from volume_io import downsample2
+from lazy_grid import as_grid, density_blocks
+
+# Rigid pre-alignment of a reconstruction onto a reference before computing metrics. Both
+# objects are sampled once on a coarse grid over the evaluation extent, then a translation is
+# found coarse-to-fine on 2x pyramids with FFT cross-correlation: a full search on the coarsest
+# level, then at each finer level only a small window around the upsampled estimate, with a
+# sub-voxel parabolic fit on the finest level. An optional small rotation is found by
+# coordinate descent over the three angles on a coarse level of at least 32 voxels.
+
+@dataclass
+class RigidTransform:
+    # obj is evaluated at R (p + translation - center) + center for reference positions p
+    rotation: np.ndarray = field(default_factory=lambda: np.eye(3))
+    translation: np.ndarray = field(default_factory=lambda: np.zeros(3))
+    center: np.ndarray = field(default_factory=lambda: np.zeros(3))
+    angles: Tuple[float, float, float] = (0.0, 0.0, 0.0)
+    correlation_before: float = float('nan')
+    correlation_after: float = float('nan')
+    time: float = 0.0
+
+    def is_translation(self) -> bool:
+        return np.allclose(self.rotation, np.eye(3))
+
+    def apply(self, pos: torch.Tensor) -> torch.Tensor:
+        R = torch.as_tensor(self.rotation, dtype=pos.dtype, device=pos.device)
+        t = torch.as_tensor(self.translation, dtype=pos.dtype, device=pos.device)
+        c = torch.as_tensor(self.center, dtype=pos.dtype, device=pos.device)
+        if self.is_translation():
+            return pos + t
+        return (pos + t - c) @ R.T + c
+
+    def to_dict(self) -> dict:
+        return {
+            'translation': self.translation.tolist(),
+            'rotation_deg': list(self.angles),
+            'rotation_matrix': self.rotation.tolist(),
+            'center': self.center.tolist(),
+            'correlation_before': self.correlation_before,
+            'correlation_after': self.correlation_after,
+            'time': self.time,
+        }
+
+class AlignedObject:
+    def __init__(self, base, transform: RigidTransform) -> None:
+        self.base = base
+        self.transform = transform
+
+    def density(self, pos: torch.Tensor) -> torch.Tensor:
+        return self.base.density(self.transform.apply(pos))
+
+def rotation_matrix(angles_deg: Tuple[float, float, float]) -> np.ndarray:
+    # R = Rz @ Ry @ Rx for rotations about the x, y and z axes in degrees
+    ax, ay, az = np.deg2rad(angles_deg)
+    Rx = np.array([[1, 0, 0], [0, np.cos(ax), -np.sin(ax)], [0, np.sin(ax), np.cos(ax)]])
+    Ry = np.array([[np.cos(ay), 0, np.sin(ay)], [0, 1, 0], [-np.sin(ay), 0, np.cos(ay)]])
+    Rz = np.array([[np.cos(az), -np.sin(az), 0], [np.sin(az), np.cos(az), 0], [0, 0, 1]])
+    return Rz @ Ry @ Rx
+
+def rotate_volume(vol: np.ndarray, R: np.ndarray, half: np.ndarray) -> np.ndarray:
+    # vol (x, y, z) sampled on a box with half-lengths half; returns vol(R (p - c) + c)
+    nx, ny, nz = vol.shape
+    u = [torch.linspace(-1, 1, n, dtype=torch.float64) for n in (nx, ny, nz)]
+    u = torch.stack(torch.meshgrid(*u, indexing='ij'), dim=-1)
+    half = torch.as_tensor(half, dtype=torch.float64)
+    grid = ((u * half) @ torch.as_tensor(R).T) / half
+    # grid_sample wants (D, H, W) = (z, y, x) and grid[..., (x, y, z)]
+    inp = torch.from_numpy(np.ascontiguousarray(vol.transpose(2, 1, 0), dtype=np.float64))
+    out = F.grid_sample(inp[None, None], grid.permute(2, 1, 0, 3)[None], align_corners=True, padding_mode='border')
+    return out[0, 0].permute(2, 1, 0).numpy()
+
+def cross_correlation(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # circular normalised cross-correlation c[k] = corr(a[i + k], b[i])
+    a = a - a.mean()
+    b = b - b.mean()
+    c = np.fft.irfftn(np.fft.rfftn(a) * np.conj(np.fft.rfftn(b)), s=a.shape)
+    return c / (np.sqrt((a*a).sum() * (b*b).sum()) + 1e-30)
+
+def _peak(c: np.ndarray, center: Optional[np.ndarray] = None, radius: int = 2) -> Tuple[np.ndarray, float]:
+    # signed integer shift of the correlation maximum, optionally within radius of center
+    shape = np.array(c.shape)
+    if center is None:
+        k = np.array(np.unravel_index(np.argmax(c), c.shape))
+    else:
+        offsets = np.array(list(itertools.product(range(-radius, radius + 1), repeat=3)))
+        cand = (np.round(center).astype(int) + offsets)
+        values = c[tuple((cand % shape).T)]
+        k = cand[np.argmax(values)]
+    k = (k + shape//2) % shape - shape//2
+    return k, float(c[tuple(k % shape)])
+
+def _subvoxel(c: np.ndarray, k: np.ndarray) -> np.ndarray:
+    # parabolic fit of the correlation peak along each axis
+    shape = np.array(c.shape)
+    s = k.astype(float)
+    for axis in range(3):
+        lo, hi = k.copy(), k.copy()
+        lo[axis] -= 1
+        hi[axis] += 1
+        cm, c0, cp = c[tuple(lo % shape)], c[tuple(k % shape)], c[tuple(hi % shape)]
+        denom = cm - 2*c0 + cp
+        if denom < 0:
+            s[axis] += 0.5 * (cm - cp) / denom
+    return s
+
+def sample_volume(obj, bounds: List[Tuple[float, float]], resolution: int) -> np.ndarray:
+    # density of obj on a resolution^3 grid over bounds, in (x, y, z) order
+    axes = [torch.linspace(lo, hi, resolution) for lo, hi in bounds]
+    with torch.no_grad():
+        blocks = [b.cpu().numpy() for b in density_blocks(obj, *axes, 16)]
+    return np.concatenate(blocks).astype(np.float64)
+
+def find_alignment(
+        obj,
+        ref,
+        bounds: List[Tuple[float, float]],
+        resolution: int = 64,
+        max_rotation: float = 0.0,
+        rotation_step: float = 1.0,
+        min_size: int = 8,
+        rotation_min_size: int = 32
+) -> RigidTransform:
+    """Rigid transform mapping reference positions onto obj.
+
+    Translation only unless max_rotation (degrees) is positive, in which case rotations about
+    each axis within +-max_rotation in steps of rotation_step are searched by coordinate descent
+    on the coarsest pyramid level of at least rotation_min_size voxels.
+    """
+    tic = time.perf_counter()
+    lo = np.array([b[0] for b in bounds], dtype=np.float64)
+    hi = np.array([b[1] for b in bounds], dtype=np.float64)
+    center = (lo + hi) / 2
+    half = (hi - lo) / 2
+    spacing = (hi - lo) / (resolution - 1)
+
+    pyramid_obj = [sample_volume(obj, bounds, resolution)]
+    pyramid_ref = [sample_volume(ref, bounds, resolution)]
+    while min(pyramid_obj[-1].shape) // 2 >= min_size:
+        pyramid_obj.append(downsample2(pyramid_obj[-1]))
+        pyramid_ref.append(downsample2(pyramid_ref[-1]))
+    correlation_before = float(cross_correlation(pyramid_obj[0], pyramid_ref[0]).flat[0])
+
+    def correlate(level, ang):
+        moving = pyramid_obj[level]
+        if any(ang):
+            moving = rotate_volume(moving, rotation_matrix(ang), half)
+        return cross_correlation(moving, pyramid_ref[level])
+
+    # rotations are searched on the coarsest level that still resolves small angles
+    rotation_level = max([0] + [i for i, v in enumerate(pyramid_obj) if min(v.shape) >= rotation_min_size])
+    ang = (0.0, 0.0, 0.0)
+    level = len(pyramid_obj) - 1
+    c = correlate(level, ang)
+    k, value = _peak(c)
+    while True:
+        if level == rotation_level and max_rotation > 0:
+            # coordinate descent over the three angles on a grid of rotation_step: each round
+            # moves only the angle that improves the correlation most, so that an early step on
+            # one axis does not compensate for a rotation about another, until none improves it
+            steps = np.arange(-max_rotation, max_rotation + 1e-9, rotation_step)
+            while True:
+                best = None
+                for axis in range(3):
+                    for a in steps:
+                        cand = list(ang)
+                        cand[axis] = float(a)
+                        cand = tuple(cand)
+                        if cand == ang:
+                            continue
+                        cand_c = correlate(level, cand)
+                        cand_k, cand_value = _peak(cand_c)
+                        if cand_value > value:
+                            best, value = (cand, cand_c, cand_k), cand_value
+                if best is None:
+                    break
+                ang, c, k = best
+        if level == 0:
+            break
+        # refine the translation on the next finer level around the upsampled estimate
+        level -= 1
+        c = correlate(level, ang)
+        k, value = _peak(c, 2*k)
+    R = rotation_matrix(ang)
+    shift = _subvoxel(c, k)
+    correlation_after = float(c[tuple(k % np.array(c.shape))])
+
+    transform = RigidTransform(
+        rotation=R,
+        translation=shift * spacing,
+        center=center,
+        angles=ang,
+        correlation_before=correlation_before,
+        correlation_after=correlation_after,
+        time=time.perf_counter() - tic
+    )
+    return transform
+
+def apply_alignment(obj, transform: RigidTransform):
+    # translated voxel grids stay on the grid-aligned fast path
+    grid = as_grid(obj)
+    if grid is not None and transform.is_translation():
+        return grid.shifted(transform.translation)
+    return AlignedObject(obj, transform)
@@ -1,33 +1,128 @@
 # %%
-import astra
 import numpy as np
 import matplotlib.pyplot as plt
 from pathlib import Path
 import cv2 as cv
 import tyro
-from typing import Tuple, Callable, Optional, Literal
+from typing import Tuple, Callable, Optional, Literal, Union
 import json
+import os
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from rich.progress import track
-from utils import PrintTableMetrics
+from utils import PrintTableMetrics, PhaseTimer
+import sino_cache
+import cpu_recon
+from preview import PreviewWriter, central_slices
+import volume_io
+import projection_pyramid
+from metrics import RunningStats
+from frame_index import FrameIndex, FrameFilter, load_index, filter_frames
+try:
+    import astra
+except ImportError: # CPU-only nodes can still run the *_CPU algorithms
+    astra = None
+
+# OpenCV can decode directly at 1/2, 1/4 and 1/8 resolution
+REDUCED_READ_FLAGS = {
+    2: cv.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv.IMREAD_REDUCED_GRAYSCALE_8,
+}
 
 def load_image(
         dname: Path,
         filepath: Path,
-        image_downscale: float
+        image_downscale: float,
+        downsampling: Literal['bilinear','area'] = 'bilinear'
 ) -> np.ndarray:
-    im = cv.imread((dname/filepath).as_posix(), cv.IMREAD_GRAYSCALE)
-    im = cv.resize(im, None, fx=1/image_downscale, fy=1/image_downscale)
+    if downsampling == 'area':
+        # area average of the float attenuation, the same resampling as the projection pyramid
+        im = projection_pyramid.attenuation(dname, filepath)
+        return projection_pyramid.area_downsample(im, image_downscale)
+    if downsampling != 'bilinear':
+        raise ValueError(f'Invalid downsampling {downsampling}')
+    flag = cv.IMREAD_GRAYSCALE
+    scale = image_downscale
+    # decode at the largest supported power-of-two reduction and resize the rest; for PNG the
+    # reduced decode is the bilinear resize itself, so both paths give the same pixels
+    for factor in sorted(REDUCED_READ_FLAGS, reverse=True):
+        if scale % factor == 0:
+            flag = REDUCED_READ_FLAGS[factor]
+            scale = scale / factor
+            break
+    im = cv.imread((dname/filepath).as_posix(), flag)
+    if im is None:
+        raise FileNotFoundError(f'Could not read {dname/filepath}')
+    if scale != 1:
+        # bilinear to int(w/factor), the detector size of projection_geometry
+        im = cv.resize(im, (int(im.shape[1]/scale), int(im.shape[0]/scale)), interpolation=cv.INTER_LINEAR)
     im = 1 - im.astype(np.float32)/255
     # flip upside down
     im = np.flipud(im)
     return im
 
-def load_projections(
-        path: Path, 
-        filter_name: Callable, 
-        image_downscale: float = 1.0, 
-        Lscale: Optional[float] = 1.0
-) -> Tuple[np.ndarray, dict]:
+def _is_power_of_two(x: float) -> bool:
+    return float(x).is_integer() and int(x) > 1 and (int(x) & (int(x) - 1)) == 0
+
+def _pyramid_level(jsonfile: Path, image_downscale: float):
+    # projection_pyramid.open_level for image_downscale, or None if no up-to-date level exists
+    if image_downscale == 1 or _is_power_of_two(image_downscale):
+        return projection_pyramid.open_level(jsonfile, int(image_downscale))
+    return None
+
+def read_sinogram(
+        dname: Path,
+        filepaths: list,
+        image_downscale: float,
+        num_workers: int = 0,
+        executor: Literal['thread','process'] = 'thread',
+        downsampling: Literal['bilinear','area'] = 'bilinear'
+) -> np.ndarray:
+    # Decode projections straight into a preallocated (rows, n_proj, cols) float32 sinogram.
+    # num_workers=0 decodes serially, otherwise on a thread/process pool (-1 uses all cores);
+    # every frame is resampled by load_image, so the result does not depend on num_workers.
+    n = len(filepaths)
+    if num_workers < 0:
+        num_workers = os.cpu_count() or 1
+    tic = time.perf_counter()
+    # the first frame fixes the detector shape
+    im = load_image(dname, filepaths[0], image_downscale, downsampling)
+    sinogram = np.empty((im.shape[0], n, im.shape[1]), dtype=np.float32)
+    sinogram[:, 0, :] = im
+
+    if num_workers == 0:
+        for i in track(range(1, n), description='Loading images'):
+            sinogram[:, i, :] = load_image(dname, filepaths[i], image_downscale, downsampling)
+    elif executor == 'thread':
+        # cv.imread releases the GIL so threads can write straight into the sinogram
+        def _read_into(i):
+            sinogram[:, i, :] = load_image(dname, filepaths[i], image_downscale, downsampling)
+        with ThreadPoolExecutor(num_workers) as pool:
+            for _ in track(pool.map(_read_into, range(1, n)), total=n-1, description='Loading images'):
+                pass
+    elif executor == 'process':
+        chunksize = max(1, (n-1) // (4*num_workers))
+        with ProcessPoolExecutor(num_workers) as pool:
+            results = pool.map(
+                load_image, [dname]*(n-1), filepaths[1:], [image_downscale]*(n-1), [downsampling]*(n-1),
+                chunksize=chunksize
+            )
+            for i, im in enumerate(track(results, total=n-1, description='Loading images'), start=1):
+                sinogram[:, i, :] = im
+    else:
+        raise ValueError(f'Invalid executor {executor}')
+
+    dt = time.perf_counter() - tic
+    print(f'Loaded {n} images in {dt:.2f} s ({n/dt:.1f} images/s)')
+    return sinogram
+
+def select_frames(
+        path: Path,
+        filter_name: Union[FrameFilter, Callable]
+) -> Tuple[Path, Path, dict, FrameIndex]:
     path = Path(path)
     if path.is_dir():
         fn = list(path.glob('transforms*.json'))
@@ -39,35 +134,60 @@ def load_projections(
         dname = path.parent
     else:
         raise ValueError('Invalid path')
-    meta = json.loads(jsonfile.read_text())
-   
-    image_filenames = []
-    images = []
-    poses = []
-
-    fnames = []
-    frame_indices = []
-    for i, frame in enumerate(meta["frames"]):
-        filepath = Path(frame["file_path"])
-        if filter_name(filepath.stem):
-            fnames.append(filepath.as_posix())
-            frame_indices.append(i)
+    # poses and file names come from the companion frame index instead of parsing the JSON
+    index = load_index(jsonfile)
     # sort the frames by fname
-    inds = np.argsort(fnames)
-    inds = [frame_indices[i] for i in inds]
-    print(f'Loading {len(inds)} images')
-    frames = [meta["frames"][ind] for ind in inds]
-    del inds
-
-    for frame in track(frames, description='Loading images'):
-        filepath = Path(frame["file_path"])
-        image_filenames.append(filepath.as_posix())
-        poses.append(np.array(frame["transform_matrix"]))
-        im = load_image(dname, filepath, image_downscale)
-        images.append(im)
-    poses = np.stack(poses, axis=0)
-    images = np.stack(images, axis=1)
+    frames = filter_frames(index, filter_name)
+    print(f'Selected {len(frames)} images')
+    return jsonfile, dname, index.meta, frames
 
+def load_projections(
+        path: Path, 
+        filter_name: Union[FrameFilter, Callable], 
+        image_downscale: float = 1.0, 
+        Lscale: Optional[float] = 1.0,
+        num_workers: int = 0,
+        executor: Literal['thread','process'] = 'thread',
+        pyramid: bool = True,
+        timer: Optional[PhaseTimer] = None,
+        downsampling: Literal['bilinear','area'] = 'bilinear',
+        selected: Optional[Tuple[Path, Path, dict, FrameIndex]] = None
+) -> Tuple[np.ndarray, dict]:
+    # selected: the result of select_frames(path, filter_name) if the caller already has it
+    timer = timer if timer is not None else PhaseTimer()
+    if selected is None:
+        with timer.span('index'):
+            selected = select_frames(path, filter_name)
+    jsonfile, dname, meta, frames = selected
+
+    image_filenames = [str(fn) for fn in frames.file_path]
+    poses = frames.poses
+    # read the level of a precomputed projection pyramid (projection_pyramid.py) if there is one;
+    # its levels are area averages, so only for downsampling='area'
+    level = _pyramid_level(jsonfile, image_downscale) if pyramid and downsampling == 'area' else None
+    if level is not None:
+        with timer.span('pyramid'):
+            tic = time.perf_counter()
+            level, level_files = level
+            row = {fn: i for i, fn in enumerate(level_files)}
+            images = projection_pyramid.read_sinogram(level, np.array([row[fn] for fn in image_filenames]))
+            print(f'Loaded {len(image_filenames)} images from pyramid level {int(image_downscale)} in {time.perf_counter() - tic:.2f} s')
+    else:
+        with timer.span('decode'):
+            images = read_sinogram(
+                dname, [Path(fn) for fn in image_filenames], image_downscale, num_workers, executor, downsampling
+            )
+
+    with timer.span('geometry'):
+        proj_geom = projection_geometry(poses, meta, image_downscale, Lscale)
+    return images, proj_geom, image_filenames
+
+def projection_geometry(
+        poses: np.ndarray,
+        meta: dict,
+        image_downscale: float = 1.0,
+        Lscale: Optional[float] = 1.0
+) -> dict:
     eye = np.array([0,0,0,1])
     eye = np.einsum('...ij,j', poses, eye) # eye to world coordinates
     assert np.allclose(eye[:,2], 0)
@@ -105,8 +225,48 @@ def load_projections(
         'DistanceOriginSource':geom_data['SrcToObject']*Lscale, # L
         'DistanceOriginDetector':(geom_data['SrcToDetector']-geom_data['SrcToObject'])*Lscale # L
     }
+    return proj_geom
 
-    return images, proj_geom, image_filenames
+def load_projections_cached(
+        cache_dir: Path,
+        path: Path,
+        filter_name: Union[FrameFilter, Callable],
+        image_downscale: float = 1.0,
+        Lscale: Optional[float] = 1.0,
+        key_params: Optional[dict] = None,
+        num_workers: int = 0,
+        executor: Literal['thread','process'] = 'thread',
+        pyramid: bool = True,
+        timer: Optional[PhaseTimer] = None,
+        downsampling: Literal['bilinear','area'] = 'bilinear'
+) -> Tuple[np.ndarray, dict]:
+    # key_params should describe filter_name (e.g. imin/imax/istep) so that different
+    # frame selections from the same transforms file get separate cache entries
+    timer = timer if timer is not None else PhaseTimer()
+    sino_cache.evict_orphans(cache_dir)
+    with timer.span('index'):
+        selected = select_frames(path, filter_name)
+    jsonfile, dname, _, frames = selected
+    # the key names the loading path actually taken; num_workers and executor are left out
+    # as they do not change the data (load_image resamples every frame the same way)
+    use_pyramid = pyramid and downsampling == 'area' and _pyramid_level(jsonfile, image_downscale) is not None
+    params = {
+        'image_downscale': image_downscale, 'Lscale': Lscale, 'downsampling': downsampling,
+        'source': 'pyramid' if use_pyramid else 'decode', **(key_params or {})
+    }
+    slot = sino_cache.cache_slot(jsonfile, params)
+    image_filenames = [str(fn) for fn in frames.file_path]
+    key = sino_cache.content_key(jsonfile, dname, image_filenames)
+    cached = sino_cache.load_cached(cache_dir, slot, key)
+    if cached is not None:
+        print(f'Loaded sinogram from cache {Path(cache_dir)/slot}')
+        return cached
+    proj_data, proj_geom, image_filenames = load_projections(
+        path, filter_name, image_downscale, Lscale, num_workers, executor, use_pyramid, timer, downsampling, selected
+    )
+    sino_cache.store_cached(cache_dir, slot, key, jsonfile, proj_data, proj_geom, image_filenames)
+    print(f'Stored sinogram in cache {Path(cache_dir)/slot}')
+    return proj_data, proj_geom, image_filenames
 
 def normalize_reorder(rec: np.ndarray) -> np.ndarray:
     rec = (rec - rec.min()) / (rec.max() - rec.min()) * 255
@@ -120,6 +280,306 @@ def save_slice(rec: np.ndarray, output_dir: Path):
     plt.savefig(output_dir/f'slice.png')
     plt.close()
 
+def save_volume(rec: np.ndarray, output_dir: Path, save_npz: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    # normalized (x, y, z) volume and its uint16 copy, written to vol_zyx.raw and vol.npz
+    rec = normalize_reorder(rec)
+    vol = rec.astype(np.uint16)
+    vol.swapaxes(0,2).tofile(output_dir/f'vol_zyx.raw')
+    if save_npz:
+        np.savez_compressed(output_dir/f'vol.npz', vol=vol)
+        # readers use vol_zyx.raw in place of vol.npz only if it is not older (sphere_gui.open_volume)
+        os.utime(output_dir/'vol_zyx.raw')
+    return rec, vol
+
+class AstraSolver:
+    def __init__(self, algorithm: str, proj_data: np.ndarray, proj_geom: dict, vol_geom: dict) -> None:
+        if astra is None:
+            raise ImportError(f'astra is required for {algorithm}')
+        # Create projection data object directly from the sinogram
+        self.proj_id = astra.data3d.create('-proj3d', proj_geom, proj_data)
+
+        # Create a data object for the reconstruction
+        self.rec_id = astra.data3d.create('-vol', vol_geom)
+        self.vol_shape = (vol_geom['GridSliceCount'], vol_geom['GridRowCount'], vol_geom['GridColCount'])
+
+        # Set up the parameters for a reconstruction algorithm using the GPU
+        cfg = astra.astra_dict(algorithm)
+        cfg['ReconstructionDataId'] = self.rec_id
+        cfg['ProjectionDataId'] = self.proj_id
+        cfg['option'] = {'GPUindex': 0} # can be useful for multi GPU machines
+
+        # Create the algorithm object from the configuration structure
+        self.alg_id = astra.algorithm.create(cfg)
+
+    def run(self, iterations: int):
+        astra.algorithm.run(self.alg_id, iterations)
+
+    def res_norm(self) -> float:
+        return astra.algorithm.get_res_norm(self.alg_id)
+
+    def get(self) -> np.ndarray:
+        return astra.data3d.get(self.rec_id)
+
+    def get_slice(self, axis: int, index: int) -> np.ndarray:
+        # view into ASTRA's memory, only the requested slice is copied
+        return np.take(astra.data3d.get_shared(self.rec_id), index, axis=axis).copy()
+
+    def delete(self):
+        # Clean up. Note that GPU memory is tied up in the algorithm object,
+        # and main RAM in the data objects.
+        astra.algorithm.delete(self.alg_id)
+        astra.data3d.delete(self.rec_id)
+        astra.data3d.delete(self.proj_id)
+
+def create_solver(
+        algorithm: str,
+        proj_data: np.ndarray,
+        proj_geom: dict,
+        vol_geom: dict,
+        cpu_threads: Optional[int] = None,
+        fdk_filter: str = 'ram-lak',
+        fdk_residual: bool = False
+):
+    if algorithm.endswith('_CUDA'):
+        return AstraSolver(algorithm, proj_data, proj_geom, vol_geom)
+    if algorithm == 'FDK_CPU':
+        return cpu_recon.create_solver(
+            algorithm, proj_data, proj_geom, vol_geom, filter_type=fdk_filter, residual=fdk_residual, num_threads=cpu_threads
+        )
+    return cpu_recon.create_solver(algorithm, proj_data, proj_geom, vol_geom, num_threads=cpu_threads)
+
+def iterate(
+        solver,
+        neach: int,
+        nmax: int,
+        stopping_threshold: float,
+        on_step: Optional[Callable] = None,
+        timer: Optional[PhaseTimer] = None
+) -> list:
+    timer = timer if timer is not None else PhaseTimer()
+    residual_error = []
+    t = PrintTableMetrics(['Iteration', 'Error', 'de/rng'])
+    de_rng = 0
+    solve_time = 0.0
+    step_time = 0.0
+    for i in range(nmax):
+        # Run a single iteration
+        with timer.span('solve'):
+            tic = time.perf_counter()
+            solver.run(neach)
+            error = solver.res_norm()
+            solve_time += time.perf_counter() - tic
+        # nan when the solver does not compute its residual (FDK_CPU without fdk_residual):
+        # there is nothing to log or to check for convergence
+        if not np.isnan(error):
+            residual_error.append(error)
+
+        if on_step is not None:
+            with timer.span('preview'):
+                tic = time.perf_counter()
+                on_step(solver, i)
+                step_time += time.perf_counter() - tic
+
+        # check convergence
+        if len(residual_error) > 1:
+            rng = max(residual_error) - min(residual_error)
+            de = residual_error[-1] - residual_error[-2]
+            de_rng = de / rng
+            # improvement by less than threshold
+            if de > 0 or -de_rng < stopping_threshold:
+                break
+        if residual_error:
+            t.update({'Iteration': i, 'Error': residual_error[-1], 'de/rng': de_rng})
+    print(f'{solve_time:.2f} s in iterations, {step_time:.2f} s in previews')
+    return residual_error
+
+def slab_extent(
+        proj_geom: dict,
+        resolution: int,
+        z0: int,
+        z1: int
+) -> Tuple[int, int, int, int]:
+    # For the core slab [z0, z1) of a resolution^3 volume find the detector rows [r0, r1) its
+    # voxels project onto and the extended slab [e0, e1) that contains every voxel seen by
+    # those rows. Assumes a circular trajectory in the z=0 plane with detector rows along z,
+    # as derived by load_projections. Voxel units, volume centred at the origin.
+    vec = cpu_recon.cone_vectors(proj_geom)
+    src, det, u, v = vec[:, 0:3], vec[:, 3:6], vec[:, 6:9], vec[:, 9:12]
+    normal = np.cross(u, v)
+    normal /= np.linalg.norm(normal, axis=1, keepdims=True)
+    dso = np.abs(np.sum(-src*normal, axis=1))
+    dsd = np.abs(np.sum((det - src)*normal, axis=1))
+    half_diag = resolution / np.sqrt(2) # xy half-diagonal bounds the in-plane distance from the axis
+    u_min, u_max = np.min(dso - half_diag), np.max(dso + half_diag)
+    mag = np.concatenate([dsd/u_min, dsd/u_max]) # magnification of points in the volume
+    dv = np.linalg.norm(v, axis=1).min()
+    det_z = det[:, 2].mean()
+    n_rows = proj_geom['DetectorRowCount']
+
+    zlo, zhi = z0 - resolution/2, z1 - resolution/2
+    zdet = np.array([zlo*mag, zhi*mag])
+    r0 = int(np.floor((zdet.min() - det_z)/dv + n_rows/2 - 0.5)) - 1
+    r1 = int(np.ceil((zdet.max() - det_z)/dv + n_rows/2 - 0.5)) + 2
+    r0, r1 = max(r0, 0), min(r1, n_rows)
+
+    # every voxel on a ray through rows [r0, r1) lies within these z limits
+    edges = (np.array([r0 - 0.5, r1 - 0.5]) - n_rows/2 + 0.5)*dv + det_z
+    z_ext = np.concatenate([edges[0]/mag, edges[1]/mag])
+    e0 = int(np.floor(z_ext.min() + resolution/2))
+    e1 = int(np.ceil(z_ext.max() + resolution/2))
+    e0, e1 = min(max(e0, 0), z0), max(min(e1, resolution), z1)
+    return r0, r1, e0, e1
+
+def plan_slabs(
+        proj_geom: dict,
+        resolution: int,
+        memory_budget: float,
+        n_cols: int,
+        n_angles: int,
+        reserved: int = 0
+) -> list:
+    # Choose the thickest slabs whose working set (extended slab volume plus the detector rows it
+    # needs, with a few working copies of each) fits into memory_budget GB less reserved bytes
+    # (memory held for the whole run, e.g. a sinogram in RAM)
+    def slabs(thickness):
+        return [(z0, min(z0 + thickness, resolution)) for z0 in range(0, resolution, thickness)]
+    def peak(thickness):
+        worst = 0
+        for z0, z1 in slabs(thickness):
+            r0, r1, e0, e1 = slab_extent(proj_geom, resolution, z0, z1)
+            nbytes = 4 * 4*((e1 - e0)*resolution**2 + (r1 - r0)*n_angles*n_cols)
+            worst = max(worst, nbytes)
+        return worst
+    budget = memory_budget * 1024**3 - reserved
+    lo, hi = 1, resolution
+    if peak(lo) > budget:
+        raise ValueError(
+            f'Memory budget of {memory_budget} GB is too small for a single slice ({peak(lo)/1024**3:.3g} GB'
+            f' plus {reserved/1024**3:.3g} GB reserved); a cache_dir keeps the sinogram memory-mapped'
+        )
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if peak(mid) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    print(f'Slab thickness {lo} with estimated peak {peak(lo)/1024**3:.2f} GB')
+    return [(z0, z1, *slab_extent(proj_geom, resolution, z0, z1)) for z0, z1 in slabs(lo)]
+
+def sub_geometry(proj_geom: dict, r0: int, r1: int) -> dict:
+    # cone_vec geometry restricted to detector rows [r0, r1)
+    geom = cpu_recon.cone_vec_geom(proj_geom)
+    vec = geom['Vectors'].copy()
+    vec[:, 3:6] += ((r0 + r1)/2 - proj_geom['DetectorRowCount']/2) * vec[:, 9:12]
+    geom['Vectors'] = vec
+    geom['DetectorRowCount'] = r1 - r0
+    return geom
+
+def reconstruct_slabs(
+        algorithm: str,
+        proj_data: np.ndarray,
+        proj_geom: dict,
+        resolution: int,
+        memory_budget: float,
+        output_dir: Path,
+        neach: int,
+        nmax: int,
+        stopping_threshold: float,
+        cpu_threads: Optional[int] = None,
+        fdk_filter: str = 'ram-lak',
+        timer: Optional[PhaseTimer] = None,
+        fdk_residual: bool = False
+) -> Tuple[np.ndarray, list]:
+    # Out-of-core reconstruction: each z-slab is solved from the detector rows it projects onto
+    # and written straight into a memory-mapped float32 (z, y, x) volume. That volume is a
+    # temporary .tmp-rec-*.npy file in output_dir which the caller removes once it is saved
+    timer = timer if timer is not None else PhaseTimer()
+    n_rows, n_angles, n_cols = proj_data.shape
+    # a sinogram loaded from the cache is memory-mapped, otherwise it stays in RAM for the whole run
+    reserved = 0 if isinstance(proj_data, np.memmap) else proj_data.nbytes
+    plan = plan_slabs(proj_geom, resolution, memory_budget, n_cols, n_angles, reserved)
+
+    def solve_slab(k, z0, z1, r0, r1, e0, e1):
+        print(f'Slab {k+1}/{len(plan)}: z {z0}-{z1} (extended {e0}-{e1}), detector rows {r0}-{r1}')
+        geom = sub_geometry(proj_geom, r0, r1)
+        vol_geom = cpu_recon.create_vol_geom(
+            resolution, resolution, e1 - e0, minz=e0 - resolution/2, maxz=e1 - resolution/2
+        )
+        with timer.span('upload'):
+            solver = create_solver(
+                algorithm, np.ascontiguousarray(proj_data[r0:r1]), geom, vol_geom, cpu_threads, fdk_filter, fdk_residual
+            )
+        residual_error = iterate(solver, neach, nmax, stopping_threshold, timer=timer)
+        with timer.span('fetch'):
+            rec[z0:z1] = solver.get()[z0 - e0:z1 - e0]
+            rec.flush()
+        solver.delete()
+        return residual_error
+
+    fd, rec_path = tempfile.mkstemp(prefix='.tmp-rec-', suffix='.npy', dir=output_dir)
+    os.close(fd)
+    try:
+        rec = np.lib.format.open_memmap(rec_path, mode='w+', dtype=np.float32, shape=(resolution,)*3)
+        residual_errors = [solve_slab(k, *slab) for k, slab in enumerate(plan)]
+    except BaseException:
+        rec = None
+        os.remove(rec_path)
+        raise
+    return rec, residual_errors
+
+def write_volume_slabs(rec: np.ndarray, output_dir: Path, slab: int = 16, save_npz: bool = True) -> np.ndarray:
+    # normalize_reorder + uint16 conversion done slab by slab; returns the uint16 volume as a memmap
+    # in the (x, y, z) orientation of normalize_reorder
+    vmin = min(float(rec[z0:z0+slab].min()) for z0 in range(0, rec.shape[0], slab))
+    vmax = max(float(rec[z0:z0+slab].max()) for z0 in range(0, rec.shape[0], slab))
+    with open(output_dir/'vol_zyx.raw', 'wb') as f:
+        for z0 in range(0, rec.shape[0], slab):
+            block = (rec[z0:z0+slab] - np.float32(vmin)) / np.float32(vmax - vmin) * 255
+            # zyx[z, b, a] = rec[z, A-1-a, b]
+            block.astype(np.uint16)[:, ::-1, :].transpose(0, 2, 1).tofile(f)
+    nz, ny, nx = rec.shape
+    zyx = np.memmap(output_dir/'vol_zyx.raw', dtype=np.uint16, mode='r', shape=(nz, nx, ny))
+    vol = zyx.swapaxes(0, 2)
+    if save_npz:
+        save_npz_slabs(output_dir/'vol.npz', vol, slab)
+        # readers use vol_zyx.raw in place of vol.npz only if it is not older (sphere_gui.open_volume)
+        os.utime(output_dir/'vol_zyx.raw')
+    return vol
+
+def save_npz_slabs(path: Path, vol: np.ndarray, slab: int = 16):
+    # np.savez_compressed(path, vol=vol) written slab x-planes at a time; savez buffers 16 MB
+    # of a non-contiguous (e.g. memory-mapped and transposed) volume
+    header = {'descr': np.lib.format.dtype_to_descr(vol.dtype), 'fortran_order': False, 'shape': tuple(vol.shape)}
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        with zf.open('vol.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            for x0 in range(0, vol.shape[0], slab):
+                f.write(np.ascontiguousarray(vol[x0:x0+slab]).tobytes())
+
+def open_reconstruction(output_dir: Path, shape: Tuple[int, int, int]):
+    # (x, y, z) uint16 volume of an astra_recon output directory, memory-mapped from vol_zyx.raw
+    # when it matches shape
+    raw = Path(output_dir)/'vol_zyx.raw'
+    if raw.exists() and raw.stat().st_size == 2*int(np.prod(shape)):
+        return np.memmap(raw, dtype=np.uint16, mode='r', shape=tuple(shape[::-1])).swapaxes(0, 2)
+    if (Path(output_dir)/'vol.chunks').exists():
+        return volume_io.ChunkedVolume(Path(output_dir)/'vol.chunks')
+    return np.load(Path(output_dir)/'vol.npz')['vol']
+
+def compare_volumes(rec: np.ndarray, ref: np.ndarray, slab: int = 16) -> dict:
+    # quality metrics between two normalized (0-255) reconstructions of the same shape,
+    # accumulated slab by slab so memory-mapped volumes are never converted whole
+    assert tuple(rec.shape) == tuple(ref.shape), f'Volume shapes differ: {rec.shape} vs {ref.shape}'
+    stats = RunningStats()
+    for i0 in range(0, rec.shape[0], slab):
+        stats.update(rec[i0:i0+slab], ref[i0:i0+slab])
+    mse = float(stats.mse()) / 255**2
+    return {
+        'mse': mse,
+        'psnr': float(10*np.log10(1/mse)) if mse > 0 else float('inf'),
+        'normed_correlation': float(stats.normed_correlation()),
+    }
+
 def main(
         input_dir: Path,
         output_dir: Path,
@@ -129,34 +589,49 @@ def main(
         imin: int = 0,
         imax: int = 1 << 26,
         istep: int = 1,
-        algorithm: Optional[Literal['SIRT3D_CUDA','CGLS3D_CUDA']] = 'SIRT3D_CUDA',
-        stopping_threshold: float = 1e-3
+        algorithm: Optional[Literal['SIRT3D_CUDA','CGLS3D_CUDA','SIRT3D_CPU','CGLS3D_CPU','FDK_CPU']] = 'SIRT3D_CUDA',
+        stopping_threshold: float = 1e-3,
+        load_workers: int = 0,
+        load_executor: Literal['thread','process'] = 'thread',
+        cache_dir: Optional[Path] = None,
+        cpu_threads: Optional[int] = None,
+        fdk_filter: Literal['ram-lak','shepp-logan'] = 'ram-lak',
+        fdk_residual: bool = False,
+        compare_to: Optional[Path] = None,
+        memory_budget: Optional[float] = None,
+        preview_every: int = 1,
+        preview_axes: Tuple[Literal['x','y','z'], ...] = ('z',),
+        save_chunked: bool = True,
+        save_npz: bool = True,
+        pyramid: bool = True,
+        downsampling: Literal['bilinear','area'] = 'bilinear'
 ):
     output_dir.mkdir(parents=True, exist_ok=True)
     print(f'Output folder: {output_dir}')
+    # per-phase wall time and peak RSS, written to timings.json/csv next to config.json
+    timer = PhaseTimer()
 
     if Lscale is None:
         Lscale = float(resolution/2)
     
-    def filter_name(x):
-        if 'train' not in x:
-            return False
-        i = int(x.split("_")[-1])
-        return i >= imin and i<=imax and (i - imin) % istep == 0
+    filter_name = FrameFilter('train', imin, imax, istep)
     # filter_name = lambda x: True
 
-    proj_data, proj_geom, image_filenames = load_projections(
-        input_dir, filter_name, image_downscale, Lscale
-    )
-
-    vol_geom = astra.create_vol_geom(resolution, resolution, resolution)
+    with timer.span('load'):
+        if cache_dir is None:
+            proj_data, proj_geom, image_filenames = load_projections(
+                input_dir, filter_name, image_downscale, Lscale, load_workers, load_executor, pyramid, timer,
+                downsampling
+            )
+        else:
+            proj_data, proj_geom, image_filenames = load_projections_cached(
+                cache_dir, input_dir, filter_name, image_downscale, Lscale,
+                {'imin': imin, 'imax': imax, 'istep': istep}, load_workers, load_executor, pyramid, timer,
+                downsampling
+            )
 
-    # Create empty volume
-    cube = np.zeros((vol_geom['GridSliceCount'], vol_geom['GridRowCount'], vol_geom['GridColCount'])) # todo check row col order
-  
-    # Create projection data from this
-    proj_id = astra.create_sino3d_gpu(cube, proj_geom, vol_geom, returnData=False)
-    astra.data3d.store(proj_id, proj_data)
+    with timer.span('geometry'):
+        vol_geom = cpu_recon.create_vol_geom(resolution, resolution, resolution)
 
     # Display a single projection image
     plt.figure(1)
@@ -164,72 +639,100 @@ def main(
     plt.savefig(output_dir/'projection.png')
     plt.close()
 
-    # Create a data object for the reconstruction
-    rec_id = astra.data3d.create('-vol', vol_geom)
-
-    # Set up the parameters for a reconstruction algorithm using the GPU
-    cfg = astra.astra_dict(algorithm)
-    cfg['ReconstructionDataId'] = rec_id
-    cfg['ProjectionDataId'] = proj_id
-    cfg['option'] = {'GPUindex': 0} # can be useful for multi GPU machines
-
-    # Create the algorithm object from the configuration structure
-    alg_id = astra.algorithm.create(cfg)
-
+    tic = time.perf_counter()
     # Run the algorithm
-    neach = 2
-    nmax = 50
-    print(f'Running {neach} iterations per step')
-    residual_error = []
-    t = PrintTableMetrics(['Iteration', 'Error', 'de/rng'])
-    de_rng = 0
-    for i in range(nmax):
-        # Run a single iteration
-        astra.algorithm.run(alg_id, neach)
-        residual_error.append(astra.algorithm.get_res_norm(alg_id))
+    if algorithm == 'FDK_CPU':
+        # FDK is a single pass; its residual costs a forward projection and is only logged with fdk_residual
+        neach, nmax = 1, 1
+        print('Running FDK in a single step')
+    else:
+        neach, nmax = 2, 50
+        print(f'Running {neach} iterations per step, at most {nmax} steps')
+    if memory_budget is None:
+        with timer.span('upload'):
+            solver = create_solver(algorithm, proj_data, proj_geom, vol_geom, cpu_threads, fdk_filter, fdk_residual)
 
-        # save slice
-        rec = astra.data3d.get(rec_id)
-        rec = normalize_reorder(rec)
-        save_slice(rec, output_dir)
+        # previews of the central slice(s) every preview_every steps (0 disables them)
+        preview = PreviewWriter(output_dir) if preview_every > 0 else None
+        def on_step(solver, i):
+            if preview is not None and i % preview_every == 0:
+                preview.submit(central_slices(solver, preview_axes))
+        residual_errors = [iterate(solver, neach, nmax, stopping_threshold, on_step, timer)]
+        if preview is not None:
+            with timer.span('preview'):
+                preview.close()
+            print(f'Preview writer: {preview.written} written, {preview.dropped} dropped, {preview.write_time:.2f} s in background')
 
-        # check convergence
-        if len(residual_error) > 1:
-            rng = max(residual_error) - min(residual_error)
-            de = residual_error[-1] - residual_error[-2]
-            de_rng = de / rng
-            # improvement by less than threshold
-            if de > 0 or -de_rng < stopping_threshold:
-                break
-        t.update({'Iteration': i, 'Error': residual_error[-1], 'de/rng': de_rng})
+        # Get the result and save
+        with timer.span('fetch'):
+            rec = solver.get()
+        solver.delete()
+        reconstruction_time = time.perf_counter() - tic
+        with timer.span('save'):
+            rec, _tmp = save_volume(rec, output_dir, save_npz)
+    else:
+        # out-of-core: peak memory is set by memory_budget (GB) rather than resolution
+        rec, residual_errors = reconstruct_slabs(
+            algorithm, proj_data, proj_geom, resolution, memory_budget, output_dir,
+            neach, nmax, stopping_threshold, cpu_threads, fdk_filter, timer, fdk_residual
+        )
+        reconstruction_time = time.perf_counter() - tic
+        rec_path = Path(rec.filename)
+        try:
+            with timer.span('save'):
+                rec = write_volume_slabs(rec, output_dir, save_npz=save_npz)
+        finally:
+            # the float32 volume is only needed until the uint16 volume is written
+            rec_path.unlink()
+        _tmp = rec
+    print(f'Reconstruction took {reconstruction_time:.2f} s')
+    if save_chunked:
+        # chunked multiscale volume alongside vol.npz, compressed in parallel and readable slice
+        # by slice with volume_io.ChunkedVolume.
+        # In slab mode the pyramid levels are memory-mapped so that memory_budget still holds
+        with timer.span('save'):
+            scratch = output_dir if memory_budget is not None else None
+            volume_io.write_chunked(output_dir/'vol.chunks', _tmp, scratch=scratch)
 
-    # Get the result and save
-    rec = astra.data3d.get(rec_id)
-    rec = normalize_reorder(rec)
-    _tmp = rec.astype(np.uint16)
-    _tmp.swapaxes(0,2).tofile(output_dir/f'vol_zyx.raw') 
-    np.savez_compressed(output_dir/f'vol.npz', vol=_tmp)
+    if compare_to is not None:
+        # compare against another reconstruction (e.g. iterative vs FDK) of the same data
+        ref_dir = compare_to if compare_to.is_dir() else compare_to.parent
+        with timer.span('compare'):
+            comparison = compare_volumes(_tmp, open_reconstruction(ref_dir, _tmp.shape))
+        comparison['algorithm'] = algorithm
+        comparison['reconstruction_time'] = reconstruction_time
+        ref_config = ref_dir/'config.json'
+        if ref_config.exists():
+            ref_config = json.loads(ref_config.read_text())
+            comparison['reference_algorithm'] = ref_config.get('algorithm')
+            comparison['reference_reconstruction_time'] = ref_config.get('reconstruction_time')
+        print(comparison)
+        (output_dir/'comparison.json').write_text(json.dumps(comparison, indent=2))
     del _tmp
 
-    # save slice
-    save_slice(rec, output_dir)
-
-    plt.figure(4)
-    plt.plot(neach*np.arange(len(residual_error)), residual_error)
-    plt.savefig(output_dir/f'convergence.png')
-    plt.close()
+    with timer.span('save'):
+        # save slice
+        save_slice(rec, output_dir)
 
-    # Clean up. Note that GPU memory is tied up in the algorithm object,
-    # and main RAM in the data objects.
-    astra.algorithm.delete(alg_id)
-    astra.data3d.delete(rec_id)
-    astra.data3d.delete(proj_id)
+        # no residuals were computed for FDK_CPU without fdk_residual
+        if any(residual_errors):
+            plt.figure(4)
+            for residual_error in residual_errors: # one curve per slab in slab mode
+                plt.plot(neach*np.arange(len(residual_error)), residual_error)
+            plt.savefig(output_dir/f'convergence.png')
+            plt.close()
 
     # save proj_geom to config.json file
     proj_geom['ProjectionAngles'] = proj_geom['ProjectionAngles'].tolist()
     proj_geom['image_filenames'] = image_filenames
     proj_geom['algorithm'] = algorithm
+    proj_geom['reconstruction_time'] = reconstruction_time
+    proj_geom['memory_budget'] = memory_budget
+    proj_geom['image_downscale'] = image_downscale
+    proj_geom['downsampling'] = downsampling
     (output_dir/'config.json').write_text(json.dumps(proj_geom, indent=2))
+    timer.summary()
+    timer.save(output_dir/'timings')
 
 if __name__ == '__main__':
     tyro.cli(main)
\ No newline at end of file
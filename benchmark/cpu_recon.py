@@ -0,0 +1,385 @@
+from contextlib import contextmanager
+from typing import Optional
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# CPU implementation of the ASTRA cone-beam geometry so that the benchmark can run
+# without CUDA. Geometry dictionaries follow ASTRA conventions:
+#   volume data is indexed (slice, row, col) = (z, y, x) with voxel size given by the window
+#   projection data is indexed (detector row, angle, detector col)
+
+@contextmanager
+def torch_threads(num_threads: Optional[int]):
+    # torch's intra-op thread count for the duration of a block; the caller's setting is
+    # restored afterwards, and None leaves it as it is
+    if num_threads is None:
+        yield
+        return
+    previous = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
+
+def create_vol_geom(
+        rows: int,
+        cols: int,
+        slices: int,
+        minx: Optional[float] = None,
+        maxx: Optional[float] = None,
+        miny: Optional[float] = None,
+        maxy: Optional[float] = None,
+        minz: Optional[float] = None,
+        maxz: Optional[float] = None
+) -> dict:
+    # same layout as astra.create_vol_geom(Y, X, Z, ...)
+    return {
+        'GridRowCount': rows,
+        'GridColCount': cols,
+        'GridSliceCount': slices,
+        'option': {
+            'WindowMinX': -cols/2 if minx is None else minx,
+            'WindowMaxX': cols/2 if maxx is None else maxx,
+            'WindowMinY': -rows/2 if miny is None else miny,
+            'WindowMaxY': rows/2 if maxy is None else maxy,
+            'WindowMinZ': -slices/2 if minz is None else minz,
+            'WindowMaxZ': slices/2 if maxz is None else maxz,
+        }
+    }
+
+def cone_vectors(proj_geom: dict) -> np.ndarray:
+    # (n_angles, 12) array of source, detector centre, u and v vectors as in astra's cone_vec
+    if proj_geom['type'] == 'cone_vec':
+        return np.asarray(proj_geom['Vectors'], dtype=np.float64)
+    if proj_geom['type'] != 'cone':
+        raise ValueError(f'Unsupported projection geometry {proj_geom["type"]}')
+    angles = np.asarray(proj_geom['ProjectionAngles'], dtype=np.float64)
+    dso = proj_geom['DistanceOriginSource']
+    dod = proj_geom['DistanceOriginDetector']
+    vectors = np.zeros((len(angles), 12))
+    vectors[:, 0] = np.sin(angles) * dso
+    vectors[:, 1] = -np.cos(angles) * dso
+    vectors[:, 3] = -np.sin(angles) * dod
+    vectors[:, 4] = np.cos(angles) * dod
+    vectors[:, 6] = np.cos(angles) * proj_geom['DetectorSpacingX']
+    vectors[:, 7] = np.sin(angles) * proj_geom['DetectorSpacingX']
+    vectors[:, 11] = proj_geom['DetectorSpacingY']
+    return vectors
+
+def cone_vec_geom(proj_geom: dict) -> dict:
+    return {
+        'type': 'cone_vec',
+        'DetectorRowCount': proj_geom['DetectorRowCount'],
+        'DetectorColCount': proj_geom['DetectorColCount'],
+        'Vectors': cone_vectors(proj_geom),
+    }
+
+class ConeBeamProjector:
+    # Ray-driven forward projector. Every ray is sampled at equidistant points along its chord
+    # through the volume and the volume is interpolated trilinearly. The back projection is
+    # the exact adjoint of this operator (the input gradient of grid_sample), so SIRT and CGLS
+    # see a matched projector pair. Rays are processed in batches of at most max_samples points.
+    # Both directions cost O(rays x samples per ray), with samples per ray ~ the volume diagonal
+    # in voxels, and the adjoint is about twice the cost of the forward projection: one SIRT or
+    # CGLS iteration at 48^3 with 96 views of 64^2 takes about 6 s on one thread. That is fine for
+    # tests and small volumes; use the CUDA algorithms (or FDK_CPU) for production sizes.
+    def __init__(
+            self,
+            proj_geom: dict,
+            vol_geom: dict,
+            step: float = 1.0,
+            max_samples: int = 1 << 24,
+            num_threads: Optional[int] = None
+    ) -> None:
+        self.num_threads = num_threads
+        self.vectors = torch.from_numpy(cone_vectors(proj_geom))
+        self.n_rows = int(proj_geom['DetectorRowCount'])
+        self.n_cols = int(proj_geom['DetectorColCount'])
+        self.n_angles = self.vectors.shape[0]
+        self.vol_shape = (vol_geom['GridSliceCount'], vol_geom['GridRowCount'], vol_geom['GridColCount'])
+        opt = vol_geom['option']
+        self.box_min = torch.tensor([opt['WindowMinX'], opt['WindowMinY'], opt['WindowMinZ']], dtype=torch.float64)
+        self.box_max = torch.tensor([opt['WindowMaxX'], opt['WindowMaxY'], opt['WindowMaxZ']], dtype=torch.float64)
+        voxel_size = (self.box_max - self.box_min) / torch.tensor(self.vol_shape[::-1], dtype=torch.float64)
+        self.step = step * float(voxel_size.min())
+        diagonal = float(torch.linalg.norm(self.box_max - self.box_min))
+        self.n_samples = int(np.ceil(diagonal / self.step))
+        self.max_samples = max_samples
+        self.sino_shape = (self.n_rows, self.n_angles, self.n_cols)
+
+    def _batches(self):
+        # yield (angle slice, row slice) blocks that fit into max_samples sample points
+        per_row = self.n_cols * self.n_samples
+        rows_per_block = max(1, min(self.n_rows, self.max_samples // per_row))
+        angles_per_block = max(1, self.max_samples // (per_row * self.n_rows)) if rows_per_block == self.n_rows else 1
+        for a0 in range(0, self.n_angles, angles_per_block):
+            for r0 in range(0, self.n_rows, rows_per_block):
+                yield slice(a0, min(a0+angles_per_block, self.n_angles)), slice(r0, min(r0+rows_per_block, self.n_rows))
+
+    def _grid(self, angles: slice, rows: slice):
+        # sample positions in grid_sample coordinates and per-ray sample lengths
+        vec = self.vectors[angles]
+        src, det, u, v = vec[:, 0:3], vec[:, 3:6], vec[:, 6:9], vec[:, 9:12]
+        r = torch.arange(rows.start, rows.stop, dtype=torch.float64) - self.n_rows/2 + 0.5
+        c = torch.arange(self.n_cols, dtype=torch.float64) - self.n_cols/2 + 0.5
+        pix = det[:, None, None, :] + r[None, :, None, None]*v[:, None, None, :] + c[None, None, :, None]*u[:, None, None, :]
+        d = pix - src[:, None, None, :]
+        d = d / torch.linalg.norm(d, dim=-1, keepdim=True)
+        # intersect rays with the volume box (slab method)
+        with torch.no_grad():
+            inv = 1 / torch.where(d.abs() < 1e-12, torch.full_like(d, 1e-12), d)
+            t0 = (self.box_min - src[:, None, None, :]) * inv
+            t1 = (self.box_max - src[:, None, None, :]) * inv
+            tmin = torch.minimum(t0, t1).amax(dim=-1)
+            tmax = torch.maximum(t0, t1).amin(dim=-1)
+            length = (tmax - tmin).clamp(min=0)
+        # sample positions are built in float32, directly in grid_sample coordinates
+        # (align_corners=False convention: [-1, 1] over the volume window): g = g0 + t*gd
+        scale = 2 / (self.box_max - self.box_min)
+        g0 = ((src - self.box_min) * scale - 1).to(torch.float32)[:, None, None, None, :]
+        gd = (d * scale).to(torch.float32)[..., None, :]
+        dt = (length / self.n_samples).to(torch.float32)
+        k = torch.arange(self.n_samples, dtype=torch.float32) + 0.5
+        t = torch.addcmul(tmin.to(torch.float32)[..., None], k, dt[..., None])
+        g = torch.addcmul(g0, t[..., None], gd)
+        return g, dt
+
+    def _project(self, vol: torch.Tensor, g: torch.Tensor, dt: torch.Tensor) -> torch.Tensor:
+        nb, nr, nc, ns, _ = g.shape
+        vals = F.grid_sample(
+            vol[None, None], g.view(1, nb*nr, nc, ns, 3),
+            mode='bilinear', padding_mode='zeros', align_corners=False
+        )
+        return vals.view(nb, nr, nc, ns).sum(dim=-1) * dt
+
+    def _backproject(self, proj: torch.Tensor, g: torch.Tensor, dt: torch.Tensor) -> torch.Tensor:
+        # adjoint of _project: the input gradient of grid_sample for the ray values spread over
+        # their samples, computed directly instead of through autograd (which would also run
+        # the forward projection and the gradient with respect to the grid)
+        nb, nr, nc, ns, _ = g.shape
+        grad = (proj * dt)[..., None].expand(nb, nr, nc, ns).reshape(1, 1, nb*nr, nc, ns)
+        vol, _ = torch.ops.aten.grid_sampler_3d_backward(
+            grad, torch.empty((1, 1) + self.vol_shape, dtype=torch.float32), g.view(1, nb*nr, nc, ns, 3),
+            0, 0, False, [True, False]
+        )
+        return vol[0, 0]
+
+    def forward(self, vol: torch.Tensor) -> torch.Tensor:
+        sino = torch.empty(self.sino_shape, dtype=torch.float32)
+        with torch.no_grad(), torch_threads(self.num_threads):
+            for angles, rows in self._batches():
+                g, dt = self._grid(angles, rows)
+                sino[rows, angles, :] = self._project(vol, g, dt).permute(1, 0, 2)
+        return sino
+
+    def backward(self, sino: torch.Tensor) -> torch.Tensor:
+        x = torch.zeros(self.vol_shape, dtype=torch.float32)
+        with torch.no_grad(), torch_threads(self.num_threads):
+            for angles, rows in self._batches():
+                g, dt = self._grid(angles, rows)
+                x += self._backproject(sino[rows, angles, :].permute(1, 0, 2), g, dt)
+        return x
+
+class CPUSolver:
+    # Same interface as the ASTRA algorithm wrapper in astra_recon: run, res_norm, get, delete
+    def __init__(self, proj_data: np.ndarray, proj_geom: dict, vol_geom: dict, **projector_kwargs) -> None:
+        self.A = ConeBeamProjector(proj_geom, vol_geom, **projector_kwargs)
+        self.b = torch.from_numpy(np.ascontiguousarray(proj_data, dtype=np.float32))
+        assert tuple(self.b.shape) == self.A.sino_shape, f'Projection data of shape {tuple(self.b.shape)} does not match geometry {self.A.sino_shape}'
+        self.x = torch.zeros(self.A.vol_shape, dtype=torch.float32)
+        self.vol_shape = self.A.vol_shape
+
+    def get(self) -> np.ndarray:
+        return self.x.numpy().copy()
+
+    def get_slice(self, axis: int, index: int) -> np.ndarray:
+        return self.x.select(axis, index).numpy().copy()
+
+    def delete(self):
+        del self.A, self.b, self.x
+
+class SIRT3DCPU(CPUSolver):
+    # x <- x + C A^T R (b - A x) with R, C the inverse row and column sums, as in SIRT3D_CUDA
+    def __init__(self, proj_data: np.ndarray, proj_geom: dict, vol_geom: dict, **projector_kwargs) -> None:
+        super().__init__(proj_data, proj_geom, vol_geom, **projector_kwargs)
+        row_sums = self.A.forward(torch.ones(self.A.vol_shape, dtype=torch.float32))
+        col_sums = self.A.backward(torch.ones(self.A.sino_shape, dtype=torch.float32))
+        self.R = torch.where(row_sums > 1e-6, 1 / row_sums, torch.zeros_like(row_sums))
+        self.C = torch.where(col_sums > 1e-6, 1 / col_sums, torch.zeros_like(col_sums))
+        self._residual = None
+
+    def run(self, iterations: int):
+        for _ in range(iterations):
+            r = self._residual if self._residual is not None else self.b - self.A.forward(self.x)
+            self.x += self.C * self.A.backward(self.R * r)
+            self._residual = None
+
+    def res_norm(self) -> float:
+        # the residual is kept for the next iteration so that asking for it costs nothing extra
+        self._residual = self.b - self.A.forward(self.x)
+        return float(torch.linalg.norm(self._residual))
+
+class CGLS3DCPU(CPUSolver):
+    def __init__(self, proj_data: np.ndarray, proj_geom: dict, vol_geom: dict, **projector_kwargs) -> None:
+        super().__init__(proj_data, proj_geom, vol_geom, **projector_kwargs)
+        self.r = self.b.clone()
+        self.p = self.A.backward(self.r)
+        self.gamma = float(self.p.pow(2).sum())
+
+    def run(self, iterations: int):
+        for _ in range(iterations):
+            if self.gamma == 0:
+                break
+            q = self.A.forward(self.p)
+            alpha = self.gamma / float(q.pow(2).sum())
+            self.x += alpha * self.p
+            self.r -= alpha * q
+            s = self.A.backward(self.r)
+            gamma = float(s.pow(2).sum())
+            self.p = s + (gamma / self.gamma) * self.p
+            self.gamma = gamma
+
+    def res_norm(self) -> float:
+        return float(torch.linalg.norm(self.r))
+
+
+def fdk_filter(n: int, filter_type: str = 'ram-lak') -> torch.Tensor:
+    # frequency response of the discrete ramp filter (Kak & Slaney) for a padded row of length n
+    k = torch.arange(-(n//2), n - n//2, dtype=torch.float64)
+    h = torch.zeros(n, dtype=torch.float64)
+    h[k == 0] = 0.25
+    odd = (k % 2) == 1
+    h[odd] = -1 / (np.pi * k[odd])**2
+    H = torch.fft.rfft(torch.fft.ifftshift(h)).real
+    if filter_type == 'shepp-logan':
+        f = torch.fft.rfftfreq(n, dtype=torch.float64)
+        H = H * torch.sinc(f)
+    elif filter_type != 'ram-lak':
+        raise ValueError(f'Unknown filter {filter_type}')
+    return H.to(torch.float32)
+
+def fdk(
+        proj_data: np.ndarray,
+        proj_geom: dict,
+        vol_geom: dict,
+        filter_type: str = 'ram-lak',
+        max_samples: int = 1 << 24,
+        num_threads: Optional[int] = None
+) -> np.ndarray:
+    # Feldkamp-Davis-Kress reconstruction for (full-angle) circular cone-beam scans:
+    # cosine weighting, row-wise ramp filtering and distance-weighted voxel-driven backprojection.
+    # Backprojection is parallelised through torch's intra-op threads (num_threads of them
+    # while fdk runs, None keeps the current setting).
+    with torch_threads(num_threads):
+        return _fdk(proj_data, proj_geom, vol_geom, filter_type, max_samples)
+
+def _fdk(
+        proj_data: np.ndarray,
+        proj_geom: dict,
+        vol_geom: dict,
+        filter_type: str,
+        max_samples: int
+) -> np.ndarray:
+    vectors = torch.from_numpy(cone_vectors(proj_geom))
+    n_rows, n_angles, n_cols = proj_data.shape
+    src, det, u, v = vectors[:, 0:3], vectors[:, 3:6], vectors[:, 6:9], vectors[:, 9:12]
+    normal = torch.linalg.cross(u, v)
+    normal = normal / torch.linalg.norm(normal, dim=-1, keepdim=True)
+    normal = normal * torch.sign(((det - src) * normal).sum(-1, keepdim=True))
+    dsd = ((det - src) * normal).sum(-1) # source to detector plane
+    dso = (-src * normal).sum(-1) # source to rotation axis
+    du = torch.linalg.norm(u, dim=-1) * dso / dsd # detector spacing at the rotation axis
+
+    # angular integration weights from the spacing of the (sorted) projection angles
+    # (for cone_vec geometries the angle is recovered from the source position)
+    angles = np.arctan2(vectors[:, 0].numpy(), -vectors[:, 1].numpy()) % (2*np.pi)
+    order = np.argsort(angles)
+    spacing = np.diff(np.concatenate([angles[order], angles[order[:1]] + 2*np.pi]))
+    dbeta = np.empty(n_angles)
+    dbeta[order] = (spacing + np.roll(spacing, 1)) / 2
+    dbeta = torch.from_numpy(dbeta)
+
+    # cosine weighting
+    r = torch.arange(n_rows, dtype=torch.float64) - n_rows/2 + 0.5
+    c = torch.arange(n_cols, dtype=torch.float64) - n_cols/2 + 0.5
+    sino = torch.from_numpy(np.ascontiguousarray(proj_data, dtype=np.float32)).permute(1, 0, 2) # angle, row, col
+    filtered = torch.empty_like(sino)
+    n_pad = 1 << int(np.ceil(np.log2(2*n_cols)))
+    H = fdk_filter(n_pad, filter_type)
+    for a in range(n_angles):
+        pix = det[a] + r[:, None, None]*v[a] + c[None, :, None]*u[a]
+        cos_w = (dsd[a] / torch.linalg.norm(pix - src[a], dim=-1)).to(torch.float32)
+        # batched FFT filtering over all detector rows
+        rows = torch.fft.rfft(sino[a] * cos_w, n=n_pad, dim=-1)
+        filtered[a] = torch.fft.irfft(rows * H, n=n_pad, dim=-1)[:, :n_cols] / float(du[a])
+
+    nz, ny, nx = vol_geom['GridSliceCount'], vol_geom['GridRowCount'], vol_geom['GridColCount']
+    opt = vol_geom['option']
+    xs = opt['WindowMinX'] + (torch.arange(nx, dtype=torch.float64) + 0.5) * (opt['WindowMaxX'] - opt['WindowMinX']) / nx
+    ys = opt['WindowMinY'] + (torch.arange(ny, dtype=torch.float64) + 0.5) * (opt['WindowMaxY'] - opt['WindowMinY']) / ny
+    zs = opt['WindowMinZ'] + (torch.arange(nz, dtype=torch.float64) + 0.5) * (opt['WindowMaxZ'] - opt['WindowMinZ']) / nz
+    vol = torch.zeros((nz, ny, nx), dtype=torch.float32)
+    slab = max(1, min(nz, max_samples // (nx*ny)))
+    for z0 in range(0, nz, slab):
+        z1 = min(z0 + slab, nz)
+        X = torch.stack(torch.meshgrid(zs[z0:z1], ys, xs, indexing='ij')[::-1], dim=-1) # (z, y, x, [x y z])
+        for a in range(n_angles):
+            d = X - src[a]
+            U = (d * normal[a]).sum(-1)
+            P = d * (dsd[a] / U)[..., None] + (src[a] - det[a])
+            cc = (P @ u[a]) / (u[a] @ u[a]) + n_cols/2 - 0.5
+            rr = (P @ v[a]) / (v[a] @ v[a]) + n_rows/2 - 0.5
+            grid = torch.stack([(cc + 0.5) / n_cols * 2 - 1, (rr + 0.5) / n_rows * 2 - 1], dim=-1)
+            vals = F.grid_sample(
+                filtered[a][None, None], grid.view(1, z1-z0, ny*nx, 2).to(torch.float32),
+                mode='bilinear', padding_mode='zeros', align_corners=False
+            ).view(z1-z0, ny, nx)
+            vol[z0:z1] += vals * ((dso[a] / U)**2 * dbeta[a] / 2).to(torch.float32)
+    return vol.numpy()
+
+class FDKCPU(CPUSolver):
+    # One-shot reconstruction; run() computes the FDK volume on the first call and does nothing after.
+    # The residual needs a full forward projection, about as long as FDK itself, so res_norm
+    # returns nan unless residual=True.
+    def __init__(
+            self,
+            proj_data: np.ndarray,
+            proj_geom: dict,
+            vol_geom: dict,
+            filter_type: str = 'ram-lak',
+            residual: bool = False,
+            **projector_kwargs
+    ) -> None:
+        super().__init__(proj_data, proj_geom, vol_geom, **projector_kwargs)
+        self.proj_geom = proj_geom
+        self.vol_geom = vol_geom
+        self.filter_type = filter_type
+        self.residual = residual
+        self.num_threads = projector_kwargs.get('num_threads')
+        self.done = False
+
+    def run(self, iterations: int):
+        if self.done:
+            return
+        self.x = torch.from_numpy(fdk(
+            self.b.numpy(), self.proj_geom, self.vol_geom, self.filter_type, self.A.max_samples, self.num_threads
+        ))
+        self.done = True
+
+    def res_norm(self) -> float:
+        if not self.residual:
+            return float('nan')
+        return float(torch.linalg.norm(self.b - self.A.forward(self.x)))
+
+SOLVERS = {
+    'SIRT3D_CPU': SIRT3DCPU,
+    'CGLS3D_CPU': CGLS3DCPU,
+    'FDK_CPU': FDKCPU,
+}
+
+def create_solver(algorithm: str, proj_data: np.ndarray, proj_geom: dict, vol_geom: dict, **kwargs) -> CPUSolver:
+    if algorithm not in SOLVERS:
+        raise ValueError(f'Unknown CPU algorithm {algorithm}')
+    return SOLVERS[algorithm](proj_data, proj_geom, vol_geom, **kwargs)
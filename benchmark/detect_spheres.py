@@ -0,0 +1,233 @@
+# %%
+from pathlib import Path
+from typing import Dict, List, Literal, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import json
+import time
+import numpy as np
+import pandas as pd
+import tyro
+import yaml
+from scipy import ndimage
+from scipy.optimize import linear_sum_assignment
+
+from volume_io import ChunkedVolume
+
+# Headless sphere measurement over whole volumes. A volume is thresholded (Otsu by default),
+# split into connected components, and a sphere is fitted to the surface voxels of every
+# component at once: the algebraic least-squares fit |p|^2 = 2 c.p + d is linear, so its normal
+# equations are accumulated for all components with np.bincount and solved as a batch of 4x4
+# systems. Centres and radii are reported in voxels and normalized to the [-1, 1] coordinates of
+# balls_XX.yaml, in which voxel i of n is centred at (i + 0.5)/n*2 - 1 (as in
+# sphere_gui.fit_sphere), and matched to the ground truth with the Hungarian algorithm.
+# Touching spheres form one component and are not separated.
+
+def load_volume(
+        path: Path,
+        resolution: Optional[Tuple[int, int, int]] = None,
+        dtype: Optional[str] = None,
+        level: int = 0
+) -> np.ndarray:
+    # volume in the XYZ layout of vol.npz
+    path = Path(path)
+    if path.suffix == '.chunks':
+        return np.asarray(ChunkedVolume(path, level))
+    if path.suffix == '.npz':
+        return np.load(path)['vol']
+    if path.suffix == '.npy':
+        return np.load(path, mmap_mode='r')
+    if path.suffix == '.raw':
+        assert resolution is not None and dtype is not None, 'Reading .raw needs resolution and dtype'
+        vol = np.memmap(path, dtype=dtype, mode='r')
+        assert len(vol) == np.prod(resolution), f'Expected {np.prod(resolution)} elements but got {len(vol)} in {path}'
+        return vol.reshape(resolution[2], resolution[1], resolution[0]).swapaxes(0, 2) # vol_zyx.raw
+    raise ValueError(f'Unsupported file format {path.suffix}')
+
+def otsu_threshold(vol: np.ndarray, bins: int = 256) -> float:
+    hist, edges = np.histogram(vol, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist * centers)
+    mu0 = m0 / np.maximum(w0, 1)
+    mu1 = (m0[-1] - m0) / np.maximum(w1, 1)
+    between = w0 * w1 * (mu0 - mu1)**2
+    return float(edges[1:][np.argmax(between)])
+
+def fit_spheres(labels: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # least-squares spheres (centres (n, 3), radii (n,), residual rms (n,)) through the surface
+    # voxels of components 1..n of labels, in voxel coordinates
+    mask = labels > 0
+    # border_value=1: faces cut by the volume boundary are not part of the surface
+    surface = mask & ~ndimage.binary_erosion(mask, border_value=1)
+    lab = labels[surface] - 1
+    p = np.stack(np.nonzero(surface), axis=-1).astype(np.float64)
+    count = np.bincount(lab, minlength=n).astype(np.float64)
+    # centre each component on its mean for conditioning
+    mean = np.stack([np.bincount(lab, p[:, k], n) for k in range(3)], axis=-1) / np.maximum(count, 1)[:, None]
+    q = p - mean[lab]
+    A = np.concatenate([2*q, np.ones((len(q), 1))], axis=1)
+    b = (q*q).sum(axis=1)
+    AtA = np.empty((n, 4, 4))
+    Atb = np.empty((n, 4))
+    for i in range(4):
+        Atb[:, i] = np.bincount(lab, A[:, i]*b, n)
+        for j in range(i, 4):
+            AtA[:, i, j] = AtA[:, j, i] = np.bincount(lab, A[:, i]*A[:, j], n)
+    # components too small to constrain a sphere get a tiny ridge instead of a singular system
+    AtA += 1e-9 * np.eye(4)
+    x = np.linalg.solve(AtA, Atb[..., None])[..., 0]
+    c = x[:, :3]
+    r = np.sqrt(np.maximum(x[:, 3] + (c*c).sum(axis=1), 0))
+    residual = np.sqrt(np.bincount(lab, (np.linalg.norm(q - c[lab], axis=1) - r[lab])**2, n) / np.maximum(count, 1))
+    # surface voxel centres lie half a voxel inside the boundary of the component
+    return c + mean, r + 0.5, residual
+
+def detect_spheres(
+        vol: np.ndarray,
+        threshold: Optional[float] = None,
+        min_voxels: int = 27
+) -> Tuple[List[dict], float]:
+    vol = np.asarray(vol)
+    if threshold is None:
+        threshold = otsu_threshold(vol)
+    labels, n = ndimage.label(vol > threshold)
+    sizes = np.bincount(labels.ravel(), minlength=n + 1)[1:]
+    keep = np.nonzero(sizes >= min_voxels)[0]
+    # relabel the kept components 1..len(keep)
+    relabel = np.zeros(n + 1, dtype=labels.dtype)
+    relabel[keep + 1] = np.arange(1, len(keep) + 1)
+    labels = relabel[labels]
+    centers, radii, residuals = fit_spheres(labels, len(keep))
+    shape = np.array(vol.shape, dtype=np.float64)
+    spheres = []
+    for c, r, res, size in zip(centers, radii, residuals, sizes[keep]):
+        spheres.append({
+            'center': ((c + 0.5) / shape * 2 - 1).tolist(),
+            'radius': float(r / shape[0] * 2),
+            'center_voxels': c.tolist(),
+            'radius_voxels': float(r),
+            'voxels': int(size),
+            'fit_rms': float(res),
+        })
+    return spheres, threshold
+
+def read_reference(path: Path) -> Tuple[np.ndarray, np.ndarray]:
+    # centres (n, 3) and radii (n,) of the spheres of an object_collection YAML
+    objects = yaml.safe_load(Path(path).read_text()).get('objects') or []
+    spheres = [o for o in objects if o.get('type') == 'sphere']
+    centers = np.array([o['center'] for o in spheres], dtype=np.float64).reshape(-1, 3)
+    radii = np.array([o['radius'] for o in spheres], dtype=np.float64)
+    return centers, radii
+
+def match_spheres(spheres: List[dict], ref_centers: np.ndarray, ref_radii: np.ndarray, max_distance: float) -> dict:
+    # Hungarian matching on centre distance; pairs further apart than max_distance are unmatched
+    centers = np.array([s['center'] for s in spheres]).reshape(-1, 3)
+    radii = np.array([s['radius'] for s in spheres])
+    dist = np.linalg.norm(centers[:, None] - ref_centers[None], axis=-1)
+    rows, cols = linear_sum_assignment(dist) if dist.size else (np.zeros(0, int), np.zeros(0, int))
+    ok = dist[rows, cols] <= max_distance
+    rows, cols = rows[ok], cols[ok]
+    for s in spheres:
+        s['match'] = None
+    for i, j in zip(rows, cols):
+        spheres[i].update({
+            'match': int(j),
+            'reference_center': ref_centers[j].tolist(),
+            'reference_radius': float(ref_radii[j]),
+            'center_error': float(dist[i, j]),
+            'radius_error': float(radii[i] - ref_radii[j]),
+        })
+    center_errors = dist[rows, cols]
+    radius_errors = np.abs(radii[rows] - ref_radii[cols])
+    return {
+        'n_reference': len(ref_centers),
+        'n_matched': len(rows),
+        'mean_center_error': float(center_errors.mean()) if len(rows) else None,
+        'max_center_error': float(center_errors.max()) if len(rows) else None,
+        'mean_radius_error': float(radius_errors.mean()) if len(rows) else None,
+        'max_radius_error': float(radius_errors.max()) if len(rows) else None,
+    }
+
+def _process(pair: dict, resolution, dtype, level, threshold, min_voxels, max_distance) -> dict:
+    tic = time.perf_counter()
+    vol = load_volume(pair['vol_path'], resolution, dtype, level)
+    load_time = time.perf_counter() - tic
+    tic = time.perf_counter()
+    spheres, used_threshold = detect_spheres(vol, threshold, min_voxels)
+    summary = {'name': pair['name'], 'vol_path': str(pair['vol_path']), 'n_detected': len(spheres), 'threshold': used_threshold}
+    if pair['ref_path'] is not None:
+        summary['ref_path'] = str(pair['ref_path'])
+        summary.update(match_spheres(spheres, *read_reference(pair['ref_path']), max_distance))
+    summary['load_time'] = load_time
+    summary['detect_time'] = time.perf_counter() - tic
+    return {'summary': summary, 'spheres': spheres}
+
+# %%
+def main(
+    vol_glob: str,
+    ref_glob: Optional[str] = None,
+    out_dir: Path = Path('detect_spheres'),
+    resolution: Optional[Tuple[int, int, int]] = None,
+    dtype: Optional[Literal['uint8', 'uint16', 'float32']] = None,
+    level: int = 0,
+    threshold: Optional[float] = None,
+    min_voxels: int = 27,
+    max_distance: float = 0.2,
+    workers: int = 0,
+):
+    """Detect and fit all spheres in the volumes matching vol_glob.
+
+    Sorted matches of ref_glob (balls_XX.yaml) are paired with the volumes in order; a single
+    reference is shared by all volumes. threshold defaults to Otsu's per volume, max_distance
+    (normalized units) limits the centre distance of matched spheres. Writes spheres.json with
+    every fitted sphere and spheres.csv with one row per volume to out_dir. workers=0 runs in
+    this process.
+    """
+    vols = sorted(glob.glob(vol_glob))
+    assert len(vols) > 0, f'No volumes match {vol_glob}'
+    refs = [None]*len(vols)
+    if ref_glob is not None:
+        refs = sorted(glob.glob(ref_glob))
+        assert len(refs) > 0, f'No references match {ref_glob}'
+        if len(refs) == 1:
+            refs = refs*len(vols)
+        assert len(vols) == len(refs), f'{len(vols)} volumes but {len(refs)} references'
+    pairs = [
+        {'name': f'{i:02d}_{Path(v).parent.name}', 'vol_path': Path(v), 'ref_path': None if r is None else Path(r)}
+        for i, (v, r) in enumerate(zip(vols, refs))
+    ]
+    print(f'Detecting spheres in {len(pairs)} volumes')
+
+    args = (resolution, dtype, level, threshold, min_voxels, max_distance)
+    tic = time.perf_counter()
+    if workers > 0:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_process, pair, *args) for pair in pairs]
+            results = []
+            for pair, future in zip(pairs, futures):
+                results.append(future.result())
+                print(f'{pair["name"]}: {results[-1]["summary"]}')
+    else:
+        results = []
+        for pair in pairs:
+            results.append(_process(pair, *args))
+            print(f'{pair["name"]}: {results[-1]["summary"]}')
+    total_time = time.perf_counter() - tic
+    print(f'Processed {len(pairs)} volumes in {total_time:.2f} s')
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    table = pd.DataFrame([r['summary'] for r in results])
+    table.to_csv(out_dir/'spheres.csv', index=False)
+    (out_dir/'spheres.json').write_text(json.dumps({'volumes': results, 'total_time': total_time}, indent=2))
+    for r in results:
+        print(r['summary']['name'])
+        for s in r['spheres']:
+            xc, yc, zc = s['center']
+            print(f'\tNormalised: ({xc:.3g}, {yc:.3g}, {zc:.3g}), {s["radius"]:.3g}')
+    print(table.to_string(index=False))
+    print(f'Saving table to {out_dir/"spheres.csv"}')
+# %%
+if __name__=='__main__':
+    tyro.cli(main)
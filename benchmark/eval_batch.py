@@ -0,0 +1,159 @@
+# %%
+from pathlib import Path
+from typing import Optional, Tuple, List
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import glob
+import json
+import time
+import os
+import tyro
+import pandas as pd
+import torch
+
+from eval_loss import DTYPES, load_obj, eval_grid, evaluate
+
+# Evaluate many (reconstruction, reference) pairs, e.g. all timesteps of a 4D sequence, in one
+# process tree. Every reference and the evaluation grid are loaded once in the parent; workers
+# are forked from it and inherit them, so each task only loads its reconstruction. With workers
+# the parent runs torch single-threaded until the fork: a child forked from a process whose
+# OpenMP thread pool has already started can deadlock in its first parallel region.
+# %%
+_shared = {}
+
+def _init_worker(refs: dict, grid, torch_threads: int):
+    _shared['refs'] = refs
+    _shared['grid'] = grid
+    torch.set_num_threads(torch_threads)
+
+def _eval_pair(pair: dict, obj_resolution, obj_dtype, obj_level, block_slices) -> dict:
+    tic = time.perf_counter()
+    obj = load_obj(pair['obj_path'], obj_resolution, obj_dtype, obj_level)
+    load_time = time.perf_counter() - tic
+    out_dir = pair['out_dir']
+    out_dir.mkdir(parents=True, exist_ok=True)
+    tic = time.perf_counter()
+    loss_dict = evaluate(obj, _shared['refs'][pair['ref_path']], _shared['grid'], out_dir, block_slices)
+    eval_time = time.perf_counter() - tic
+    (out_dir/'eval_loss.json').write_text(json.dumps(loss_dict, indent=2))
+    return {
+        'name': pair['name'],
+        'obj_path': str(pair['obj_path']),
+        'ref_path': str(pair['ref_path']),
+        **loss_dict,
+        'load_time': load_time,
+        'eval_time': eval_time,
+    }
+
+def read_manifest(manifest: Path) -> List[dict]:
+    # .json: list of {"obj_path", "ref_path"[, "name"]}; .csv: the same as columns.
+    # Relative paths are resolved against the manifest's directory.
+    if manifest.suffix == '.json':
+        rows = json.loads(manifest.read_text())
+    elif manifest.suffix == '.csv':
+        rows = pd.read_csv(manifest).to_dict('records')
+    else:
+        raise ValueError(f'Unsupported manifest format {manifest.suffix}')
+    pairs = []
+    for row in rows:
+        pairs.append({
+            'obj_path': manifest.parent/row['obj_path'],
+            'ref_path': manifest.parent/row['ref_path'],
+            'name': row.get('name'),
+        })
+    return pairs
+
+def glob_pairs(obj_glob: str, ref_glob: str) -> List[dict]:
+    # sorted matches are paired in order; a single reference is shared by all reconstructions
+    objs = sorted(glob.glob(obj_glob))
+    refs = sorted(glob.glob(ref_glob))
+    assert len(objs) > 0, f'No reconstructions match {obj_glob}'
+    assert len(refs) > 0, f'No references match {ref_glob}'
+    if len(refs) == 1:
+        refs = refs*len(objs)
+    assert len(objs) == len(refs), f'{len(objs)} reconstructions but {len(refs)} references'
+    return [{'obj_path': Path(o), 'ref_path': Path(r), 'name': None} for o, r in zip(objs, refs)]
+# %%
+def main(
+    manifest: Optional[Path] = None,
+    obj_glob: Optional[str] = None,
+    ref_glob: Optional[str] = None,
+    out_dir: Path = Path('eval_batch'),
+    eval_resolution: int = 200,
+    obj_resolution: Optional[Tuple[int, int, int]] = None,
+    obj_dtype: Optional[DTYPES] = None,
+    ref_resolution: Optional[Tuple[int, int, int]] = None,
+    ref_dtype: Optional[DTYPES] = None,
+    extent: Optional[List[Tuple[float, float]]] = None,
+    obj_level: int = 0,
+    ref_level: int = 0,
+    block_slices: Optional[int] = None,
+    workers: int = 0,
+):
+    """Evaluate pairs from a manifest (.csv/.json) or from obj_glob/ref_glob.
+
+    Writes eval_batch.csv and eval_batch.json with the metrics and timings of every pair to
+    out_dir, and slices_eval.png/eval_loss.json of each pair to out_dir/<name>.
+    workers=0 evaluates in this process.
+    """
+    if manifest is not None:
+        pairs = read_manifest(manifest)
+    else:
+        assert obj_glob is not None and ref_glob is not None, 'Provide a manifest or obj_glob and ref_glob'
+        pairs = glob_pairs(obj_glob, ref_glob)
+    for i, pair in enumerate(pairs):
+        if pair['name'] is None or pd.isna(pair['name']):
+            pair['name'] = f'{i:02d}_{pair["obj_path"].parent.name}'
+        pair['out_dir'] = out_dir/pair['name']
+    print(f'Evaluating {len(pairs)} pairs')
+    if workers > 0:
+        # before any torch op so that no OpenMP pool exists when the workers are forked
+        torch.set_num_threads(1)
+
+    tic = time.perf_counter()
+    refs = {}
+    for ref_path in dict.fromkeys(pair['ref_path'] for pair in pairs):
+        print(f'Loading reference object from {ref_path}')
+        refs[ref_path] = load_obj(ref_path, ref_resolution, ref_dtype, ref_level)
+    grid = eval_grid(eval_resolution, extent)
+    setup_time = time.perf_counter() - tic
+    print(f'Loaded {len(refs)} references in {setup_time:.2f} s')
+
+    args = (obj_resolution, obj_dtype, obj_level, block_slices)
+    tic = time.perf_counter()
+    if workers > 0:
+        # fork so that the workers share the loaded references instead of unpickling copies
+        methods = mp.get_all_start_methods()
+        ctx = mp.get_context('fork' if 'fork' in methods else None)
+        torch_threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(refs, grid, torch_threads)) as pool:
+            futures = [pool.submit(_eval_pair, pair, *args) for pair in pairs]
+            results = []
+            for pair, future in zip(pairs, futures):
+                results.append(future.result())
+                print(f'{pair["name"]}: {results[-1]}')
+    else:
+        _init_worker(refs, grid, torch.get_num_threads())
+        results = []
+        for pair in pairs:
+            results.append(_eval_pair(pair, *args))
+            print(f'{pair["name"]}: {results[-1]}')
+    total_time = time.perf_counter() - tic
+    print(f'Evaluated {len(pairs)} pairs in {total_time:.2f} s (+{setup_time:.2f} s setup)')
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    table = pd.DataFrame(results)
+    table.to_csv(out_dir/'eval_batch.csv', index=False)
+    summary = {
+        'pairs': results,
+        'setup_time': setup_time,
+        'total_time': total_time,
+        'workers': workers,
+    }
+    (out_dir/'eval_batch.json').write_text(json.dumps(summary, indent=2))
+    print(table.to_string(index=False))
+    print(f'Saving table to {out_dir/"eval_batch.csv"}')
+# %%
+if __name__=='__main__':
+    tyro.cli(main)
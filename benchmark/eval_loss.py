@@ -1,7 +1,8 @@
 # %%
 from pathlib import Path
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Literal
 from enum import Enum
+import time
 import tyro
 import json
 import numpy as np
@@ -10,7 +11,15 @@ import matplotlib.pyplot as plt
 import os
 os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
 
-from nerf_xray.objects import Object, VoxelGrid
+try:
+    from nerf_xray.objects import Object, VoxelGrid
+except ImportError: # voxel volumes (.raw/.chunks) are read without nerf_xray
+    Object = VoxelGrid = None
+from volume_io import ChunkedVolume
+from metrics import RunningStats, bootstrap_metrics, sample_points
+from lazy_grid import LazyVoxelGrid, lazy_voxel_grid, as_grid, density_blocks
+from align import apply_alignment, find_alignment
+from utils import PhaseTimer
 # %%
 class DTYPES(Enum):
     UINT8 = np.uint8
@@ -27,28 +36,209 @@ class DTYPES(Enum):
 def load_obj(
         ref_path: Path, 
         resolution: Optional[Tuple[int, int, int]]=None, 
-        dtype: Optional[DTYPES]=None
+        dtype: Optional[DTYPES]=None,
+        level: int = 0
 ):
-    if ref_path.suffix in ['.npy', '.npz', '.yaml']:
+    if ref_path.suffix == '.chunks':
+        # chunked volume written by astra_recon (same XYZ layout as vol.npz); level selects the pyramid
         assert resolution is None
         assert dtype is None
+        vol = ChunkedVolume(ref_path, level)
+        vol = vol.swapaxes(0,2) # ZYX as needed for torch, as for vol_zyx.raw
+        vol = lazy_voxel_grid(vol)
+    elif ref_path.suffix in ['.npy', '.npz', '.yaml']:
+        assert resolution is None
+        assert dtype is None
+        if Object is None:
+            raise ImportError(f'nerf_xray is needed to load {ref_path.suffix} files')
         vol = Object.from_file(ref_path)
     elif ref_path.suffix == '.raw':
         assert resolution is not None
         assert dtype is not None
         dtype = dtype.value
-        vol = np.fromfile(ref_path, dtype=dtype)
+        # memory-mapped in its native dtype; voxels are converted to float per density query
+        vol = np.memmap(ref_path, dtype=dtype, mode='r')
         assert len(vol) == np.prod(resolution), f'Expected {np.prod(resolution)} elements but got {len(vol)} in {ref_path}'
         vol = vol.reshape(resolution[2], resolution[1], resolution[0]) # ZYX as needed for torch
         # vol = vol.swapaxes(0,2)
-        vol = torch.from_numpy(vol.astype(float))
-        vol = VoxelGrid(vol)
+        vol = lazy_voxel_grid(vol)
     else:
         raise ValueError(f'Unsupported file format {ref_path.suffix}')
-    if isinstance(vol, VoxelGrid):
+    if isinstance(vol, LazyVoxelGrid) or (VoxelGrid is not None and isinstance(vol, VoxelGrid)):
         print(f'VoxelGrid of shape {vol.rho.shape} loaded')
     return vol
 # %%
+def plot_slices(ref_slice, obj_slice, diff_slice, out_dir: Path):
+    # plot slices as sanity check
+    fig, axs = plt.subplots(1, 3, figsize=(12, 4))
+    axs[0].imshow(ref_slice)
+    axs[0].set_title('Target')
+    axs[1].imshow(obj_slice)
+    axs[1].set_title('Reconstruction')
+    axs[2].imshow(diff_slice, cmap='bwr')
+    axs[2].set_title('Difference')
+    plt.savefig(out_dir/'slices_eval.png')
+    plt.close()
+
+def dense_eval(obj, vol, xpos, ypos, zpos, out_dir: Path, timer: Optional[PhaseTimer] = None) -> dict:
+    timer = timer if timer is not None else PhaseTimer()
+    eval_resolution = len(xpos)
+    with timer.span('density'):
+        pos = torch.stack(torch.meshgrid(xpos, ypos, zpos, indexing='ij'), dim=-1)
+        density = obj.density(pos.view(-1, 3)).view(eval_resolution, eval_resolution, eval_resolution)
+        ref_density = vol.density(pos.view(-1, 3)).view(eval_resolution, eval_resolution, eval_resolution)
+    with timer.span('plot'):
+        # normalise to zero mean and unit variance
+        density_n = density - density.mean()
+        density_n = density_n / density_n.std()
+        pred_density_n = ref_density - ref_density.mean()
+        pred_density_n = pred_density_n / pred_density_n.std()
+        
+        plot_slices(
+            ref_density[:,:,eval_resolution//2],
+            density[:,:,eval_resolution//2].cpu().numpy(),
+            (density_n-pred_density_n)[:,:,eval_resolution//2].cpu().numpy(),
+            out_dir
+        )
+
+    with timer.span('metrics'):
+        y = ref_density.flatten()
+        x = density.flatten()
+
+        density_loss = torch.nn.functional.mse_loss(y, x).item()
+
+        density_n = (x - x.min()) / (x.max() - x.min())
+        pred_dens_n = (y - y.min()) / (y.max() - y.min())
+        scaled_density_loss = torch.nn.functional.mse_loss(pred_dens_n, density_n).item()
+        
+        mux = x.mean()
+        muy = y.mean()
+        dx = x-mux
+        dy = y-muy
+        normed_correlation = torch.sum(dx*dy) / torch.sqrt(dx.pow(2).sum() * dy.pow(2).sum())
+    return {
+        'volumetric_loss': density_loss, 
+        'scaled_volumetric_loss': scaled_density_loss,
+        'normed_correlation': normed_correlation.item()
+        }
+
+def streaming_eval(
+        obj, vol, xpos, ypos, zpos, block_slices: int, out_dir: Path, grid_fast_path: bool = True,
+        timer: Optional[PhaseTimer] = None
+) -> dict:
+    # same metrics as dense_eval, accumulated over blocks of x-slices
+    timer = timer if timer is not None else PhaseTimer()
+    ny, nz = len(ypos), len(zpos)
+    mid = nz//2
+    stats = RunningStats()
+    obj_slice = np.empty((len(xpos), ny))
+    ref_slice = np.empty((len(xpos), ny))
+    with torch.no_grad():
+        i0 = 0
+        blocks = zip(
+            density_blocks(obj, xpos, ypos, zpos, block_slices, grid_fast_path),
+            density_blocks(vol, xpos, ypos, zpos, block_slices, grid_fast_path)
+        )
+        while True:
+            # the blocks are resampled lazily, so time fetching the next pair separately
+            with timer.span('density'):
+                pair = next(blocks, None)
+            if pair is None:
+                break
+            density, ref_density = pair
+            with timer.span('metrics'):
+                stats.update(density, ref_density)
+                obj_slice[i0:i0+len(density)] = density[:,:,mid].cpu().numpy()
+                ref_slice[i0:i0+len(density)] = ref_density[:,:,mid].cpu().numpy()
+            i0 += len(density)
+    with timer.span('plot'):
+        std_x, std_y = stats.std()
+        diff_slice = (obj_slice - stats.mean_x) / std_x - (ref_slice - stats.mean_y) / std_y
+        plot_slices(ref_slice, obj_slice, diff_slice, out_dir)
+    return stats.metrics()
+
+def sampled_eval(
+        obj,
+        vol,
+        bounds: List[Tuple[float, float]],
+        n_samples: int,
+        sampling: Literal['random', 'stratified'] = 'stratified',
+        time_budget: Optional[float] = None,
+        n_bootstrap: int = 200,
+        confidence: float = 0.95,
+        batch_size: int = 1<<18,
+        seed: Optional[int] = None,
+        timer: Optional[PhaseTimer] = None
+) -> dict:
+    # Monte-Carlo estimate of the metrics from n_samples points in bounds. With a time_budget
+    # (in seconds) evaluation stops after the batch that exceeds it, using fewer points.
+    timer = timer if timer is not None else PhaseTimer()
+    rng = np.random.default_rng(seed)
+    with timer.span('sample'):
+        points = sample_points(n_samples, bounds, sampling, rng)
+        if time_budget is None:
+            # z-sorted batches each touch a thin slab of a (memory-mapped) voxel grid, so the
+            # volume is read about once; with a time budget the random order is kept so that
+            # stopping early still leaves an unbiased sample
+            points = points[np.argsort(points[:, 2], kind='stable')]
+    xs, ys = [], []
+    tic = time.perf_counter()
+    with torch.no_grad():
+        for i0 in range(0, n_samples, batch_size):
+            with timer.span('density'):
+                pos = torch.from_numpy(points[i0:i0+batch_size]).float()
+                xs.append(obj.density(pos).flatten().cpu().numpy())
+                ys.append(vol.density(pos).flatten().cpu().numpy())
+            if time_budget is not None and time.perf_counter() - tic > time_budget:
+                break
+    with timer.span('metrics'):
+        x = np.concatenate(xs)
+        y = np.concatenate(ys)
+        loss_dict = RunningStats().update(x, y).metrics()
+    with timer.span('bootstrap'):
+        for k, ci in bootstrap_metrics(x, y, n_bootstrap, confidence, rng).items():
+            loss_dict[f'{k}_ci'] = ci
+    loss_dict['n_samples'] = len(x)
+    loss_dict['confidence'] = confidence
+    return loss_dict
+
+def eval_grid(
+        eval_resolution: int,
+        extent: Optional[List[Tuple[float, float]]] = None
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    pos = torch.linspace(-1, 1, eval_resolution)
+    if extent is not None:
+        assert len(extent) == 3
+        xpos = torch.linspace(extent[0][0], extent[0][1], eval_resolution)
+        ypos = torch.linspace(extent[1][0], extent[1][1], eval_resolution)
+        zpos = torch.linspace(extent[2][0], extent[2][1], eval_resolution)
+    else:
+        xpos = pos
+        ypos = pos
+        zpos = pos
+    return xpos, ypos, zpos
+
+def evaluate(
+        obj,
+        vol,
+        grid,
+        out_dir: Path,
+        block_slices: Optional[int] = None,
+        grid_fast_path: bool = True,
+        timer: Optional[PhaseTimer] = None
+) -> dict:
+    xpos, ypos, zpos = grid
+    if block_slices is None and grid_fast_path and as_grid(obj) is not None and as_grid(vol) is not None:
+        # two voxel grids on an axis-aligned grid: resample block-wise instead of the dense path
+        block_slices = 16
+    elif block_slices is None and (isinstance(obj, LazyVoxelGrid) or isinstance(vol, LazyVoxelGrid)):
+        # a single dense query would read the bounding box of the whole grid from a memory-mapped
+        # volume and convert it to float64; blocks of x-slices only touch a thin box each
+        block_slices = 16
+    if block_slices is not None:
+        return streaming_eval(obj, vol, xpos, ypos, zpos, block_slices, out_dir, grid_fast_path, timer)
+    return dense_eval(obj, vol, xpos, ypos, zpos, out_dir, timer)
+# %%
 def main(
     obj_path: Path, 
     ref_path: Path, 
@@ -59,69 +249,66 @@ def main(
     ref_resolution: Optional[Tuple[int, int, int]] = None,
     ref_dtype: Optional[DTYPES] = None,
     extent: Optional[List[Tuple[float, float]]] = None,
+    obj_level: int = 0,
+    ref_level: int = 0,
+    block_slices: Optional[int] = None,
+    n_samples: Optional[int] = None,
+    sampling: Literal['random', 'stratified'] = 'stratified',
+    sample_time_budget: Optional[float] = None,
+    n_bootstrap: int = 200,
+    seed: Optional[int] = None,
+    grid_fast_path: bool = True,
+    align: bool = False,
+    align_resolution: int = 64,
+    align_max_rotation: float = 0.0,
+    align_rotation_step: float = 1.0,
 ):
-    print(f'Loading object from {obj_path}')
-    obj = load_obj(obj_path, obj_resolution, obj_dtype)
+    """Compare obj against ref on an eval_resolution^3 grid.
 
-    print(f'Loading reference object from {ref_path}')
-    vol = load_obj(ref_path, ref_resolution, ref_dtype)
+    If block_slices is given, the grid is evaluated block_slices x-slices at a time and
+    the metrics are accumulated in one pass, so memory does not grow with eval_resolution.
+    If n_samples is given, the metrics are instead estimated from n_samples random or
+    stratified points in the extent, with bootstrap confidence intervals.
+    Voxel volumes are resampled separably on the axis-aligned grid unless grid_fast_path
+    is disabled; when both inputs are voxel volumes this implies block-wise evaluation.
+    With align, obj is first rigidly registered onto ref (translation, plus rotations up to
+    align_max_rotation degrees) and the transform is stored in eval_loss.json.
+    Wall time and peak memory per phase are written to eval_loss_timings.json/csv.
+    """
+    timer = PhaseTimer()
+    with timer.span('load'):
+        print(f'Loading object from {obj_path}')
+        obj = load_obj(obj_path, obj_resolution, obj_dtype, obj_level)
+
+        print(f'Loading reference object from {ref_path}')
+        vol = load_obj(ref_path, ref_resolution, ref_dtype, ref_level)
 
     if out_dir is None:
         out_dir = obj_path.parent
 
-    pos = torch.linspace(-1, 1, eval_resolution)
-    if extent is not None:
-        assert len(extent) == 3
-        xpos = torch.linspace(extent[0][0], extent[0][1], eval_resolution)
-        ypos = torch.linspace(extent[1][0], extent[1][1], eval_resolution)
-        zpos = torch.linspace(extent[2][0], extent[2][1], eval_resolution)
+    bounds = extent if extent is not None else [(-1, 1)]*3
+    transform = None
+    if align:
+        with timer.span('align'):
+            transform = find_alignment(obj, vol, bounds, align_resolution, align_max_rotation, align_rotation_step)
+            print(f'Alignment: {transform.to_dict()}')
+            obj = apply_alignment(obj, transform)
+    if n_samples is not None:
+        loss_dict = sampled_eval(
+            obj, vol, bounds, n_samples, sampling, sample_time_budget, n_bootstrap, seed=seed, timer=timer
+        )
     else:
-        xpos = pos
-        ypos = pos
-        zpos = pos
-    pos = torch.stack(torch.meshgrid(xpos, ypos, zpos, indexing='ij'), dim=-1)
-    density = obj.density(pos.view(-1, 3)).view(eval_resolution, eval_resolution, eval_resolution)
-    ref_density = vol.density(pos.view(-1, 3)).view(eval_resolution, eval_resolution, eval_resolution)
-    # normalise to zero mean and unit variance
-    density_n = density - density.mean()
-    density_n = density_n / density_n.std()
-    pred_density_n = ref_density - ref_density.mean()
-    pred_density_n = pred_density_n / pred_density_n.std()
-    
-    # plot slices as sanity check
-    fig, axs = plt.subplots(1, 3, figsize=(12, 4))
-    axs[0].imshow(ref_density[:,:,eval_resolution//2])
-    axs[0].set_title('Target')
-    axs[1].imshow(density[:,:,eval_resolution//2].cpu().numpy())
-    axs[1].set_title('Reconstruction')
-    axs[2].imshow(((density_n-pred_density_n)[:,:,eval_resolution//2].cpu().numpy()), cmap='bwr')
-    axs[2].set_title('Difference')
-    plt.savefig(out_dir/'slices_eval.png')
-    plt.close()
-
-    y = ref_density.flatten()
-    x = density.flatten()
-
-    density_loss = torch.nn.functional.mse_loss(y, x).item()
-
-    density_n = (x - x.min()) / (x.max() - x.min())
-    pred_dens_n = (y - y.min()) / (y.max() - y.min())
-    scaled_density_loss = torch.nn.functional.mse_loss(pred_dens_n, density_n).item()
-    
-    mux = x.mean()
-    muy = y.mean()
-    dx = x-mux
-    dy = y-muy
-    normed_correlation = torch.sum(dx*dy) / torch.sqrt(dx.pow(2).sum() * dy.pow(2).sum())
-    loss_dict = {
-        'volumetric_loss': density_loss, 
-        'scaled_volumetric_loss': scaled_density_loss,
-        'normed_correlation': normed_correlation.item()
-        }
+        with timer.span('grid'):
+            grid = eval_grid(eval_resolution, extent)
+        loss_dict = evaluate(obj, vol, grid, out_dir, block_slices, grid_fast_path, timer)
+    if transform is not None:
+        loss_dict['alignment'] = transform.to_dict()
     print(loss_dict)
     # save to file
     print(f'Saving loss to {out_dir/"eval_loss.json"}')
     (out_dir/'eval_loss.json').write_text(json.dumps(loss_dict, indent=2))
+    timer.summary()
+    timer.save(out_dir/'eval_loss_timings')
 # %%
 if __name__=='__main__':
     tyro.cli(main)
\ No newline at end of file
@@ -0,0 +1,226 @@
+from pathlib import Path
+import numpy as np
+from dataclasses import dataclass
+from typing import Iterable, Optional, Union
+import json
+import os
+
+# Columnar companion index of a nerfstudio-style transforms JSON, stored next to it as
+# <name>.index.npz. It holds
+#   poses        - (N, 4, 4) float64 transform matrices
+#   time         - (N,) float64 frame times (nan where a frame has none)
+#   file_path    - (N,) str, as in the JSON
+#   stem         - (N,) str, file name without suffix
+#   split        - (N,) str, 'train', 'eval' or '' from the stem
+#   frame_number - (N,) int64 trailing number of the stem (stem.split('_')[-1]), -1 if none
+#   meta         - JSON of all top-level keys except frames (fl_x, w, h, ...)
+#   source       - size and mtime_ns of the JSON the index was built from
+# so frames can be selected and their poses read without parsing the JSON again. An index
+# whose source does not match the JSON anymore is rebuilt on load.
+
+VERSION = 1
+SPLITS = ('train', 'eval')
+
+def index_path(jsonfile: Path) -> Path:
+    jsonfile = Path(jsonfile)
+    return jsonfile.with_name(jsonfile.stem + '.index.npz')
+
+def _fingerprint(jsonfile: Path) -> np.ndarray:
+    st = Path(jsonfile).stat()
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+def _split(stem: str) -> str:
+    for split in SPLITS:
+        if split in stem:
+            return split
+    return ''
+
+def _frame_number(stem: str) -> int:
+    try:
+        return int(stem.split('_')[-1])
+    except ValueError:
+        return -1
+
+class FrameIndex:
+    def __init__(
+            self,
+            poses: np.ndarray,
+            time: np.ndarray,
+            file_path: np.ndarray,
+            stem: np.ndarray,
+            split: np.ndarray,
+            frame_number: np.ndarray,
+            meta: dict
+    ) -> None:
+        self.poses = poses
+        self.time = time
+        self.file_path = file_path
+        self.stem = stem
+        self.split = split
+        self.frame_number = frame_number
+        self.meta = meta
+
+    def __len__(self) -> int:
+        return len(self.file_path)
+
+    @classmethod
+    def from_frames(cls, meta: dict, frames: Iterable[dict]) -> 'FrameIndex':
+        builder = FrameIndexBuilder()
+        for frame in frames:
+            builder.add(frame)
+        return builder.build(meta)
+
+    @classmethod
+    def from_json(cls, jsonfile: Path) -> 'FrameIndex':
+        meta = json.loads(Path(jsonfile).read_text())
+        return cls.from_frames(meta, meta.get('frames', []))
+
+    def save(self, path: Path, source: np.ndarray):
+        # write-then-rename, so concurrent readers never see a partial index
+        path = Path(path)
+        tmp = path.with_name(path.name + f'.{os.getpid()}.tmp.npz')
+        np.savez(
+            tmp,
+            version=np.array(VERSION),
+            source=source,
+            poses=self.poses,
+            time=self.time,
+            file_path=self.file_path,
+            stem=self.stem,
+            split=self.split,
+            frame_number=self.frame_number,
+            meta=np.array(json.dumps(self.meta)),
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path) -> 'FrameIndex':
+        with np.load(path) as data:
+            return cls(
+                poses=data['poses'],
+                time=data['time'],
+                file_path=data['file_path'],
+                stem=data['stem'],
+                split=data['split'],
+                frame_number=data['frame_number'],
+                meta=json.loads(str(data['meta']))
+            )
+
+    def take(self, indices) -> 'FrameIndex':
+        # view of the frames at indices (integer array or boolean mask)
+        return FrameIndex(
+            self.poses[indices],
+            self.time[indices],
+            self.file_path[indices],
+            self.stem[indices],
+            self.split[indices],
+            self.frame_number[indices],
+            self.meta
+        )
+
+    def select(
+            self,
+            split: Optional[str] = None,
+            imin: Optional[int] = None,
+            imax: Optional[int] = None,
+            istep: int = 1
+    ) -> 'FrameIndex':
+        # frames of a split with imin <= frame_number <= imax and (frame_number - imin) % istep == 0
+        mask = np.ones(len(self), dtype=bool)
+        if split is not None:
+            mask &= self.split == split
+        if imin is not None:
+            mask &= self.frame_number >= imin
+        if imax is not None:
+            mask &= self.frame_number <= imax
+        if istep != 1:
+            mask &= (self.frame_number - (imin or 0)) % istep == 0
+        return self.take(mask)
+
+    def sorted(self) -> 'FrameIndex':
+        # sorted by file path
+        return self.take(np.argsort(self.file_path))
+
+    def frames(self):
+        # frames as dicts, for code that expects the JSON layout
+        for i in range(len(self)):
+            frame = {'file_path': str(self.file_path[i]), 'transform_matrix': self.poses[i].tolist()}
+            if not np.isnan(self.time[i]):
+                frame['time'] = float(self.time[i])
+            yield frame
+
+class FrameIndexBuilder:
+    # collects the index columns of frames one at a time, e.g. while they are streamed to a
+    # JSON file, without keeping the frame dicts
+    def __init__(self) -> None:
+        self.poses = []
+        self.time = []
+        self.file_path = []
+
+    def add(self, frame: dict):
+        self.poses.append(np.asarray(frame['transform_matrix'], dtype=np.float64))
+        self.time.append(frame.get('time', np.nan))
+        self.file_path.append(Path(frame['file_path']).as_posix())
+
+    def build(self, meta: dict) -> FrameIndex:
+        stem = [Path(fp).stem for fp in self.file_path]
+        return FrameIndex(
+            poses=np.stack(self.poses) if self.poses else np.zeros((0, 4, 4)),
+            time=np.array(self.time, dtype=np.float64),
+            file_path=np.array(self.file_path, dtype=str),
+            stem=np.array(stem, dtype=str),
+            split=np.array([_split(s) for s in stem], dtype=str),
+            frame_number=np.array([_frame_number(s) for s in stem], dtype=np.int64),
+            meta={k: v for k, v in meta.items() if k != 'frames'}
+        )
+
+def write_index(jsonfile: Path, index: FrameIndex) -> Path:
+    # store index as the companion of jsonfile, which must already be written
+    path = index_path(jsonfile)
+    index.save(path, _fingerprint(jsonfile))
+    return path
+
+def load_index(jsonfile: Path, rebuild: bool = False) -> FrameIndex:
+    # companion index of jsonfile, built (and stored if possible) when missing or stale
+    jsonfile = Path(jsonfile)
+    path = index_path(jsonfile)
+    source = _fingerprint(jsonfile)
+    if not rebuild and path.exists():
+        try:
+            with np.load(path) as data:
+                current = int(data['version']) == VERSION and np.array_equal(data['source'], source)
+            if current:
+                return FrameIndex.load(path)
+        except (OSError, ValueError, KeyError):
+            pass
+    index = FrameIndex.from_json(jsonfile)
+    try:
+        index.save(path, source)
+    except OSError as e:
+        print(f'Could not store frame index {path}: {e}')
+    return index
+
+@dataclass
+class FrameFilter:
+    # frame selection of astra_recon; usable as a stem predicate and as a vectorised index query
+    split: Optional[str] = 'train'
+    imin: int = 0
+    imax: int = 1 << 26
+    istep: int = 1
+
+    def __call__(self, stem: str) -> bool:
+        if self.split is not None and self.split not in stem:
+            return False
+        i = int(stem.split("_")[-1])
+        return i >= self.imin and i <= self.imax and (i - self.imin) % self.istep == 0
+
+    def apply(self, index: FrameIndex) -> FrameIndex:
+        return index.select(self.split, self.imin, self.imax, self.istep)
+
+def filter_frames(index: FrameIndex, filter_name: Union[FrameFilter, callable]) -> FrameIndex:
+    # frames passing filter_name, sorted by file path
+    if hasattr(filter_name, 'apply'):
+        view = filter_name.apply(index)
+    else:
+        view = index.take(np.array([bool(filter_name(s)) for s in index.stem], dtype=bool))
+    return view.sorted()
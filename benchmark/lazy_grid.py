@@ -0,0 +1,192 @@
+from typing import Optional, Tuple
+import numpy as np
+import torch
+try:
+    from nerf_xray.objects import VoxelGrid
+except ImportError: # the lazy grid and its resampling only need torch
+    VoxelGrid = None
+
+# Lazily evaluated voxel grid. The volume stays in its native dtype (np.memmap of a .raw file,
+# a ChunkedVolume, ...) and each density query only converts the bounding box of voxels it
+# touches to float. The interpolation reproduces nerf_xray's VoxelGrid.
+
+# (align_corners, padding) of nerf_xray's VoxelGrid.density, which samples rho with
+# torch.nn.functional.grid_sample(..., align_corners=True) and the default zeros padding
+# (nerfstudio-xray/nerf-xray/nerf_xray/objects.py)
+VOXELGRID_CONVENTION = (True, 'zeros')
+# most voxels a density query converts to float at a time (32 MB of float64)
+SLAB_VOXELS = 1 << 22
+
+def index_coords(pos: torch.Tensor, shape: Tuple[int, int, int], align_corners: bool) -> torch.Tensor:
+    # positions (N, 3) in XYZ within [-1, 1] to fractional voxel indices (N, 3) in ZYX
+    n = torch.tensor(shape[::-1], dtype=torch.float64)
+    pos = pos.to(torch.float64)
+    if align_corners:
+        idx = (pos + 1) / 2 * (n - 1)
+    else:
+        idx = ((pos + 1) * n - 1) / 2
+    return idx.flip(-1)
+
+def trilinear(
+        vol,
+        idx: torch.Tensor,
+        padding: str = 'zeros'
+) -> torch.Tensor:
+    # trilinear interpolation of vol (ZYX, anything supporting basic slicing) at fractional
+    # indices idx (N, 3) in ZYX; only vol[bounding box of idx] is read and converted to float
+    shape = torch.tensor(vol.shape)
+    if padding == 'border':
+        idx = torch.minimum(idx.clamp(min=0), (shape - 1).to(idx.dtype))
+    i0 = torch.floor(idx).long()
+    w = idx - i0
+    if len(idx) == 0:
+        return torch.zeros(0, dtype=torch.float64)
+    lo = torch.minimum(i0.min(0).values.clamp(min=0), shape - 1)
+    hi = torch.maximum(torch.minimum(i0.max(0).values + 2, shape), lo + 1)
+    box = tuple(slice(int(a), int(b)) for a, b in zip(lo, hi))
+    sub = torch.from_numpy(np.asarray(vol[box], dtype=np.float64))
+    out = torch.zeros(len(idx), dtype=torch.float64)
+    for corner in range(8):
+        offset = torch.tensor([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1])
+        ci = i0 + offset
+        weight = torch.where(offset.bool(), w, 1 - w).prod(-1)
+        valid = ((ci >= 0) & (ci < shape)).all(-1)
+        ci = torch.minimum(torch.maximum(ci - lo, torch.zeros_like(ci)), hi - lo - 1)
+        values = sub[ci[:, 0], ci[:, 1], ci[:, 2]]
+        out += torch.where(valid, weight * values, torch.zeros_like(values))
+    return out
+
+def trilinear_slabs(
+        vol,
+        idx: torch.Tensor,
+        padding: str = 'zeros',
+        max_voxels: int = SLAB_VOXELS
+) -> torch.Tensor:
+    # trilinear on the points grouped into z-slabs of at most max_voxels voxels, so that points
+    # spread over the whole volume never convert more than one slab (plus a plane) at a time
+    nz = vol.shape[0]
+    slab = max(1, max_voxels // (vol.shape[1] * vol.shape[2]))
+    if len(idx) == 0 or slab >= nz:
+        return trilinear(vol, idx, padding)
+    zbin = torch.floor(idx[:, 0]).long().clamp(0, nz - 1) // slab
+    order = torch.argsort(zbin, stable=True)
+    _, counts = torch.unique_consecutive(zbin[order], return_counts=True)
+    out = torch.empty(len(idx), dtype=torch.float64)
+    for sel in torch.split(order, counts.tolist()):
+        out[sel] = trilinear(vol, idx[sel], padding)
+    return out
+
+class LazyVoxelGrid:
+    def __init__(
+            self,
+            vol,
+            align_corners: bool,
+            padding: str,
+            dtype: torch.dtype = torch.float64,
+            offset: Tuple[float, float, float] = (0.0, 0.0, 0.0)
+    ) -> None:
+        # vol in ZYX order, as passed to VoxelGrid; offset (XYZ) is added to every query position
+        self.rho = vol
+        self.align_corners = align_corners
+        self.padding = padding
+        self.dtype = dtype
+        self.offset = tuple(float(o) for o in offset)
+
+    def shifted(self, translation) -> 'LazyVoxelGrid':
+        offset = tuple(o + float(t) for o, t in zip(self.offset, translation))
+        return LazyVoxelGrid(self.rho, self.align_corners, self.padding, self.dtype, offset)
+
+    def density(self, pos: torch.Tensor) -> torch.Tensor:
+        shape = pos.shape[:-1]
+        pos = pos.reshape(-1, 3).cpu().to(torch.float64) + torch.tensor(self.offset, dtype=torch.float64)
+        idx = index_coords(pos, tuple(self.rho.shape), self.align_corners)
+        out = trilinear_slabs(self.rho, idx, self.padding)
+        return out.to(self.dtype).view(shape).to(pos.device)
+
+def lazy_voxel_grid(vol) -> LazyVoxelGrid:
+    # LazyVoxelGrid interpolating vol (ZYX) as nerf_xray's VoxelGrid would
+    return LazyVoxelGrid(vol, *VOXELGRID_CONVENTION)
+
+def axis_weights(pos: torch.Tensor, n: int, align_corners: bool, padding: str):
+    # 1D linear interpolation along one axis of length n at positions pos in [-1, 1]:
+    # lower/upper voxel indices and their weights (zero for voxels outside the volume)
+    pos = pos.to(torch.float64)
+    if align_corners:
+        idx = (pos + 1) / 2 * (n - 1)
+    else:
+        idx = ((pos + 1) * n - 1) / 2
+    if padding == 'border':
+        idx = idx.clamp(0, n - 1)
+    # snap positions within float32 rounding of a voxel onto it, so that matching
+    # resolutions reduce to a copy
+    idx = torch.where((idx - idx.round()).abs() < 1e-4, idx.round(), idx)
+    i0 = torch.floor(idx).long()
+    w = idx - i0
+    i1 = i0 + 1
+    w0 = (1 - w) * ((i0 >= 0) & (i0 < n))
+    w1 = w * ((i1 >= 0) & (i1 < n))
+    return i0.clamp(0, n - 1), i1.clamp(0, n - 1), w0, w1
+
+def _interp_axis(a: torch.Tensor, axis: int, weights, offset: int) -> torch.Tensor:
+    i0, i1, w0, w1 = weights
+    shape = [1]*a.ndim
+    shape[axis] = -1
+    if torch.all(w1 == 0):
+        if torch.all(w0 == 1) and torch.equal(i0 - offset, torch.arange(a.shape[axis])):
+            # positions fall exactly on the voxels: plain copy
+            return a
+        return a.index_select(axis, i0 - offset) * w0.view(shape)
+    return a.index_select(axis, i0 - offset) * w0.view(shape) + a.index_select(axis, i1 - offset) * w1.view(shape)
+
+def grid_blocks(grid: LazyVoxelGrid, xpos: torch.Tensor, ypos: torch.Tensor, zpos: torch.Tensor, block_slices: int):
+    # density of grid on the axis-aligned grid xpos x ypos x zpos (indexing 'ij'), yielded in
+    # blocks of block_slices x-slices. Trilinear interpolation is separable on such grids, so
+    # each block is resampled one axis at a time without building the coordinate grid.
+    nz, ny, nx = grid.rho.shape
+    ox, oy, oz = grid.offset
+    wz = axis_weights(zpos.to(torch.float64) + oz, nz, grid.align_corners, grid.padding)
+    wy = axis_weights(ypos.to(torch.float64) + oy, ny, grid.align_corners, grid.padding)
+    wx = axis_weights(xpos.to(torch.float64) + ox, nx, grid.align_corners, grid.padding)
+    z0, z1 = int(wz[0].min()), int(wz[1].max()) + 1
+    y0, y1 = int(wy[0].min()), int(wy[1].max()) + 1
+    for i0 in range(0, len(xpos), block_slices):
+        bx = tuple(t[i0:i0+block_slices] for t in wx)
+        x0, x1 = int(bx[0].min()), int(bx[1].max()) + 1
+        sub = torch.from_numpy(np.asarray(grid.rho[z0:z1, y0:y1, x0:x1], dtype=np.float64))
+        sub = _interp_axis(sub, 2, bx, x0)
+        sub = _interp_axis(sub, 1, wy, y0)
+        sub = _interp_axis(sub, 0, wz, z0)
+        yield sub.permute(2, 1, 0).to(grid.dtype)
+
+def as_grid(obj) -> Optional[LazyVoxelGrid]:
+    # LazyVoxelGrid view of obj for the grid-aligned fast path, or None if obj is not a plain
+    # voxel grid. A VoxelGrid is only accepted if it agrees with the view on a spot check.
+    if isinstance(obj, LazyVoxelGrid):
+        return obj
+    if VoxelGrid is None or not isinstance(obj, VoxelGrid) or not isinstance(getattr(obj, 'rho', None), torch.Tensor):
+        return None
+    if obj.rho.ndim != 3:
+        return None
+    grid = LazyVoxelGrid(obj.rho.detach().cpu(), *VOXELGRID_CONVENTION)
+    pos = torch.rand(256, 3, generator=torch.Generator().manual_seed(1)) * 2.2 - 1.1
+    try:
+        ref = obj.density(pos).detach().to(torch.float64).flatten()
+    except Exception:
+        return None
+    out = grid.density(pos).flatten()
+    if out.shape != ref.shape or not torch.allclose(out, ref, rtol=1e-4, atol=1e-5 * float(ref.abs().max() + 1)):
+        return None
+    return grid
+
+def density_blocks(obj, xpos, ypos, zpos, block_slices: int, grid_fast_path: bool = True):
+    # density on the grid in blocks of block_slices x-slices; voxel grids are resampled
+    # directly (grid_blocks), anything else is queried at explicit positions
+    grid = as_grid(obj) if grid_fast_path else None
+    if grid is not None:
+        yield from grid_blocks(grid, xpos, ypos, zpos, block_slices)
+        return
+    ny, nz = len(ypos), len(zpos)
+    for i0 in range(0, len(xpos), block_slices):
+        xs = xpos[i0:i0+block_slices]
+        pos = torch.stack(torch.meshgrid(xs, ypos, zpos, indexing='ij'), dim=-1)
+        yield obj.density(pos.view(-1, 3)).view(len(xs), ny, nz)
@@ -0,0 +1,138 @@
+import numpy as np
+import torch
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+# One-pass volume comparison metrics. RunningStats accumulates count, means, centred second
+# moments, co-moment and extrema of a pair (x, y) block by block, merging blocks with the
+# pairwise update of Chan et al., so the metrics of eval_loss can be computed without holding
+# the full volumes in memory. Accumulation is done in float64.
+
+Array = Union[np.ndarray, torch.Tensor]
+
+def _to_numpy(a: Array) -> np.ndarray:
+    if isinstance(a, torch.Tensor):
+        a = a.detach().cpu().numpy()
+    return np.asarray(a, dtype=np.float64).ravel()
+
+class RunningStats:
+    def __init__(self) -> None:
+        self.n = 0
+        self.mean_x = 0.0
+        self.mean_y = 0.0
+        self.m2_x = 0.0
+        self.m2_y = 0.0
+        self.c_xy = 0.0
+        self.min_x = np.inf
+        self.max_x = -np.inf
+        self.min_y = np.inf
+        self.max_y = -np.inf
+
+    def update(self, x: Array, y: Array) -> 'RunningStats':
+        x = _to_numpy(x)
+        y = _to_numpy(y)
+        assert x.shape == y.shape, f'Shape mismatch {x.shape} vs {y.shape}'
+        if x.size == 0:
+            return self
+        block = RunningStats()
+        block.n = x.size
+        block.mean_x = x.mean()
+        block.mean_y = y.mean()
+        dx = x - block.mean_x
+        dy = y - block.mean_y
+        block.m2_x = np.dot(dx, dx)
+        block.m2_y = np.dot(dy, dy)
+        block.c_xy = np.dot(dx, dy)
+        block.min_x, block.max_x = x.min(), x.max()
+        block.min_y, block.max_y = y.min(), y.max()
+        return self.merge(block)
+
+    def merge(self, other: 'RunningStats') -> 'RunningStats':
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        f = self.n * other.n / n
+        delta_x = other.mean_x - self.mean_x
+        delta_y = other.mean_y - self.mean_y
+        self.m2_x += other.m2_x + delta_x*delta_x*f
+        self.m2_y += other.m2_y + delta_y*delta_y*f
+        self.c_xy += other.c_xy + delta_x*delta_y*f
+        self.mean_x += delta_x * other.n / n
+        self.mean_y += delta_y * other.n / n
+        self.n = n
+        self.min_x = min(self.min_x, other.min_x)
+        self.max_x = max(self.max_x, other.max_x)
+        self.min_y = min(self.min_y, other.min_y)
+        self.max_y = max(self.max_y, other.max_y)
+        return self
+
+    def var(self, ddof: int = 0):
+        return self.m2_x / (self.n - ddof), self.m2_y / (self.n - ddof)
+
+    def std(self, ddof: int = 1):
+        # unbiased by default, like torch.std
+        vx, vy = self.var(ddof)
+        return np.sqrt(vx), np.sqrt(vy)
+
+    def mse(self) -> float:
+        # mean((y - x)^2) = var(x) + var(y) - 2 cov(x, y) + (mean(y) - mean(x))^2
+        d = self.mean_y - self.mean_x
+        return (self.m2_x + self.m2_y - 2*self.c_xy) / self.n + d*d
+
+    def scaled_mse(self) -> float:
+        # mse after min-max scaling both x and y to [0, 1]
+        rx = self.max_x - self.min_x
+        ry = self.max_y - self.min_y
+        d = (self.mean_y - self.min_y) / ry - (self.mean_x - self.min_x) / rx
+        return (self.m2_x/rx**2 + self.m2_y/ry**2 - 2*self.c_xy/(rx*ry)) / self.n + d*d
+
+    def normed_correlation(self) -> float:
+        return self.c_xy / np.sqrt(self.m2_x * self.m2_y)
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            'volumetric_loss': float(self.mse()),
+            'scaled_volumetric_loss': float(self.scaled_mse()),
+            'normed_correlation': float(self.normed_correlation()),
+        }
+
+def bootstrap_metrics(
+        x: Array,
+        y: Array,
+        n_bootstrap: int = 200,
+        confidence: float = 0.95,
+        seed: Optional[int] = None
+) -> Dict[str, Tuple[float, float]]:
+    # percentile bootstrap confidence intervals of RunningStats.metrics for paired samples x, y
+    x = _to_numpy(x)
+    y = _to_numpy(y)
+    rng = np.random.default_rng(seed)
+    samples = {}
+    for _ in range(n_bootstrap):
+        idx = rng.integers(0, x.size, x.size)
+        for k, v in RunningStats().update(x[idx], y[idx]).metrics().items():
+            samples.setdefault(k, []).append(v)
+    alpha = (1 - confidence) / 2
+    return {k: (float(np.quantile(v, alpha)), float(np.quantile(v, 1 - alpha))) for k, v in samples.items()}
+
+def sample_points(
+        n: int,
+        bounds: Sequence[Tuple[float, float]],
+        strategy: str = 'stratified',
+        rng: Optional[np.random.Generator] = None
+) -> np.ndarray:
+    # n points (n, 3) in the box bounds, either uniform random or jittered stratified: one
+    # point per cell of a k^3 grid, k = floor(n^(1/3)), with the remaining points uniform random.
+    # Points come in random order, so any prefix is itself an unbiased sample.
+    rng = np.random.default_rng() if rng is None else rng
+    lo = np.array([b[0] for b in bounds], dtype=np.float64)
+    hi = np.array([b[1] for b in bounds], dtype=np.float64)
+    if strategy == 'random':
+        u = rng.random((n, 3))
+    elif strategy == 'stratified':
+        k = int(np.floor(n ** (1/3) + 1e-9))
+        cells = np.stack(np.meshgrid(*[np.arange(k)]*3, indexing='ij'), axis=-1).reshape(-1, 3)
+        u = np.concatenate([(cells + rng.random(cells.shape)) / k, rng.random((n - len(cells), 3))])
+        u = u[rng.permutation(n)]
+    else:
+        raise ValueError(f'Invalid sampling strategy {strategy}')
+    return lo + u * (hi - lo)
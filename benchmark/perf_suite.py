@@ -0,0 +1,326 @@
+# %%
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from datetime import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import cv2 as cv
+import torch
+import tyro
+
+import astra_recon
+import projection_pyramid
+import volume_io
+from frame_index import FrameFilter, load_index
+from sphere_gui import detect_circles, to_uint8
+from utils import PhaseTimer, PrintTableMetrics, peak_rss, RSS_KIND
+
+# Speed benchmarks of our own code paths on procedural data, so no renderer or GPU is needed.
+# A random sphere phantom is voxelized and projected analytically (cone beam, source on a
+# circle of radius R in the z=0 plane as astra_recon.projection_geometry assumes) into a PNG
+# dataset with transforms_00.json in a temporary directory. Every case is run once to warm up
+# and then repeats times; the median wall time is what runs are compared on. Results are
+# written as JSON together with the machine they ran on; given a baseline JSON from an
+# earlier run, cases whose median grew by more than tolerance are flagged as regressions.
+# The eval cases need nerf_xray and are skipped where it is not installed.
+
+FORMAT = 'perf-suite'
+VERSION = 1
+
+def random_spheres(n: int, rng: np.random.Generator) -> np.ndarray:
+    # (n, 5) rows of centre xyz, radius and density in normalized [-1, 1] coordinates
+    centers = rng.uniform(-0.6, 0.6, (n, 3))
+    radii = rng.uniform(0.08, 0.25, (n, 1))
+    density = rng.uniform(0.5, 1.0, (n, 1))
+    return np.concatenate([centers, radii, density], axis=1)
+
+def voxelize(spheres: np.ndarray, resolution: int) -> np.ndarray:
+    # float32 (x, y, z) volume sampled at voxel centres
+    x = (np.arange(resolution) + 0.5) / resolution * 2 - 1
+    vol = np.zeros((resolution,)*3, dtype=np.float32)
+    for cx, cy, cz, r, rho in spheres:
+        d2 = (x[:, None, None] - cx)**2 + (x[None, :, None] - cy)**2 + (x[None, None, :] - cz)**2
+        vol[d2 <= r*r] += rho
+    return vol
+
+def project(spheres: np.ndarray, eye: np.ndarray, size: int, fl: float, mu: float = 2.0) -> np.ndarray:
+    # uint8 transmission image 255*exp(-mu * line integral) seen from eye towards the origin
+    back = eye / np.linalg.norm(eye)
+    right = np.array([-back[1], back[0], 0.0])
+    up = np.cross(back, right)
+    u = np.arange(size) + 0.5 - size/2
+    v = size/2 - (np.arange(size) + 0.5)
+    d = -fl*back + u[None, :, None]*right + v[:, None, None]*up
+    d /= np.linalg.norm(d, axis=-1, keepdims=True)
+    line = np.zeros((size, size))
+    for cx, cy, cz, r, rho in spheres:
+        oc = np.array([cx, cy, cz]) - eye
+        b = d @ oc
+        disc = r*r - oc @ oc + b*b
+        line += rho * 2*np.sqrt(np.maximum(disc, 0))
+    return np.round(255*np.exp(-mu*line)).astype(np.uint8)
+
+def write_dataset(
+        dname: Path,
+        spheres: np.ndarray,
+        n_projections: int,
+        image_size: int,
+        R: float = 4.0
+) -> Path:
+    # PNG projections over a full turn and transforms_00.json; the frame index is built
+    # here so that it is not part of the timed loads
+    (dname/'images').mkdir(parents=True, exist_ok=True)
+    # the unit cube fills about two thirds of the detector
+    fl = image_size/2 * R / 1.5
+    frames = []
+    for i, theta in enumerate(np.linspace(0, 2*np.pi, n_projections, endpoint=False)):
+        eye = R * np.array([np.cos(theta), np.sin(theta), 0.0])
+        back = eye / R
+        right = np.array([-back[1], back[0], 0.0])
+        c2w = np.eye(4)
+        c2w[:3, 0], c2w[:3, 1], c2w[:3, 2], c2w[:3, 3] = right, np.cross(back, right), back, eye
+        file_path = f'images/train_{i:04d}.png'
+        cv.imwrite((dname/file_path).as_posix(), project(spheres, eye, image_size, fl))
+        frames.append({'file_path': file_path, 'transform_matrix': c2w.tolist()})
+    jsonfile = dname/'transforms_00.json'
+    jsonfile.write_text(json.dumps({'fl_x': fl, 'fl_y': fl, 'w': image_size, 'h': image_size, 'frames': frames}, indent=2))
+    load_index(jsonfile)
+    return jsonfile
+
+def machine_info() -> dict:
+    info = {
+        'hostname': platform.node(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'opencv': cv.__version__,
+        'torch': torch.__version__,
+        'torch_threads': torch.get_num_threads(),
+    }
+    try:
+        info['memory_gb'] = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**3
+    except (ValueError, OSError, AttributeError): # not available on Windows
+        info['memory_gb'] = None
+    try:
+        info['git_commit'] = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['git_commit'] = None
+    return info
+
+def measure(
+        fn: Callable,
+        repeats: int,
+        items: int = 1,
+        setup: Optional[Callable] = None
+) -> dict:
+    # fn may return the seconds to record (a float) instead of its wall time, e.g. to leave out
+    # plotting; any other return value is ignored. setup runs untimed before every call.
+    # rss_growth is how far the case raised the process peak RSS; as the peak never drops, a
+    # case that stays below the peak of an earlier one records 0
+    rss0 = peak_rss()
+    times = []
+    for i in range(repeats + 1):
+        if setup is not None:
+            setup()
+        tic = time.perf_counter()
+        dt = fn()
+        dt = dt if isinstance(dt, float) else time.perf_counter() - tic
+        if i > 0: # the first call is a warm-up
+            times.append(dt)
+    times = np.array(times)
+    rss = peak_rss()
+    median = float(np.median(times))
+    return {
+        'times': times.tolist(),
+        'median': median,
+        'min': float(times.min()),
+        'mean': float(times.mean()),
+        'std': float(times.std()),
+        'items': items,
+        'items_per_s': items / median if median > 0 else None,
+        'rss_growth_mb': rss - rss0 if rss is not None and rss0 is not None else None,
+        'process_peak_rss_mb': rss,
+        'rss_kind': RSS_KIND,
+    }
+
+def build_cases(
+        workdir: Path,
+        jsonfile: Path,
+        phantom: np.ndarray,
+        eval_resolutions: Tuple[int, ...],
+        seed: int
+) -> Dict[str, Tuple[Callable, int, Optional[Callable]]]:
+    # name -> (fn, items, setup)
+    cases = {}
+    n_frames = len(load_index(jsonfile))
+    train = FrameFilter(split='train')
+
+    def load(downscale, workers, downsampling='bilinear', pyramid=False):
+        return lambda: astra_recon.load_projections(
+            jsonfile, train, downscale, 1.0, workers, 'thread', pyramid, downsampling=downsampling
+        )
+    cases['load/serial'] = (load(1, 0), n_frames, None)
+    cases['load/threads'] = (load(1, -1), n_frames, None)
+    cases['load/threads_ds2'] = (load(2, -1), n_frames, None)
+    # the pyramid is built once, in the untimed setup of the first call
+    build = lambda: projection_pyramid.build_pyramid(jsonfile, max_factor=2)
+    cases['load/threads_ds2_area'] = (load(2, -1, 'area'), n_frames, None)
+    cases['load/pyramid_ds2'] = (load(2, 0, 'area', True), n_frames, build)
+
+    # a reconstruction is float32 like the phantom; its layout does not matter for timing
+    rec = phantom + np.random.default_rng(seed).normal(0, 0.05, phantom.shape).astype(np.float32)
+    out = workdir/'out'
+    out.mkdir(exist_ok=True)
+    cases['normalize_reorder'] = (lambda: np.ascontiguousarray(astra_recon.normalize_reorder(rec)), 1, None)
+    cases['save/npz'] = (lambda: astra_recon.save_volume(rec, out, save_npz=True), 1, None)
+    # out-of-core path: reconstruction memmapped as reconstruct_slabs leaves it
+    rec_mm = np.lib.format.open_memmap(workdir/'rec.npy', mode='w+', dtype=np.float32, shape=rec.shape)
+    rec_mm[:] = rec
+    rec_mm.flush()
+    cases['save/slabs'] = (lambda: astra_recon.write_volume_slabs(rec_mm, out, save_npz=False), 1, None)
+    vol = np.clip(phantom*255, 0, 255).astype(np.uint16)
+    cases['save/chunked'] = (lambda: volume_io.write_chunked(out/'vol.chunks', vol), 1, None)
+
+    # eval_loss metrics of a noisy copy against the phantom (both ZYX as eval_loss.load_obj gives).
+    # eval_loss and lazy_grid import nerf_xray, so they are only imported once an eval case runs
+    grids = {}
+    def make_grids():
+        from lazy_grid import lazy_voxel_grid
+        if not grids:
+            grids['obj'] = lazy_voxel_grid(np.ascontiguousarray(rec.swapaxes(0, 2)))
+            grids['ref'] = lazy_voxel_grid(np.ascontiguousarray(phantom.swapaxes(0, 2)))
+    def metrics(resolution, grid_fast_path):
+        def fn():
+            from eval_loss import eval_grid, evaluate
+            timer = PhaseTimer()
+            evaluate(grids['obj'], grids['ref'], eval_grid(resolution), out, None, grid_fast_path, timer)
+            # without the slice plot
+            return sum(r['total'] for name, r in timer.records.items() if name != 'plot')
+        return fn
+    for resolution in eval_resolutions:
+        cases[f'eval/stream_{resolution}'] = (metrics(resolution, True), resolution**3, make_grids)
+        # without the fast path the lazy grids are queried at explicit positions, block by block
+        cases[f'eval/points_{resolution}'] = (metrics(resolution, False), resolution**3, make_grids)
+
+    # sphere_gui detection on every z slice, at full resolution and the fast downsampled pass
+    slices = [to_uint8(vol[:, ::-1, z].T) for z in range(vol.shape[2])]
+    for scale in (1, 2):
+        cases[f'circles/scale{scale}'] = (lambda scale=scale: [detect_circles(s, scale) for s in slices], len(slices), None)
+    return cases
+
+def compare(results: dict, baseline: dict, tolerance: float) -> dict:
+    # median time relative to the baseline; beyond 1 +/- tolerance a case is flagged
+    comparison = {}
+    for name, res in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        ratio = res['median'] / base['median'] if base['median'] > 0 else float('inf')
+        status = 'ok'
+        if ratio > 1 + tolerance:
+            status = 'regression'
+        elif ratio < 1 - tolerance:
+            status = 'improvement'
+        comparison[name] = {'baseline_median': base['median'], 'ratio': ratio, 'status': status}
+    return comparison
+
+# %%
+def main(
+    out: Path = Path('perf_suite.json'),
+    baseline: Optional[Path] = None,
+    cases: Optional[List[str]] = None,
+    resolution: int = 128,
+    image_size: int = 256,
+    n_projections: int = 90,
+    n_spheres: int = 8,
+    eval_resolutions: Tuple[int, ...] = (32, 64, 128),
+    repeats: int = 3,
+    tolerance: float = 0.2,
+    seed: int = 0,
+    workdir: Optional[Path] = None,
+    fail_on_regression: bool = False,
+):
+    """Time the CPU code paths of the benchmark on a procedural sphere phantom.
+
+    The phantom volume has resolution^3 voxels and n_projections image_size^2 PNG projections,
+    generated in workdir (a temporary directory by default). cases restricts the run to cases
+    whose name starts with one of the given prefixes (load, normalize_reorder, save, eval,
+    circles). Results go to out; with a baseline JSON of an earlier run, cases slower by more
+    than tolerance (relative median) are flagged, and fail_on_regression exits with status 1.
+    """
+    rng = np.random.default_rng(seed)
+    spheres = random_spheres(n_spheres, rng)
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp) if workdir is None else Path(workdir)
+        workdir.mkdir(parents=True, exist_ok=True)
+        tic = time.perf_counter()
+        phantom = voxelize(spheres, resolution)
+        jsonfile = write_dataset(workdir/'data', spheres, n_projections, image_size)
+        print(f'Generated phantom and {n_projections} projections in {workdir} in {time.perf_counter() - tic:.2f} s')
+
+        all_cases = build_cases(workdir, jsonfile, phantom, eval_resolutions, seed)
+        selected = [name for name in all_cases if cases is None or any(name.startswith(c) for c in cases)]
+        assert len(selected) > 0, f'No cases match {cases}'
+        results = {}
+        for name in selected:
+            fn, items, setup = all_cases[name]
+            print(f'Running {name}')
+            try:
+                results[name] = measure(fn, repeats, items, setup)
+            except ModuleNotFoundError as e:
+                print(f'Skipping {name}: {e}')
+        assert len(results) > 0, 'No case could be run'
+
+    report = {
+        'format': FORMAT,
+        'version': VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'machine': machine_info(),
+        'config': {
+            'resolution': resolution, 'image_size': image_size, 'n_projections': n_projections,
+            'n_spheres': n_spheres, 'eval_resolutions': list(eval_resolutions), 'repeats': repeats, 'seed': seed,
+        },
+        'results': results,
+    }
+    if baseline is not None:
+        base = json.loads(Path(baseline).read_text())
+        if base.get('config') != report['config']:
+            print(f'Warning: baseline {baseline} was run with a different config')
+        for key in ('hostname', 'processor', 'cpu_count'):
+            if base['machine'].get(key) != report['machine'][key]:
+                print(f'Warning: baseline {key} {base["machine"].get(key)} differs from {report["machine"][key]}')
+        report['baseline'] = {'path': str(baseline), 'created': base.get('created'), 'tolerance': tolerance}
+        report['comparison'] = compare(results, base, tolerance)
+
+    comparison = report.get('comparison', {})
+    table = PrintTableMetrics(['Case', 'Median [s]', 'Min [s]', 'Items/s', 'RSS +MB', 'Ratio', 'Status'], col_width=18, timing=False)
+    for name, res in results.items():
+        row = {'Case': name, 'Median [s]': res['median'], 'Min [s]': res['min'], 'Items/s': f'{res["items_per_s"] or 0:.1f}'}
+        if res['rss_growth_mb'] is not None:
+            row['RSS +MB'] = res['rss_growth_mb']
+        if name in comparison:
+            row['Ratio'] = f'{comparison[name]["ratio"]:.2f}'
+            row['Status'] = comparison[name]['status']
+        table.update(row)
+
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2))
+    print(f'Saving results to {out}')
+    regressions = [name for name, c in comparison.items() if c['status'] == 'regression']
+    if regressions:
+        print(f'Regressions beyond {tolerance:.0%}: {", ".join(regressions)}')
+        if fail_on_regression:
+            sys.exit(1)
+# %%
+if __name__=='__main__':
+    tyro.cli(main)
@@ -0,0 +1,85 @@
+from pathlib import Path
+import numpy as np
+import matplotlib.image
+from typing import Tuple, Dict
+import threading
+import queue
+import time
+
+# Cheap progress previews for the reconstruction loop. Only the central slice(s) are pulled
+# from the solver and the PNGs are encoded on a background thread. If the writer is still busy
+# when a new preview arrives, the older pending one is dropped so the solver never waits on I/O.
+
+def central_slices(solver, axes: Tuple[str, ...] = ('z',)) -> Dict[str, np.ndarray]:
+    # Central slices in the (x, y, z) orientation produced by normalize_reorder, i.e.
+    # vol[a, b, c] = rec[c, A-1-a, b] for the (z, y, x) solver volume rec with A rows
+    nz, ny, nx = solver.vol_shape
+    slices = {}
+    for axis in axes:
+        if axis == 'z':
+            slices[axis] = solver.get_slice(0, nz//2)[::-1, :]
+        elif axis == 'x':
+            slices[axis] = solver.get_slice(1, ny - 1 - ny//2).T
+        elif axis == 'y':
+            slices[axis] = solver.get_slice(2, nx//2)[:, ::-1].T
+        else:
+            raise ValueError(f'Invalid preview axis {axis}')
+    return slices
+
+class PreviewWriter:
+    def __init__(self, output_dir: Path) -> None:
+        self.output_dir = Path(output_dir)
+        self.write_time = 0.0
+        self.written = 0
+        self.dropped = 0
+        # first exception raised while writing, re-raised by close
+        self.error = None
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def fname(self, axis: str) -> Path:
+        # the z slice keeps the historical slice.png name
+        return self.output_dir/('slice.png' if axis == 'z' else f'slice_{axis}.png')
+
+    def submit(self, slices: Dict[str, np.ndarray]):
+        try:
+            self._queue.put_nowait(slices)
+        except queue.Full:
+            # replace the pending preview with the newer one
+            try:
+                self._queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            self._queue.put_nowait(slices)
+
+    def _work(self):
+        while True:
+            slices = self._queue.get()
+            if slices is None:
+                break
+            tic = time.perf_counter()
+            try:
+                for axis, im in slices.items():
+                    matplotlib.image.imsave(self.fname(axis), np.ascontiguousarray(im))
+            except Exception as e:
+                # keep draining the queue so neither submit nor close can block on it
+                if self.error is None:
+                    print(f'Preview writing failed: {e}')
+                    self.error = e
+                continue
+            self.write_time += time.perf_counter() - tic
+            self.written += 1
+
+    def close(self):
+        # the timeout guards against a worker that died without taking the pending preview
+        while self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
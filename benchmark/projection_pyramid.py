@@ -0,0 +1,173 @@
+# %%
+from pathlib import Path
+import numpy as np
+import cv2 as cv
+import tyro
+from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from rich.progress import track
+import json
+import os
+import time
+
+import sino_cache
+from frame_index import load_index
+
+# Precomputed multi-resolution projections of a dataset. For a transforms file
+# <dir>/transforms_XX.json the pyramid lives in <dir>/transforms_XX.pyramid/:
+#   meta.json         - content key, frame file paths (row order) and the levels
+#   level_<f>.npy     - float32 (n_frames, rows, cols) projections at downscale f
+# Levels are stored for f = 1, 2, 4, ... in the form load_projections uses: attenuation
+# 1 - I/255, flipped upside down. Each level is the 2x2 area average of the previous one
+# (a trailing odd row/column is dropped, matching DetectorRowCount = int(w/f)). Levels are
+# opened with mmap, so loading a frame subset reads only those frames. load_projections reads
+# them only with downsampling='area'; its default bilinear resampling decodes the images.
+
+FORMAT = 'projection-pyramid'
+VERSION = 1
+META_FILE = 'meta.json'
+
+def pyramid_dir(jsonfile: Path) -> Path:
+    jsonfile = Path(jsonfile)
+    return jsonfile.with_name(jsonfile.stem + '.pyramid')
+
+def level_file(factor: int) -> str:
+    return f'level_{factor}.npy'
+
+def attenuation(dname: Path, filepath: Path) -> np.ndarray:
+    # full-resolution projection as in astra_recon.load_image
+    im = cv.imread((Path(dname)/filepath).as_posix(), cv.IMREAD_GRAYSCALE)
+    if im is None:
+        raise FileNotFoundError(f'Could not read {Path(dname)/filepath}')
+    return np.flipud(1 - im.astype(np.float32)/255)
+
+def area_downsample(im: np.ndarray, factor: float) -> np.ndarray:
+    # The downsampling of the levels here and of astra_recon.load_image(downsampling='area'):
+    # area average to int(h/factor) x int(w/factor), the detector size of projection_geometry.
+    # For integer factors this is the mean over factor x factor blocks with a trailing partial
+    # block dropped, so pyramid level f and a direct downsample by f agree to float rounding.
+    if factor == 1:
+        return im
+    h, w = int(im.shape[0]/factor), int(im.shape[1]/factor)
+    if float(factor).is_integer():
+        im = im[:h*int(factor), :w*int(factor)]
+    return cv.resize(np.ascontiguousarray(im), (w, h), interpolation=cv.INTER_AREA)
+
+def build_pyramid(
+        jsonfile: Path,
+        max_factor: int = 8,
+        num_workers: int = -1,
+        force: bool = False
+) -> Path:
+    # decode every frame of jsonfile once and write all power-of-two levels up to max_factor
+    jsonfile = Path(jsonfile)
+    dname = jsonfile.parent
+    out = pyramid_dir(jsonfile)
+    file_paths = [str(fn) for fn in load_index(jsonfile).file_path]
+    key = sino_cache.content_key(jsonfile, dname, file_paths)
+    meta = read_meta(jsonfile)
+    if not force and meta is not None and meta['key'] == key and meta['max_factor'] >= max_factor:
+        print(f'Pyramid {out} is up to date')
+        return out
+    if num_workers < 0:
+        num_workers = os.cpu_count() or 1
+
+    tic = time.perf_counter()
+    out.mkdir(parents=True, exist_ok=True)
+    # meta.json marks the pyramid as complete, so remove it while the levels are rewritten
+    (out/META_FILE).unlink(missing_ok=True)
+    first = attenuation(dname, file_paths[0])
+    factors = [1]
+    while 2*factors[-1] <= max_factor and min(first.shape) // (2*factors[-1]) >= 1:
+        factors.append(2*factors[-1])
+    levels = {}
+    shape = first.shape
+    for f in factors:
+        levels[f] = np.lib.format.open_memmap(
+            out/(level_file(f) + '.tmp'), mode='w+', dtype=np.float32, shape=(len(file_paths), *shape)
+        )
+        shape = (shape[0]//2, shape[1]//2)
+
+    def _write(i):
+        im = first if i == 0 else attenuation(dname, file_paths[i])
+        assert im.shape == first.shape, f'{file_paths[i]} has shape {im.shape}, expected {first.shape}'
+        for f in factors:
+            if f > 1:
+                im = area_downsample(im, 2)
+            levels[f][i] = im
+
+    # cv.imread releases the GIL, and each frame goes to its own rows of the levels
+    with ThreadPoolExecutor(max(1, num_workers)) as pool:
+        for _ in track(pool.map(_write, range(len(file_paths))), total=len(file_paths), description='Building pyramid'):
+            pass
+    for f in factors:
+        levels[f].flush()
+        del levels[f]
+        os.replace(out/(level_file(f) + '.tmp'), out/level_file(f))
+    meta = {
+        'format': FORMAT,
+        'version': VERSION,
+        'key': key,
+        'source': jsonfile.resolve().as_posix(),
+        'max_factor': max_factor,
+        'levels': factors,
+        'file_paths': file_paths,
+    }
+    tmp = out/(META_FILE + '.tmp')
+    tmp.write_text(json.dumps(meta))
+    os.replace(tmp, out/META_FILE)
+    dt = time.perf_counter() - tic
+    print(f'Built pyramid of {len(file_paths)} frames at downscales {factors} in {dt:.2f} s')
+    return out
+
+def read_meta(jsonfile: Path) -> Optional[dict]:
+    try:
+        meta = json.loads((pyramid_dir(jsonfile)/META_FILE).read_text())
+    except (OSError, ValueError):
+        return None
+    if meta.get('format') != FORMAT or meta.get('version') != VERSION:
+        return None
+    return meta
+
+def open_level(
+        jsonfile: Path,
+        factor: int,
+        check: bool = True
+) -> Optional[Tuple[np.ndarray, List[str]]]:
+    # memmap of the level at downscale factor and the file path of each row, or None if the
+    # pyramid is missing, lacks that level or (with check) is stale
+    meta = read_meta(jsonfile)
+    if meta is None or factor not in meta['levels']:
+        return None
+    if check and meta['key'] != sino_cache.content_key(jsonfile, Path(jsonfile).parent, meta['file_paths']):
+        print(f'Pyramid {pyramid_dir(jsonfile)} is stale')
+        return None
+    level = np.load(pyramid_dir(jsonfile)/level_file(factor), mmap_mode='r')
+    return level, meta['file_paths']
+
+def read_sinogram(
+        level: np.ndarray,
+        rows: np.ndarray,
+        chunk: int = 64
+) -> np.ndarray:
+    # frames rows of a level as a (rows, n_proj, cols) sinogram, copied chunk by chunk
+    n = len(rows)
+    sinogram = np.empty((level.shape[1], n, level.shape[2]), dtype=np.float32)
+    for i0 in range(0, n, chunk):
+        sinogram[:, i0:i0+chunk, :] = level[rows[i0:i0+chunk]].transpose(1, 0, 2)
+    return sinogram
+
+def main(
+        input_path: Path,
+        max_factor: int = 8,
+        num_workers: int = -1,
+        force: bool = False
+):
+    # input_path: transforms JSON, or a directory whose transforms*.json files are all processed
+    input_path = Path(input_path)
+    jsonfiles = sorted(input_path.glob('transforms*.json')) if input_path.is_dir() else [input_path]
+    for jsonfile in jsonfiles:
+        build_pyramid(jsonfile, max_factor, num_workers, force)
+
+if __name__ == '__main__':
+    tyro.cli(main)
@@ -0,0 +1,120 @@
+from pathlib import Path
+import numpy as np
+from typing import Optional, Tuple, List
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# On-disk cache of processed sinograms. Each entry lives in its own slot directory
+# (one per transforms file and load parameters) and holds
+#   sinogram.npy - float32 (rows, n_proj, cols) array, opened with mmap on warm runs
+#   meta.json    - content key, proj_geom and image_filenames
+# The content key covers the transforms JSON contents and the mtimes of the selected
+# images, so an entry whose inputs changed is detected as stale and evicted. Entries are
+# written to a .tmp-<slot>-* directory and renamed into place when complete, so a slot
+# directory is never partial and runs sharing a cache do not evict each other's writes.
+
+SINOGRAM_FILE = 'sinogram.npy'
+META_FILE = 'meta.json'
+TMP_PREFIX = '.tmp-'
+# temporary directories older than this are left over from crashed runs
+STALE_TMP_SECONDS = 24*3600
+
+def cache_slot(jsonfile: Path, params: dict) -> str:
+    h = hashlib.sha1()
+    h.update(Path(jsonfile).resolve().as_posix().encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()[:16]
+
+def content_key(jsonfile: Path, dname: Path, image_filenames: List[str]) -> str:
+    h = hashlib.sha256()
+    h.update(Path(jsonfile).read_bytes())
+    for fn in image_filenames:
+        st = (Path(dname)/fn).stat()
+        h.update(f'{fn}:{st.st_mtime_ns}:{st.st_size}\n'.encode())
+    return h.hexdigest()
+
+def evict(cache_dir: Path, slot: str):
+    shutil.rmtree(Path(cache_dir)/slot, ignore_errors=True)
+
+def evict_orphans(cache_dir: Path):
+    # remove entries whose transforms file no longer exists, entries without meta.json and
+    # temporary directories of writes abandoned more than STALE_TMP_SECONDS ago
+    cache_dir = Path(cache_dir)
+    if not cache_dir.is_dir():
+        return
+    for slot_dir in cache_dir.iterdir():
+        if not slot_dir.is_dir():
+            continue
+        if slot_dir.name.startswith(TMP_PREFIX):
+            try:
+                abandoned = time.time() - slot_dir.stat().st_mtime > STALE_TMP_SECONDS
+            except OSError: # renamed into place or removed meanwhile
+                continue
+            if abandoned:
+                print(f'Evicting abandoned cache write {slot_dir.name}')
+                evict(cache_dir, slot_dir.name)
+            continue
+        meta_file = slot_dir/META_FILE
+        try:
+            meta = json.loads(meta_file.read_text())
+            orphan = not Path(meta['source']).exists()
+        except (OSError, ValueError, KeyError):
+            orphan = True
+        if orphan:
+            print(f'Evicting orphaned cache entry {slot_dir.name}')
+            evict(cache_dir, slot_dir.name)
+
+def load_cached(
+        cache_dir: Path,
+        slot: str,
+        key: str
+) -> Optional[Tuple[np.ndarray, dict, List[str]]]:
+    slot_dir = Path(cache_dir)/slot
+    meta_file = slot_dir/META_FILE
+    if not meta_file.exists():
+        return None
+    meta = json.loads(meta_file.read_text())
+    if meta['key'] != key or not (slot_dir/SINOGRAM_FILE).exists():
+        print(f'Cache entry {slot} is stale, evicting')
+        evict(cache_dir, slot)
+        return None
+    proj_data = np.load(slot_dir/SINOGRAM_FILE, mmap_mode='r')
+    proj_geom = meta['proj_geom']
+    proj_geom['ProjectionAngles'] = np.array(proj_geom['ProjectionAngles'])
+    return proj_data, proj_geom, meta['image_filenames']
+
+def store_cached(
+        cache_dir: Path,
+        slot: str,
+        key: str,
+        source: Path,
+        proj_data: np.ndarray,
+        proj_geom: dict,
+        image_filenames: List[str]
+):
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f'{TMP_PREFIX}{slot}-', dir=cache_dir))
+    try:
+        with open(tmp_dir/SINOGRAM_FILE, 'wb') as f:
+            np.save(f, np.ascontiguousarray(proj_data, dtype=np.float32))
+        geom = dict(proj_geom)
+        geom['ProjectionAngles'] = np.asarray(geom['ProjectionAngles']).tolist()
+        meta = {
+            'key': key,
+            'source': Path(source).resolve().as_posix(),
+            'proj_geom': geom,
+            'image_filenames': image_filenames,
+        }
+        (tmp_dir/META_FILE).write_text(json.dumps(meta, indent=2))
+        try:
+            os.rename(tmp_dir, cache_dir/slot)
+        except OSError:
+            # another run stored the same slot first; keep its entry
+            print(f'Cache entry {slot} was stored concurrently, discarding this copy')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
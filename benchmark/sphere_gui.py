@@ -2,22 +2,241 @@ from pathlib import Path
 import numpy as np
 import cv2 as cv
 import tyro
+from typing import Dict, Literal, Optional, Tuple
+from collections import OrderedDict
+import threading
+import zipfile
+from volume_io import ChunkedVolume
 
-def main(
+# Circle detection runs on a worker thread. Results are kept in an LRU cache keyed by
+# (axis, index), holding the 8-bit slice and its circles: a fast pass on a downsampled slice
+# for the slices shown and their neighbours (prefetched), and a full-resolution pass only when
+# a click asks for a sphere fit. The UI thread only draws what is cached and polls for updates.
+
+def to_uint8(v: np.ndarray) -> np.ndarray:
+    # HoughCircles needs 8-bit input; volumes written by astra_recon are already within 0-255
+    if v.dtype == np.uint8:
+        return np.ascontiguousarray(v)
+    vmax = float(v.max()) if v.size else 0.0
+    if vmax > 255 or vmax <= 1:
+        v = v.astype(np.float32) * (255 / vmax if vmax > 0 else 0)
+    return np.ascontiguousarray(np.clip(v, 0, 255).astype(np.uint8))
+
+def detect_circles(im: np.ndarray, scale: int = 1) -> Optional[np.ndarray]:
+    # HoughCircles on im downsampled by scale; circles (1, n, 3) in full-resolution pixels
+    if scale > 1:
+        im = cv.resize(im, None, fx=1/scale, fy=1/scale, interpolation=cv.INTER_AREA)
+    im = cv.medianBlur(im, 5)
+    h, w = im.shape
+    circles = cv.HoughCircles(im, cv.HOUGH_GRADIENT, 1, h / 8,
+                              param1=100, param2=10,
+                              minRadius=0, maxRadius=0)
+    if circles is not None and scale > 1:
+        circles = circles * scale
+    return circles
+
+class SliceDetector:
+    def __init__(self, data, fast_scale: int = 1, cache_size: int = 256) -> None:
+        self.data = data
+        self.fast_scale = fast_scale
+        self.cache_size = cache_size
+        # (axis, index) -> {'image': uint8 slice, 'circles': array or None, 'refined': bool}
+        self.cache = OrderedDict()
+        # (axis, index) -> (priority, refined), replaced on every request
+        self.pending = {}
+        self.version = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def slice(self, axis: str, index: int) -> np.ndarray:
+        data = self.data
+        if axis == 'x':
+            v = data[index,:,::-1].T
+        elif axis == 'y':
+            v = data[:,index,::-1].T
+        elif axis == 'z':
+            v = data[:,::-1,index].T
+        else:
+            raise ValueError(f'Invalid slice {axis}')
+        return to_uint8(np.asarray(v))
+
+    def get(self, axis: str, index: int) -> Optional[dict]:
+        with self._cond:
+            entry = self.cache.get((axis, index))
+            if entry is not None:
+                self.cache.move_to_end((axis, index))
+            return entry
+
+    def request(self, targets: Dict[Tuple[str, int], Tuple[int, bool]]):
+        # targets: (axis, index) -> (priority, refined); lower priority is served first.
+        # Replaces all earlier requests, so slices the cursor has moved away from are dropped.
+        with self._cond:
+            self.pending = dict(targets)
+            self._cond.notify()
+
+    def _next(self):
+        # most urgent pending key that is not cached at the requested quality
+        best = None
+        for key, (priority, refined) in list(self.pending.items()):
+            entry = self.cache.get(key)
+            if entry is not None and (entry['refined'] or not refined):
+                del self.pending[key]
+                continue
+            if best is None or priority < best[1]:
+                best = (key, priority, refined)
+        return best
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._closed and self._next() is None:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                key, _, refined = self._next()
+                del self.pending[key]
+                entry = self.cache.get(key)
+            image = entry['image'] if entry is not None else self.slice(*key)
+            circles = detect_circles(image, 1 if refined else self.fast_scale)
+            with self._cond:
+                self.cache[key] = {'image': image, 'circles': circles, 'refined': refined or self.fast_scale == 1}
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+                self.version += 1
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+def npz_header(path: Path, key: str = 'vol') -> Tuple[Tuple[int, ...], bool, np.dtype]:
+    # shape, fortran order and dtype of an array in an npz, read without decompressing it
+    with zipfile.ZipFile(path) as zf, zf.open(f'{key}.npy') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            return np.lib.format.read_array_header_1_0(f)
+        return np.lib.format.read_array_header_2_0(f)
+
+def open_volume(
     input: Path,
-    zxy: bool = False
+    level: int = 0,
+    resolution: Optional[Tuple[int, int, int]] = None,
+    dtype: str = 'uint16'
 ):
-    assert input.is_file(), f'Input file {input} does not exist'
+    # volume in the XYZ layout of vol.npz, read lazily where the format allows it: slices
+    # are only fetched from disk when indexed
+    if input.suffix == '.chunks':
+        # lazily read chunked volume; level selects the pyramid level
+        return ChunkedVolume(input, level)
+    if input.suffix == '.raw':
+        # vol_zyx.raw as written by astra_recon; a cube if resolution is not given
+        vol = np.memmap(input, dtype=dtype, mode='r')
+        if resolution is None:
+            n = int(round(len(vol) ** (1/3)))
+            assert n**3 == len(vol), f'{input} is not a cube of {dtype}, pass resolution'
+            resolution = (n, n, n)
+        assert len(vol) == np.prod(resolution), f'Expected {np.prod(resolution)} elements but got {len(vol)} in {input}'
+        return vol.reshape(resolution[2], resolution[1], resolution[0]).swapaxes(0,2)
+    if input.suffix == '.npy':
+        return np.load(input, mmap_mode='r')
     if input.suffix == '.npz':
-        data = np.load(input)['vol']
-    elif input.suffix == '.npy':
-        data = np.load(input)
-    else:
-        raise ValueError(f'Invalid input file {input}')
+        # vol.npz is compressed; astra_recon writes the same volume to vol_zyx.raw, which
+        # can be memory-mapped instead. It is only used if it was written with or after the
+        # npz, so that a stale raw file from an earlier run is never shown
+        raw = input.with_name('vol_zyx.raw')
+        if raw.exists() and raw.stat().st_mtime >= input.stat().st_mtime:
+            shape, fortran_order, raw_dtype = npz_header(input)
+            if len(shape) == 3 and not fortran_order and raw.stat().st_size == np.prod(shape) * raw_dtype.itemsize:
+                print(f'Opened {raw} instead of decompressing {input.name}')
+                return open_volume(raw, resolution=shape, dtype=raw_dtype)
+        print(f'Opened {input}')
+        return np.load(input)['vol']
+    raise ValueError(f'Invalid input file {input}')
+
+def fit_sphere(
+    circles: Dict[str, Optional[np.ndarray]],
+    position: Dict[str, int],
+    shape: Tuple[int, int, int]
+) -> Optional[dict]:
+    # Sphere through the circles detected in the x, y and z slices at position (as shown by
+    # SliceDetector.slice, rows flipped). For every axis the circle containing the other two
+    # slice indices is used; None unless all three axes have one. Centres are normalized like
+    # detect_spheres: voxel i of n is centred at (i + 0.5)/n*2 - 1.
+    nx, ny, nz = shape
+    x, y, z = position['x'], position['y'], position['z']
+    circle_data = {}
+    for k, v in circles.items():
+        if v is None: continue
+        for p0, p1, r in v[0]:
+            if k == 'x':
+                p1 = nz - 1 - p1
+                yc, zc = p0, p1
+                if (y-yc)**2 + (z-zc)**2 <= r**2:
+                    circle_data[k] = {k: x, 'ycx': yc, 'zcx': zc, 'rx': r}
+            elif k == 'y':
+                p1 = nz - 1 - p1
+                xc, zc = p0, p1
+                if (x-xc)**2 + (z-zc)**2 <= r**2:
+                    circle_data[k] = {k: y, 'xcy': xc, 'zcy': zc, 'ry': r}
+            elif k == 'z':
+                p1 = ny - 1 - p1
+                xc, yc = p0, p1
+                if (x-xc)**2 + (y-yc)**2 <= r**2:
+                    circle_data[k] = {k: z, 'xcz': xc, 'ycz': yc, 'rz': r}
+            else: raise ValueError(f'Invalid slice {k}')
+
+    if len(circle_data) < 3:
+        return None
+
+    # find centre
+    xc = (circle_data['y']['xcy'] + circle_data['z']['xcz']) / 2
+    yc = (circle_data['x']['ycx'] + circle_data['z']['ycz']) / 2
+    zc = (circle_data['x']['zcx'] + circle_data['y']['zcy']) / 2
+    # find radius
+    deltax = x - xc
+    deltay = y - yc
+    deltaz = z - zc
+    rx = np.sqrt(deltax**2 + circle_data['x']['rx']**2)
+    ry = np.sqrt(deltay**2 + circle_data['y']['ry']**2)
+    rz = np.sqrt(deltaz**2 + circle_data['z']['rz']**2)
+    R = float(np.mean([rx, ry, rz]))
+    assert nx == ny == nz
+    center = np.array([xc, yc, zc], dtype=np.float64)
+    return {
+        'center': ((center + 0.5) / np.array(shape) * 2 - 1).tolist(),
+        'radius': R / nx * 2,
+        'center_voxels': center.tolist(),
+        'radius_voxels': R,
+    }
+
+def main(
+    input: Path,
+    zxy: bool = False,
+    level: int = 0,
+    resolution: Optional[Tuple[int, int, int]] = None,
+    dtype: Literal['uint8', 'uint16', 'float32'] = 'uint16',
+    fast_scale: Optional[int] = None,
+    prefetch: int = 4,
+    cache_size: int = 256
+):
+    # resolution/dtype: layout of a .raw input (default: uint16 cube); fast_scale: downsampling
+    # of the fast detection pass, by default slices are reduced to about 256 pixels; prefetch:
+    # neighbouring slices on either side detected ahead of the cursor
+    assert input.exists(), f'Input file {input} does not exist'
+    data = open_volume(input, level, resolution, dtype)
     if zxy:
+        # a view with remapped indices, nothing is copied
         data = data.swapaxes(0,2)
     print(f'Loaded {data.size} elements of type {data.dtype}')
     nx, ny, nz = data.shape
+    if fast_scale is None:
+        fast_scale = max(1, max(data.shape) // 256)
+    detector = SliceDetector(data, fast_scale, cache_size)
+    sizes = {'x': nx, 'y': ny, 'z': nz}
 
     # Show 3 slices, one from each axis. Create sliders to change the slice.
     cv.namedWindow('x-slice', cv.WINDOW_NORMAL)
@@ -25,126 +244,106 @@ def main(
     cv.namedWindow('z-slice', cv.WINDOW_NORMAL)
     cv.namedWindow('control', cv.WINDOW_NORMAL)
 
-    # keep track of circles
-    global circles
-    circles = {
-        'x': None,
-        'y': None,
-        'z': None
-    }
+    # set by a click, cleared once the refined circles of the current slices are available
+    state = {'fit_pending': False, 'drawn': None}
 
-    def update_slices(val):
-        global circles
-
-        x = cv.getTrackbarPos('x', 'control')
-        y = cv.getTrackbarPos('y', 'control')
-        z = cv.getTrackbarPos('z', 'control')
-        slices = {
-            'x': data[x,:,::-1].T,
-            'y': data[:,y,::-1].T,
-            'z': data[:,::-1,z].T
-        }
-        for k,v in slices.items():
-            im = cv.medianBlur(v, 5)
-            h,w = im.shape
-            _circles = cv.HoughCircles(im, cv.HOUGH_GRADIENT, 1, h / 8,
-                                    param1=100, param2=10,
-                                    minRadius=0, maxRadius=0)
-            circles[k] = _circles
+    def position():
+        return {k: cv.getTrackbarPos(k, 'control') for k in ('x', 'y', 'z')}
 
+    def request(refine: bool = False):
+        pos = position()
+        targets = {}
+        for d in range(prefetch, 0, -1):
+            for k, i in pos.items():
+                for j in (i - d, i + d):
+                    if 0 <= j < sizes[k]:
+                        targets[(k, j)] = (2 + d, False)
+        for k, i in pos.items():
+            targets[(k, i)] = (0, False)
+            if refine:
+                targets[(k, i)] = (1, True)
+        detector.request(targets)
+
+    def update_slices(val):
+        # draw the current slices with their cached circles; detection happens in the background
+        pos = position()
+        for k, i in pos.items():
+            entry = detector.get(k, i)
+            if entry is None:
+                v = detector.slice(k, i)
+                _circles = None
+            else:
+                v, _circles = entry['image'], entry['circles']
+            v = cv.cvtColor(v, cv.COLOR_GRAY2BGR)
             if _circles is not None:
-                v = cv.cvtColor(v, cv.COLOR_GRAY2BGR)
                 _circles = np.uint16(np.around(_circles))
-                for i in _circles[0, :]:
-                    center = (i[0], i[1])
+                for c in _circles[0, :]:
+                    center = (c[0], c[1])
                     # circle outline
-                    radius = i[2]
+                    radius = c[2]
                     cv.circle(v, center, radius, (255, 0, 255), 3)
-
             cv.imshow(f'{k}-slice', v)
+        state['drawn'] = (tuple(pos.values()), detector.version)
 
-    def on_click_x(event, y, z, flags, param):
+    def on_trackbar(val):
+        request(state['fit_pending'])
+        update_slices(val)
+
+    def on_click(event, pos):
         if event == cv.EVENT_LBUTTONDOWN:
-            z = nz - z - 1
-            cv.setTrackbarPos('y', 'control', y)
-            cv.setTrackbarPos('z', 'control', z)
+            for k, i in pos.items():
+                cv.setTrackbarPos(k, 'control', i)
+            state['fit_pending'] = True
+            request(refine=True)
             update_slices(0)
-            fit_sphere()
+
+    def on_click_x(event, y, z, flags, param):
+        on_click(event, {'y': y, 'z': nz - z - 1})
 
     def on_click_y(event, x, z, flags, param):
-        if event == cv.EVENT_LBUTTONDOWN:
-            z = nz - z - 1
-            cv.setTrackbarPos('x', 'control', x)
-            cv.setTrackbarPos('z', 'control', z)
-            update_slices(0)
-            fit_sphere()
+        on_click(event, {'x': x, 'z': nz - z - 1})
 
     def on_click_z(event, x, y, flags, param):
-        if event == cv.EVENT_LBUTTONDOWN:
-            y = ny - y - 1
-            cv.setTrackbarPos('x', 'control', x)
-            cv.setTrackbarPos('y', 'control', y)
-            update_slices(0)
-            fit_sphere()
-
-    def fit_sphere():
-        x = cv.getTrackbarPos('x', 'control')
-        y = cv.getTrackbarPos('y', 'control')
-        z = cv.getTrackbarPos('z', 'control')
-        circle_data = {}
-        for k,v in circles.items():
-            if v is None: continue
-            for p0, p1, r in v[0]:
-                if k == 'x':
-                    p1 = nz - p1
-                    yc, zc = p0, p1
-                    if (y-yc)**2 + (z-zc)**2 <= r**2:
-                        circle_data[k] = {k: x, 'ycx': yc, 'zcx': zc, 'rx': r}
-                elif k == 'y':
-                    p1 = nz - p1
-                    xc, zc = p0, p1
-                    if (x-xc)**2 + (z-zc)**2 <= r**2:
-                        circle_data[k] = {k: y, 'xcy': xc, 'zcy': zc, 'ry': r}
-                elif k == 'z':
-                    p1 = ny - p1
-                    xc, yc = p0, p1
-                    if (x-xc)**2 + (y-yc)**2 <= r**2:
-                        circle_data[k] = {k: z, 'xcz': xc, 'ycz': yc, 'rz': r}
-                else: raise ValueError(f'Invalid slice {k}')
-
-        if len(circle_data) < 3:
+        on_click(event, {'x': x, 'y': ny - y - 1})
+
+    def current_circles():
+        # refined circles of the current slices, or None while any is still being detected
+        pos = position()
+        circles = {}
+        for k, i in pos.items():
+            entry = detector.get(k, i)
+            if entry is None or not entry['refined']:
+                return None
+            circles[k] = entry['circles']
+        return circles
+
+    def on_fit(circles):
+        fit = fit_sphere(circles, position(), data.shape)
+        if fit is None:
             return
-        
-        # find centre
-        xc = (circle_data['y']['xcy'] + circle_data['z']['xcz']) / 2
-        yc = (circle_data['x']['ycx'] + circle_data['z']['ycz']) / 2
-        zc = (circle_data['x']['zcx'] + circle_data['y']['zcy']) / 2
-        # find radius
-        deltax = x - xc
-        deltay = y - yc
-        deltaz = z - zc
-        rx = np.sqrt(deltax**2 + circle_data['x']['rx']**2)
-        ry = np.sqrt(deltay**2 + circle_data['y']['ry']**2)
-        rz = np.sqrt(deltaz**2 + circle_data['z']['rz']**2)
-        R = np.mean([rx, ry, rz])
-        print(f'Centre: {xc}, {yc}, {zc}, Radius: {R:.3g}')
-        # normalized coordinates
-        xc = xc / nx * 2 - 1
-        yc = yc / ny * 2 - 1
-        zc = zc / nz * 2 - 1
-        assert nx == ny == nz
-        R = R / nx * 2
-        print(f'\tNormalised: ({xc:.3g}, {yc:.3g}, {zc:.3g}), {R:.3g}')
-
-    cv.createTrackbar('x', 'control', 0, data.shape[0]-1, update_slices)
-    cv.createTrackbar('y', 'control', 0, data.shape[1]-1, update_slices)
-    cv.createTrackbar('z', 'control', 0, data.shape[2]-1, update_slices)
+        print(f'Centre: {fit["center_voxels"][0]}, {fit["center_voxels"][1]}, {fit["center_voxels"][2]}, Radius: {fit["radius_voxels"]:.3g}')
+        xc, yc, zc = fit['center']
+        print(f'\tNormalised: ({xc:.3g}, {yc:.3g}, {zc:.3g}), {fit["radius"]:.3g}')
+
+    cv.createTrackbar('x', 'control', 0, data.shape[0]-1, on_trackbar)
+    cv.createTrackbar('y', 'control', 0, data.shape[1]-1, on_trackbar)
+    cv.createTrackbar('z', 'control', 0, data.shape[2]-1, on_trackbar)
     cv.setMouseCallback('x-slice', on_click_x)
     cv.setMouseCallback('y-slice', on_click_y)
     cv.setMouseCallback('z-slice', on_click_z)
+    request()
     update_slices(0)
-    cv.waitKey(0)
+    # poll instead of blocking in waitKey(0), redrawing when new detections arrive; any key exits
+    while cv.waitKey(30) == -1:
+        if state['drawn'] != (tuple(position().values()), detector.version):
+            update_slices(0)
+        if state['fit_pending']:
+            circles = current_circles()
+            if circles is not None:
+                state['fit_pending'] = False
+                on_fit(circles)
+    detector.close()
     cv.destroyAllWindows()
 
 if __name__=='__main__':
-    tyro.cli(main)
\ No newline at end of file
+    tyro.cli(main)
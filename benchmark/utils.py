@@ -2,25 +2,36 @@ from pathlib import Path
 import pandas as pd
 import cv2 as cv
 import numpy as np
-from typing import Optional
+from typing import Dict, List, Optional
 from rich.progress import track
 from datetime import datetime
+from contextlib import contextmanager
+import json
+import sys
+import time
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
 
 class PrintTableMetrics:
-    def __init__(self, log_metrics: list, col_width: int = 12, max_iter: Optional[int] = None) -> None:
+    def __init__(self, log_metrics: list, col_width: int = 12, max_iter: Optional[int] = None, timing: bool = True) -> None:
+        # timing=False prints log_metrics only, without the Time/Iteration/it/s columns
         super().__init__()
 
         header = []
         for metric in log_metrics:
             header.append(metric)
-        if 'Iteration' not in header:
-            header.insert(0, "Iteration")
-        if 'Time' not in header:
-            header.insert(0, "Time")
-        if max_iter is not None:
-            header.append('ETA')
-        if 'it/s' not in header:
-            header.append('it/s')
+        self.timing = timing
+        if timing:
+            if 'Iteration' not in header:
+                header.insert(0, "Iteration")
+            if 'Time' not in header:
+                header.insert(0, "Time")
+            if max_iter is not None:
+                header.append('ETA')
+            if 'it/s' not in header:
+                header.append('it/s')
         
         self.format_str = '{' + ':>' + str(col_width) + '}'
         self.col_width = col_width
@@ -36,13 +47,14 @@ class PrintTableMetrics:
     def update(self, metrics: dict) -> str:
         # Formatting
         s = self.format_str
-        if 'Time' not in metrics:
-            metrics['Time'] = datetime.now().strftime('%H:%M:%S')
+        if self.timing:
+            if 'Time' not in metrics:
+                metrics['Time'] = datetime.now().strftime('%H:%M:%S')
 
-        cur_iter = max(1, metrics['Iteration'])
-        time_per_iter = (datetime.now() - self._time_metrics['start']) / cur_iter
-        iter_per_s = 1 / time_per_iter.total_seconds()
-        metrics['it/s'] = iter_per_s
+            cur_iter = max(1, metrics['Iteration'])
+            time_per_iter = (datetime.now() - self._time_metrics['start']) / cur_iter
+            iter_per_s = 1 / time_per_iter.total_seconds()
+            metrics['it/s'] = iter_per_s
 
         if 'ETA' in self.header:
             assert 'Iteration' in metrics
@@ -63,4 +75,87 @@ class PrintTableMetrics:
             else:
                 fields.append(s.format(''))
         line =  " | ".join(fields)
-        print(line)
\ No newline at end of file
+        print(line)
+
+# what peak_rss measures: the process high-water mark, or only the current RSS on the psutil
+# fallback, whose span differences can then be negative
+RSS_KIND = 'peak' if resource is not None else 'current'
+
+def peak_rss() -> Optional[float]:
+    # peak resident set size of this process in MB; current RSS via psutil where the resource
+    # module is missing (see RSS_KIND), None if neither is available
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 1024**2
+
+class PhaseTimer:
+    # Named spans recording wall time and peak RSS, cheap enough (a few microseconds per span)
+    # to leave on. Spans opened inside another span are recorded as 'outer/inner'; repeated
+    # spans (e.g. one per iteration) are aggregated into count, total, min and max. rss_growth is
+    # how much the process peak RSS rose while the span was open, i.e. new peaks it caused, and
+    # is the per-span signal; process_peak_rss is the process-wide value when the span last
+    # closed, which includes everything that ran before it.
+    def __init__(self) -> None:
+        self.records: Dict[str, dict] = {}
+        self._stack: List[str] = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def span(self, name: str):
+        path = '/'.join(self._stack + [name])
+        self._stack.append(name)
+        rss0 = peak_rss()
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - tic
+            self._stack.pop()
+            self.add(path, dt, rss0)
+
+    def add(self, name: str, seconds: float, rss_before: Optional[float] = None):
+        rss = peak_rss()
+        rec = self.records.get(name)
+        if rec is None:
+            rec = self.records[name] = {
+                'count': 0, 'total': 0.0, 'min': float('inf'), 'max': 0.0, 'process_peak_rss_mb': None, 'rss_growth_mb': 0.0
+            }
+        rec['count'] += 1
+        rec['total'] += seconds
+        rec['min'] = min(rec['min'], seconds)
+        rec['max'] = max(rec['max'], seconds)
+        if rss is not None:
+            rec['process_peak_rss_mb'] = rss
+            if rss_before is not None:
+                rec['rss_growth_mb'] += rss - rss_before
+
+    def to_dict(self) -> dict:
+        phases = {name: {**rec, 'mean': rec['total'] / rec['count']} for name, rec in self.records.items()}
+        return {'wall_time': time.perf_counter() - self._start, 'process_peak_rss_mb': peak_rss(), 'rss_kind': RSS_KIND,
+                'phases': phases}
+
+    def table(self) -> pd.DataFrame:
+        rows = [{'phase': name, **rec} for name, rec in self.to_dict()['phases'].items()]
+        return pd.DataFrame(rows, columns=['phase', 'count', 'total', 'mean', 'min', 'max', 'process_peak_rss_mb', 'rss_growth_mb'])
+
+    def summary(self):
+        rss_col = 'Proc peak MB' if RSS_KIND == 'peak' else 'Proc RSS MB'
+        t = PrintTableMetrics(['Phase', 'Count', 'Total [s]', 'Mean [s]', rss_col, 'RSS +MB'], col_width=14, timing=False)
+        for name, rec in self.to_dict()['phases'].items():
+            t.update({
+                'Phase': name, 'Count': rec['count'], 'Total [s]': rec['total'], 'Mean [s]': rec['mean'],
+                rss_col: rec['process_peak_rss_mb'] if rec['process_peak_rss_mb'] is not None else '',
+                'RSS +MB': rec['rss_growth_mb']
+            })
+
+    def save(self, path: Path):
+        # path without suffix; writes <path>.json and <path>.csv
+        path = Path(path)
+        path.with_suffix('.json').write_text(json.dumps(self.to_dict(), indent=2))
+        self.table().to_csv(path.with_suffix('.csv'), index=False)
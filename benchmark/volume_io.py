@@ -0,0 +1,278 @@
+from pathlib import Path
+import numpy as np
+from typing import Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+import itertools
+import tempfile
+import threading
+import json
+import os
+import zlib
+
+# Chunked, multiscale volume format. A volume is stored as a directory (conventionally *.chunks):
+#   meta.json          - shape, dtype, chunk size, compression and the pyramid levels
+#   level_<k>.bin      - zlib-compressed chunks of level k, concatenated in C order of the chunk grid
+#   level_<k>.idx.npy  - (n_chunks, 2) int64 array of byte offsets and lengths into level_<k>.bin
+# Level k is the volume downsampled by 2^k with 2x2x2 block averaging. Chunks are compressed in
+# parallel (zlib releases the GIL) and a reader only decompresses the chunks a request touches.
+
+FORMAT = 'chunked-volume'
+VERSION = 1
+
+def downsample2(vol: np.ndarray, out: Optional[np.ndarray] = None, slab: int = 16) -> np.ndarray:
+    # 2x2x2 block average; a trailing odd voxel along an axis is dropped. Computed slab planes
+    # of the result at a time, so only 2*slab input planes are converted to float32 at once;
+    # out (e.g. a memmap) receives the result
+    shape = [max(1, n//2) for n in vol.shape]
+    factors = [2 if n > 1 else 1 for n in vol.shape]
+    if out is None:
+        out = np.empty(shape, dtype=vol.dtype)
+    for i0 in range(0, shape[0], slab):
+        i1 = min(i0 + slab, shape[0])
+        v = np.asarray(vol[factors[0]*i0:factors[0]*i1, :2*shape[1], :2*shape[2]], dtype=np.float32)
+        v = v.reshape(i1 - i0, factors[0], shape[1], factors[1], shape[2], factors[2]).mean(axis=(1, 3, 5))
+        if np.issubdtype(vol.dtype, np.integer):
+            v = np.rint(v)
+        out[i0:i1] = v
+    return out
+
+def _chunk_boxes(shape: Tuple[int, ...], chunk: Tuple[int, ...]):
+    grid = [range(0, n, c) for n, c in zip(shape, chunk)]
+    for start in itertools.product(*grid):
+        yield tuple(slice(s, min(s + c, n)) for s, c, n in zip(start, chunk, shape))
+
+def write_chunked(
+        path: Path,
+        vol: np.ndarray,
+        chunk: int = 64,
+        levels: int = 4,
+        num_workers: Optional[int] = None,
+        compresslevel: int = 1,
+        scratch: Optional[Path] = None
+) -> Path:
+    # levels=4 stores full resolution plus the 1/2, 1/4 and 1/8 pyramid. The coarser levels are
+    # held in memory (1/7 of the volume together) unless scratch is given, in which case they
+    # are memory-mapped from a temporary directory in scratch that is removed when done
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    num_workers = num_workers or os.cpu_count() or 1
+    chunk = (chunk,)*vol.ndim
+    meta = {
+        'format': FORMAT,
+        'version': VERSION,
+        'dtype': np.dtype(vol.dtype).str,
+        'chunk': list(chunk),
+        'compression': 'zlib',
+        'levels': [],
+    }
+
+    def compress(level_vol, box):
+        return zlib.compress(np.ascontiguousarray(level_vol[box]).tobytes(), compresslevel)
+
+    level_vol, out = vol, None
+    tmp = tempfile.TemporaryDirectory(prefix='.tmp-pyramid-', dir=scratch) if scratch is not None else nullcontext()
+    with tmp as tmp_dir, ThreadPoolExecutor(num_workers) as pool:
+        for k in range(levels):
+            if k > 0:
+                if min(level_vol.shape) == 1:
+                    break
+                if tmp_dir is not None:
+                    shape = tuple(max(1, n//2) for n in level_vol.shape)
+                    out = np.lib.format.open_memmap(Path(tmp_dir)/f'level_{k}.npy', mode='w+', dtype=vol.dtype, shape=shape)
+                level_vol = downsample2(level_vol, out)
+            index = []
+            offset = 0
+            pending = deque()
+            with open(path/f'level_{k}.bin', 'wb') as f:
+                # bounded window of in-flight chunks keeps memory independent of volume size
+                for box in _chunk_boxes(level_vol.shape, chunk):
+                    pending.append(pool.submit(compress, level_vol, box))
+                    if len(pending) >= 4*num_workers:
+                        data = pending.popleft().result()
+                        f.write(data)
+                        index.append((offset, len(data)))
+                        offset += len(data)
+                while pending:
+                    data = pending.popleft().result()
+                    f.write(data)
+                    index.append((offset, len(data)))
+                    offset += len(data)
+            np.save(path/f'level_{k}.idx.npy', np.array(index, dtype=np.int64).reshape(-1, 2))
+            meta['levels'].append({'scale': 2**k, 'shape': list(level_vol.shape)})
+        # release the memmaps before the temporary directory is removed
+        del level_vol, out
+    (path/'meta.json').write_text(json.dumps(meta, indent=2))
+    return path
+
+def _normalize_key(key, shape):
+    # split an index of ints/slices into a bounding box plus the indexing to apply to it
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        i = key.index(Ellipsis)
+        key = key[:i] + (slice(None),)*(len(shape) - len(key) + 1) + key[i+1:]
+    if len(key) > len(shape):
+        raise IndexError(f'Too many indices for volume of shape {shape}')
+    key = key + (slice(None),)*(len(shape) - len(key))
+    box = []
+    local = []
+    for k, n in zip(key, shape):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(n)
+            idx = range(start, stop, step)
+            if len(idx) == 0:
+                box.append((0, 0))
+                local.append(slice(0, 0))
+                continue
+            lo, hi = min(idx[0], idx[-1]), max(idx[0], idx[-1]) + 1
+            box.append((lo, hi))
+            stop = idx[-1] - lo + (1 if step > 0 else -1)
+            local.append(slice(idx[0] - lo, None if stop < 0 else stop, step))
+        else:
+            k = int(k)
+            if k < 0:
+                k += n
+            if not 0 <= k < n:
+                raise IndexError(f'Index {k} out of bounds for axis of size {n}')
+            box.append((k, k + 1))
+            local.append(0)
+    return box, tuple(local)
+
+class ChunkedVolume:
+    # Lazy reader: indexing (vol[x, :, ::-1], vol[10:20, ...]) or read() only decompresses the
+    # chunks overlapping the request. Recently used chunks are kept in a small LRU cache.
+    def __init__(self, path: Path, level: int = 0, cache_chunks: int = 256) -> None:
+        self.path = Path(path)
+        self.meta = json.loads((self.path/'meta.json').read_text())
+        assert self.meta['format'] == FORMAT, f'{path} is not a chunked volume'
+        self.level = level
+        self.num_levels = len(self.meta['levels'])
+        if not 0 <= level < self.num_levels:
+            raise ValueError(f'Level {level} not available, volume has {self.num_levels} levels')
+        self.shape = tuple(self.meta['levels'][level]['shape'])
+        self.scale = self.meta['levels'][level]['scale']
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.chunk = tuple(self.meta['chunk'])
+        self.index = np.load(self.path/f'level_{level}.idx.npy')
+        self.grid = tuple(-(-n // c) for n, c in zip(self.shape, self.chunk))
+        self._file = open(self.path/f'level_{level}.bin', 'rb')
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_chunks = cache_chunks
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    def pyramid_level(self, level: int) -> 'ChunkedVolume':
+        return ChunkedVolume(self.path, level, self._cache_chunks)
+
+    def _chunk(self, cidx: Tuple[int, ...]) -> np.ndarray:
+        with self._lock:
+            if cidx in self._cache:
+                self._cache.move_to_end(cidx)
+                return self._cache[cidx]
+            offset, length = self.index[np.ravel_multi_index(cidx, self.grid)]
+            self._file.seek(int(offset))
+            data = self._file.read(int(length))
+        shape = tuple(min(c, n - i*c) for i, c, n in zip(cidx, self.chunk, self.shape))
+        arr = np.frombuffer(zlib.decompress(data), dtype=self.dtype).reshape(shape)
+        with self._lock:
+            self._cache[cidx] = arr
+            if len(self._cache) > self._cache_chunks:
+                self._cache.popitem(last=False)
+        return arr
+
+    def read(self, box) -> np.ndarray:
+        # box: sequence of (start, stop) per axis
+        out = np.empty(tuple(hi - lo for lo, hi in box), dtype=self.dtype)
+        if out.size == 0:
+            return out
+        ranges = [range(lo // c, (hi - 1) // c + 1) for (lo, hi), c in zip(box, self.chunk)]
+        for cidx in itertools.product(*ranges):
+            arr = self._chunk(cidx)
+            src = []
+            dst = []
+            for (lo, hi), i, c in zip(box, cidx, self.chunk):
+                c0 = i*c
+                s0, s1 = max(lo, c0), min(hi, c0 + c)
+                src.append(slice(s0 - c0, s1 - c0))
+                dst.append(slice(s0 - lo, s1 - lo))
+            out[tuple(dst)] = arr[tuple(src)]
+        return out
+
+    def slice(self, axis: int, index: int) -> np.ndarray:
+        key = [slice(None)]*self.ndim
+        key[axis] = index
+        return self[tuple(key)]
+
+    def __getitem__(self, key) -> np.ndarray:
+        box, local = _normalize_key(key, self.shape)
+        return self.read(box)[local]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        arr = self[...]
+        return arr if dtype is None else arr.astype(dtype)
+
+    def swapaxes(self, axis1: int, axis2: int) -> 'AxisView':
+        return AxisView(self).swapaxes(axis1, axis2)
+
+    def transpose(self, *axes) -> 'AxisView':
+        return AxisView(self).transpose(*axes)
+
+    def close(self):
+        self._file.close()
+
+class AxisView:
+    # Axis permutation of a lazily indexed volume done by remapping indices instead of copying
+    def __init__(self, base, axes: Optional[Tuple[int, ...]] = None) -> None:
+        self.base = base
+        self.axes = tuple(range(base.ndim)) if axes is None else tuple(axes)
+        self.shape = tuple(base.shape[a] for a in self.axes)
+        self.dtype = base.dtype
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    def transpose(self, *axes) -> 'AxisView':
+        if len(axes) == 1 and isinstance(axes[0], (tuple, list)):
+            axes = tuple(axes[0])
+        if not axes:
+            axes = tuple(reversed(range(self.ndim)))
+        return AxisView(self.base, tuple(self.axes[a] for a in axes))
+
+    def swapaxes(self, axis1: int, axis2: int) -> 'AxisView':
+        axes = list(range(self.ndim))
+        axes[axis1], axes[axis2] = axes[axis2], axes[axis1]
+        return self.transpose(*axes)
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),)*(self.ndim - len(key) + 1) + key[i+1:]
+        key = key + (slice(None),)*(self.ndim - len(key))
+        base_key = [slice(None)]*self.ndim
+        for view_axis, base_axis in enumerate(self.axes):
+            base_key[base_axis] = key[view_axis]
+        out = self.base[tuple(base_key)]
+        # axes that survive indexing, in base order, rearranged into view order
+        kept = [a for a in range(self.ndim) if not isinstance(base_key[a], (int, np.integer))]
+        order = [kept.index(a) for a in self.axes if a in kept]
+        return out.transpose(order)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        arr = self[...]
+        return arr if dtype is None else arr.astype(dtype)
@@ -14,8 +14,8 @@ echo "=========================================="
 echo "Step 1: Generating synthetic data"
 echo "=========================================="
 
-# Run the data generation script
-python3 "$SCRIPT_DIR/generate_data.py"
+# Run the data generation script; with the benchmark tools importable it also writes the frame index
+PYTHONPATH="$PROJECT_ROOT/benchmark${PYTHONPATH:+:$PYTHONPATH}" python3 "$SCRIPT_DIR/generate_data.py"
 
 if [ $? -ne 0 ]; then
     echo "Error: Data generation failed!"
@@ -1,68 +1,406 @@
 #!/usr/bin/env python3
 """
-Generate synthetic X-ray projection data with 8 spheres that deform over time.
+Generate synthetic X-ray projection data with spheres that deform over time.
+
+By default 8 spheres of radius 0.15 on the corners of a cube are rendered over 21 timesteps.
+Object count, layout, radii distribution, timestep count and deformation field can be changed
+to generate larger scenes.
 """
 
 import sys
+import os
 import json
-import yaml
+import math
+import hashlib
+import numpy as np
 from pathlib import Path
 import tempfile
 import shutil
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from xray_projection_render import XRayRenderer
+try:
+    # the frame index lives with the benchmark tools, importable with benchmark/ on PYTHONPATH
+    from frame_index import FrameIndexBuilder, write_index
+except ImportError:  # the loaders build the index from the JSON on first use instead
+    FrameIndexBuilder = write_index = None
 
 
 def apply_deformation(X_1, X_2, X_3, t):
     """
     Apply deformation field to original coordinates.
-    
+
+    Works elementwise on scalars or on broadcastable NumPy arrays, e.g. centers of shape
+    (1, N) against times of shape (T, 1) to deform all centers at all times at once.
+
     Args:
         X_1, X_2, X_3: Original coordinates
         t: Time parameter (0 to 1)
-    
+
     Returns:
         Deformed coordinates (x_1, x_2, x_3)
     """
     # relu(X) = max(0, X)
-    relu_X1 = max(0, X_1)
-    relu_X3 = max(0, X_3)
-    
+    relu_X1 = np.maximum(0, X_1)
+    relu_X3 = np.maximum(0, X_3)
+
     x_1 = X_1 + 0.5 * relu_X1 * t
     x_2 = X_2 + relu_X3 * X_2 * t
     x_3 = X_3 + X_1 * X_2 * X_3 * t
-    
+
     return x_1, x_2, x_3
 
 
-def create_sphere_collection(sphere_centers):
+def twist_deformation(X_1, X_2, X_3, t):
+    """Rotate about the x_3 axis by an angle growing linearly with x_3 and t (up to 45° at x_3=1, t=1)."""
+    angle = np.pi / 4 * X_3 * t
+    x_1 = np.cos(angle) * X_1 - np.sin(angle) * X_2
+    x_2 = np.sin(angle) * X_1 + np.cos(angle) * X_2
+    return x_1, x_2, X_3 + 0 * t
+
+
+def no_deformation(X_1, X_2, X_3, t):
+    """Static scene."""
+    return X_1 + 0 * t, X_2 + 0 * t, X_3 + 0 * t
+
+
+DEFORMATIONS = {
+    'default': apply_deformation,
+    'twist': twist_deformation,
+    'none': no_deformation,
+}
+
+
+def deform_centers(centers, times, deformation=apply_deformation):
+    """
+    Deform all sphere centers at all times in one batched operation.
+
+    Args:
+        centers: (N, 3) array of original centers
+        times: (T,) array of time parameters
+        deformation: Deformation field, see apply_deformation
+
+    Returns:
+        (T, N, 3) array of deformed centers
+    """
+    X = np.asarray(centers, dtype=np.float64)[None]
+    t = np.asarray(times, dtype=np.float64)[:, None]
+    return np.stack(deformation(X[..., 0], X[..., 1], X[..., 2], t), axis=-1)
+
+
+def generate_centers(num_objects, layout='grid', extent=0.5, rng=None):
+    """
+    Sphere centers, shape (num_objects, 3).
+
+    'grid' fills a k x k x k lattice on [-extent, extent]^3 (k = ceil(num_objects^(1/3)))
+    in x-major order, so 8 objects give the cube corners. 'random' draws uniform centers.
+    """
+    if layout == 'grid':
+        k = math.ceil(round(num_objects ** (1 / 3), 9))
+        axis = np.linspace(-extent, extent, k) if k > 1 else np.zeros(1)
+        grid = np.stack(np.meshgrid(axis, axis, axis, indexing='ij'), axis=-1).reshape(-1, 3)
+        return grid[:num_objects]
+    if layout == 'random':
+        rng = np.random.default_rng() if rng is None else rng
+        return rng.uniform(-extent, extent, (num_objects, 3))
+    raise ValueError(f"Unknown layout {layout}")
+
+
+def generate_radii(num_objects, radius=0.15, distribution='constant', spread=0.0, rng=None):
+    """
+    Sphere radii, shape (num_objects,).
+
+    'constant' uses radius for all, 'uniform' draws from radius * [1 - spread, 1 + spread]
+    and 'lognormal' draws radius * exp(N(0, spread^2)).
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    if distribution == 'constant':
+        return np.full(num_objects, radius, dtype=np.float64)
+    if distribution == 'uniform':
+        return radius * rng.uniform(1 - spread, 1 + spread, num_objects)
+    if distribution == 'lognormal':
+        return radius * np.exp(rng.normal(0.0, spread, num_objects))
+    raise ValueError(f"Unknown radius distribution {distribution}")
+
+
+def _yaml_float(x):
+    # float formatting of yaml.dump (PyYAML's represent_float)
+    x = float(x)
+    if x != x:
+        return '.nan'
+    if x == math.inf:
+        return '.inf'
+    if x == -math.inf:
+        return '-.inf'
+    value = repr(x).lower()
+    if '.' not in value and 'e' in value:
+        value = value.replace('e', '.0e', 1)
+    return value
+
+
+def write_collection(f, centers, radii, rho=1.0):
+    """
+    Write an object_collection of spheres as YAML, one object at a time.
+
+    The output is identical to yaml.dump(collection, f, default_flow_style=False) of the
+    equivalent dictionary, without building it.
+
+    Args:
+        f: Text file to write to
+        centers: (N, 3) array of sphere centers
+        radii: (N,) array of sphere radii
+        rho: Density of the spheres
     """
-    Create an object_collection YAML structure from sphere centers.
-    
+    if len(centers) == 0:
+        f.write("objects: []\n")
+    else:
+        f.write("objects:\n")
+        rho = _yaml_float(rho)
+        for center, radius in zip(centers, radii):
+            x, y, z = (_yaml_float(c) for c in center)
+            f.write(f"- center:\n  - {x}\n  - {y}\n  - {z}\n"
+                    f"  radius: {_yaml_float(radius)}\n  rho: {rho}\n  type: sphere\n")
+    f.write("type: object_collection\n")
+
+
+def write_transforms(f, transforms, frames):
+    """
+    Write a transforms JSON with its frames streamed from an iterable.
+
+    The output is identical to json.dump(transforms, f, indent=2) with transforms['frames']
+    replaced by the frames, without holding them all in memory.
+    """
+    def indent(value, level):
+        return json.dumps(value, indent=2).replace('\n', '\n' + '  ' * level)
+
+    f.write("{")
+    for n, (key, value) in enumerate(transforms.items()):
+        f.write(("," if n else "") + f"\n  {json.dumps(key)}: ")
+        if key != 'frames':
+            f.write(indent(value, 1))
+            continue
+        empty = True
+        for frame in frames:
+            f.write(("[" if empty else ",") + "\n    " + indent(frame, 2))
+            empty = False
+        f.write("[]" if empty else "\n  ]")
+    f.write("\n}")
+
+
+_renderer = None
+
+
+def _init_worker():
+    """Create the renderer of a worker process."""
+    # imported where it is used, so that the geometry and writer helpers work without it
+    from xray_projection_render import XRayRenderer
+    global _renderer
+    _renderer = XRayRenderer()
+
+
+def render_setup(i, t, output_dir, full_view, cache_dir, name_width=2):
+    """
+    Render parameters of one timestep, without the input collection.
+
     Args:
-        sphere_centers: List of (x, y, z) tuples for sphere centers
-    
+        i: Timestep index
+        t: Time parameter (0 to 1)
+        output_dir: Output directory
+        full_view: Render 16 equispaced projections instead of 2
+        cache_dir: Directory the renderer writes the transforms of the timestep to
+        name_width: Digits of the timestep index in file names
+
     Returns:
-        Dictionary representing object_collection
+        (params, camera_angles)
     """
-    objects = []
-    for center in sphere_centers:
-        objects.append({
-            "center": list(center),
-            "radius": 0.15,
-            "rho": 1.0,
-            "type": "sphere"
-        })
-    
-    return {
-        "type": "object_collection",
-        "objects": objects
+    # Set up render parameters
+    params = {
+        'output_dir': str(output_dir / f"images_{i:0{name_width}d}"),
+        'fname_pattern': 'train_%02d.png',
+        'resolution': 500,
+        'R': 4.0,
+        'fov': 40.0,
+        'time_label': t,
+        'log_level': 'error',  # Quiet operation
     }
 
+    # Configure camera angles based on timestep
+    if full_view:
+        # 16 equispaced projections for the first and last timestep
+        params['num_images'] = 16
+        params['polar_angle'] = 90.0
+        camera_angles = None
+    else:
+        # 2 projections for intermediate timesteps
+        # Use 90° and 180° to match the equispaced sequence (first and 5th angles)
+        camera_angles = [
+            {'azimuthal': 90, 'polar': 90},
+            {'azimuthal': 180, 'polar': 90}
+        ]
+
+    # Always generate transforms file for all timesteps; kept in the cache so that
+    # unchanged timesteps can be aggregated without rendering them again
+    params['transforms_file'] = str(cache_dir / f"transforms_{i:0{name_width}d}.json")
+    return params, camera_angles
+
 
-def main():
+def render_timestep(i, t, centers, radii, config_file, params, camera_angles, name_width=2, renderer=None):
+    """
+    Render the projections of one timestep.
+
+    Args:
+        i: Timestep index
+        t: Time parameter (0 to 1)
+        centers: (N, 3) deformed sphere centers at t, ignored for t=0
+        radii: (N,) sphere radii
+        config_file: Path of the t=0 object collection
+        params: Render parameters from render_setup
+        camera_angles: Camera angles from render_setup
+        name_width: Digits of the timestep index in file names
+        renderer: XRayRenderer to use, defaults to the one of this worker process
+
+    Returns:
+        (i, success, elapsed) with the rendering time in seconds
+    """
+    renderer = renderer if renderer is not None else _renderer
+    tic = time.perf_counter()
+    success = False
+    log = [f"\nTimestep {i:0{name_width}d} (t={t:.2f})..."]
+
+    # Use the deformed configuration if t > 0
+    if t > 0:
+        # Create temporary file
+        temp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.yaml', delete=False)
+        write_collection(temp_file, centers, radii)
+        temp_file.close()
+        input_file = temp_file.name
+    else:
+        input_file = str(config_file)
+    params = {'input': input_file, **params}
+    transforms_file = Path(params['transforms_file'])
+
+    # Render projections
+    try:
+        if camera_angles is None:
+            result = renderer.render(params)
+        else:
+            result = renderer.render(params, camera_angles=camera_angles)
+
+        if result['success']:
+            log.append(f"  ✓ Rendered {result['num_images']} images")
+            success = transforms_file.exists()
+        else:
+            log.append(f"  ✗ Error: {result.get('error', 'Unknown error')}")
+    except Exception as e:
+        log.append(f"  ✗ Exception during rendering: {e}")
+
+    # Clean up temporary file if created
+    if t > 0 and Path(input_file).exists():
+        Path(input_file).unlink()
+
+    elapsed = time.perf_counter() - tic
+    if success:
+        log.append(f"  ✓ Timestep {i:0{name_width}d} took {elapsed:.2f} s")
+    else:
+        log.append(f"  ✗ Timestep {i:0{name_width}d} failed after {elapsed:.2f} s")
+    # print in one go so that output of concurrent workers does not interleave
+    print("\n".join(log), flush=True)
+    return i, success, elapsed
+
+
+MANIFEST_FILE = "render_manifest.json"
+CACHE_DIR = ".render_cache"
+# render parameters that only say where files go, not what is rendered
+_PATH_PARAMS = ('input', 'output_dir', 'transforms_file')
+
+
+def timestep_hash(i, centers, radii, params, camera_angles):
+    """Content hash of everything that determines the images of a timestep."""
+    h = hashlib.sha256(b"spheres-v1")
+    h.update(np.ascontiguousarray(centers, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(radii, dtype=np.float64).tobytes())
+    inputs = {
+        'timestep': i,
+        'params': {k: v for k, v in params.items() if k not in _PATH_PARAMS},
+        'camera_angles': camera_angles,
+    }
+    h.update(json.dumps(inputs, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def load_manifest(output_dir):
+    manifest_file = output_dir / MANIFEST_FILE
+    if manifest_file.exists():
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def save_manifest(output_dir, manifest):
+    # write-then-rename so an interrupted run never leaves a truncated manifest
+    tmp_file = output_dir / (MANIFEST_FILE + ".tmp")
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_file, output_dir / MANIFEST_FILE)
+
+
+def is_up_to_date(entry, digest, transforms_file, image_dir):
+    """Whether a timestep was rendered from the same inputs and its outputs are still there."""
+    if entry is None or entry.get('hash') != digest or not transforms_file.exists():
+        return False
+    with open(transforms_file, 'r') as f:
+        frames = json.load(f)['frames']
+    names = [Path(frame['file_path']).name for frame in frames] + ["eval_00.png"]
+    return all((image_dir / name).exists() for name in names)
+
+
+def timing_summary(timings, wall_time, workers, serial_times=()):
+    """
+    Lines reporting the rendering times of a run.
+
+    Args:
+        timings: Render time of every timestep rendered in this run
+        wall_time: Wall-clock time of the rendering loop
+        workers: Number of timesteps rendered concurrently
+        serial_times: Render times of timesteps rendered one at a time (--workers 1), from this or earlier runs
+
+    Returns:
+        List of lines to print
+    """
+    render_time = sum(timings.values())
+    lines = [
+        f"✓ Rendered {len(timings)} timesteps in {wall_time:.2f} s wall-clock with {workers} workers",
+        # summed over wall-clock time is the mean number of timesteps in flight; workers share
+        # the CPU, so this is not a speedup
+        f"  {render_time:.2f} s summed over timesteps, {render_time / max(wall_time, 1e-9):.2f} timesteps in flight on average",
+    ]
+    if workers > 1:
+        if len(serial_times):
+            serial_estimate = float(np.mean(serial_times)) * len(timings)
+            lines.append(f"  Speedup {serial_estimate / max(wall_time, 1e-9):.2f}x over an estimated serial time of "
+                         f"{serial_estimate:.2f} s ({len(serial_times)} timesteps rendered with --workers 1)")
+        else:
+            lines.append("  No serial render times in the manifest; render once with --workers 1 to measure the speedup")
+    return lines
+
+
+def main(
+    workers=1,
+    num_objects=8,
+    layout='grid',
+    radius=0.15,
+    radius_distribution='constant',
+    radius_spread=0.0,
+    num_timesteps=21,
+    deformation='default',
+    seed=0,
+    output_dir=None,
+    force=False,
+):
     # Setup and initialization
     print("Initializing renderer...")
+    from xray_projection_render import XRayRenderer
     try:
         renderer = XRayRenderer()
         print("✓ Successfully loaded the shared library")
@@ -72,246 +410,241 @@ def main():
         print("  cd xray_projection_render")
         print("  ./build.sh")
         sys.exit(1)
-    
+
+    assert num_timesteps >= 2, "Need at least the first and the last timestep"
+    last = num_timesteps - 1
+    width = max(2, len(str(last)))
+    times = np.arange(num_timesteps) * (1.0 / last)  # t=0 for i=0, t=1.0 for i=last
+
     # Define output directory
-    workspace_root = Path(__file__).parent.parent
-    output_dir = workspace_root / "data" / "synthetic" / "balls"
+    if output_dir is None:
+        workspace_root = Path(__file__).parent.parent
+        output_dir = workspace_root / "data" / "synthetic" / "balls"
+    output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
-    
+
     # Create image subdirectories
-    for i in range(21):
-        (output_dir / f"images_{i:02d}").mkdir(exist_ok=True)
-    
+    for i in range(num_timesteps):
+        (output_dir / f"images_{i:0{width}d}").mkdir(exist_ok=True)
+
     print(f"Output directory: {output_dir}")
-    
+
     # Generate initial configuration (t=0)
-    print("\nGenerating initial sphere configuration...")
-    sphere_coords = [
-        (-0.5, -0.5, -0.5), (-0.5, -0.5, 0.5),
-        (-0.5, 0.5, -0.5), (-0.5, 0.5, 0.5),
-        (0.5, -0.5, -0.5), (0.5, -0.5, 0.5),
-        (0.5, 0.5, -0.5), (0.5, 0.5, 0.5),
-    ]
-    
-    initial_collection = create_sphere_collection(sphere_coords)
+    print(f"\nGenerating initial configuration of {num_objects} spheres...")
+    rng = np.random.default_rng(seed)
+    original_centers = generate_centers(num_objects, layout, rng=rng)
+    radii = generate_radii(num_objects, radius, radius_distribution, radius_spread, rng=rng)
+
     config_file = output_dir / "balls.yaml"
     with open(config_file, 'w') as f:
-        yaml.dump(initial_collection, f, default_flow_style=False)
+        write_collection(f, original_centers, radii)
     print(f"✓ Saved initial config to {config_file}")
-    
+
     # Also save as balls_00.yaml for volume grid
-    balls_00_file = output_dir / "balls_00.yaml"
-    with open(balls_00_file, 'w') as f:
-        yaml.dump(initial_collection, f, default_flow_style=False)
+    balls_00_file = output_dir / f"balls_{0:0{width}d}.yaml"
+    shutil.copyfile(config_file, balls_00_file)
     print(f"✓ Saved initial config to {balls_00_file}")
-    
-    # Store original sphere centers for deformation
-    original_centers = sphere_coords.copy()
-    
-    # Rendering loop for all timesteps
+
+    # Deform all centers at all times at once
+    deformed = deform_centers(original_centers, times, DEFORMATIONS[deformation])
+
+    # Hash the render inputs of every timestep and skip the ones that did not change
+    cache_dir = output_dir / CACHE_DIR
+    cache_dir.mkdir(exist_ok=True)
+    manifest = {} if force else load_manifest(output_dir)
+    setups = {}
+    digests = {}
+    todo = []
+    for i in range(num_timesteps):
+        setups[i] = render_setup(i, float(times[i]), output_dir, i in (0, last), cache_dir, width)
+        centers = original_centers if i == 0 else deformed[i]
+        digests[i] = timestep_hash(i, centers, radii, *setups[i])
+        transforms_file = Path(setups[i][0]['transforms_file'])
+        if not is_up_to_date(manifest.get(str(i)), digests[i], transforms_file, output_dir / f"images_{i:0{width}d}"):
+            todo.append(i)
+    rendered = set(range(num_timesteps)) - set(todo)  # Timesteps with transforms for aggregation
+    print(f"\n{len(rendered)} timesteps unchanged, {len(todo)} to render")
+    # per-timestep times of earlier serial renders, the baseline of the speedup reported below
+    serial_times = [entry['render_time'] for entry in manifest.values() if entry.get('workers') == 1]
+    concurrent = min(workers, len(todo)) if workers > 1 and len(todo) > 1 else 1
+    # invalidate first, so that an interrupted run re-renders these timesteps
+    for i in todo:
+        manifest.pop(str(i), None)
+    save_manifest(output_dir, manifest)
+
+    # Rendering loop for invalidated timesteps
     print("\nStarting rendering loop...")
-    all_transforms = {}  # Store transforms for aggregation
-    final_collection = None  # Store final deformed state for balls_20.yaml
-    
-    for i in range(21):
-        t = i * 0.05  # t=0 for i=0, t=1.0 for i=20
-        print(f"\nTimestep {i:02d} (t={t:.2f})...")
-        
-        # Apply deformation if t > 0
-        if t > 0:
-            deformed_centers = [apply_deformation(X_1, X_2, X_3, t) 
-                              for X_1, X_2, X_3 in original_centers]
-            collection = create_sphere_collection(deformed_centers)
-            # Store final state for balls_20.yaml
-            if i == 20:
-                final_collection = collection
-            # Create temporary file
-            temp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.yaml', delete=False)
-            yaml.dump(collection, temp_file, default_flow_style=False)
-            temp_file.close()
-            input_file = temp_file.name
-        else:
-            input_file = str(config_file)
-        
-        # Set up render parameters
-        params = {
-            'input': input_file,
-            'output_dir': str(output_dir / f"images_{i:02d}"),
-            'fname_pattern': 'train_%02d.png',
-            'resolution': 500,
-            'R': 4.0,
-            'fov': 40.0,
-            'time_label': t,
-            'log_level': 'error',  # Quiet operation
-        }
-        
-        # Configure camera angles based on timestep
-        if i == 0 or i == 20:
-            # 16 equispaced projections for t=0 and t=1
-            params['num_images'] = 16
-            params['polar_angle'] = 90.0
-            camera_angles = None
-        else:
-            # 2 projections for intermediate timesteps
-            # Use 90° and 180° to match the equispaced sequence (first and 5th angles)
-            camera_angles = [
-                {'azimuthal': 90, 'polar': 90},
-                {'azimuthal': 180, 'polar': 90}
-            ]
-        
-        # Always generate transforms file for all timesteps
-        transforms_file = str(output_dir / f"transforms_{i:02d}.json")
-        params['transforms_file'] = transforms_file
-        
-        # Render projections
-        try:
-            if camera_angles is None:
-                result = renderer.render(params)
-            else:
-                result = renderer.render(params, camera_angles=camera_angles)
-            
-            if result['success']:
-                print(f"  ✓ Rendered {result['num_images']} images")
-                # Load transforms from generated file
-                if Path(transforms_file).exists():
-                    with open(transforms_file, 'r') as f:
-                        all_transforms[i] = json.load(f)
-            else:
-                print(f"  ✗ Error: {result.get('error', 'Unknown error')}")
-        except Exception as e:
-            print(f"  ✗ Exception during rendering: {e}")
-        
-        # Clean up temporary file if created
-        if t > 0 and Path(input_file).exists():
-            Path(input_file).unlink()
-    
-    # Create eval images (copy train_00.png to eval_00.png for each timestep)
-    print("\nCreating eval images...")
-    for i in range(21):
-        image_dir = output_dir / f"images_{i:02d}"
+    timings = {}
+
+    def _collect(i, success, elapsed):
+        timings[i] = elapsed
+        if not success:
+            return
+        rendered.add(i)
+        # Create eval image (copy train_00.png to eval_00.png)
+        image_dir = output_dir / f"images_{i:0{width}d}"
         train_00 = image_dir / "train_00.png"
-        eval_00 = image_dir / "eval_00.png"
-        
         if train_00.exists():
-            shutil.copy2(train_00, eval_00)
-            print(f"  ✓ Created {eval_00}")
-    
+            shutil.copy2(train_00, image_dir / "eval_00.png")
+        manifest[str(i)] = {'hash': digests[i], 'time': float(times[i]), 'render_time': elapsed, 'workers': concurrent}
+        save_manifest(output_dir, manifest)
+
+    def _args(i):
+        return (i, float(times[i]), deformed[i], radii, config_file, *setups[i], width)
+
+    tic = time.perf_counter()
+    if concurrent > 1:
+        # each worker process holds its own renderer
+        with ProcessPoolExecutor(concurrent, initializer=_init_worker) as pool:
+            futures = [pool.submit(render_timestep, *_args(i)) for i in todo]
+            for future in as_completed(futures):
+                _collect(*future.result())
+    else:
+        for i in todo:
+            _collect(*render_timestep(*_args(i), renderer=renderer))
+    wall_time = time.perf_counter() - tic
+
+    # Report timing
+    if timings:
+        print("\nRendering times:")
+        for i in sorted(timings):
+            print(f"  Timestep {i:0{width}d}: {timings[i]:.2f} s")
+        print("\n".join(timing_summary(timings, wall_time, concurrent, serial_times)))
+
     # Assemble transform files
     print("\nAssembling transform files...")
-    
-    # transforms_00.json - copy from timestep 0
-    if 0 in all_transforms:
-        transforms_00 = all_transforms[0].copy()
-        # Update file paths to include images_00/ prefix
-        for frame in transforms_00['frames']:
-            if not frame['file_path'].startswith('images_00/'):
-                frame['file_path'] = f"images_00/{Path(frame['file_path']).name}"
-        
-        # Add eval frame (copy of first frame)
-        if transforms_00['frames']:
-            eval_frame = transforms_00['frames'][0].copy()
-            eval_frame['file_path'] = 'images_00/eval_00.png'
-            transforms_00['frames'].append(eval_frame)
-        
-        transforms_00_file = output_dir / "transforms_00.json"
-        with open(transforms_00_file, 'w') as f:
-            json.dump(transforms_00, f, indent=2)
-        print(f"✓ Created {transforms_00_file}")
-    
-    # transforms_20.json - copy from timestep 20
-    if 20 in all_transforms:
-        transforms_20 = all_transforms[20].copy()
-        # Update file paths to include images_20/ prefix
-        for frame in transforms_20['frames']:
-            if not frame['file_path'].startswith('images_20/'):
-                frame['file_path'] = f"images_20/{Path(frame['file_path']).name}"
-        
+
+    # transforms_00.json and transforms_<last>.json with an eval frame (copy of the first frame)
+    for i in (0, last):
+        if i not in rendered:
+            continue
+        prefix = f"images_{i:0{width}d}/"
+        transforms_i_file = output_dir / f"transforms_{i:0{width}d}.json"
+        with open(setups[i][0]['transforms_file'], 'r') as f:
+            transforms_i = json.load(f)
+        # Update file paths to include images_XX/ prefix
+        for frame in transforms_i['frames']:
+            if not frame['file_path'].startswith(prefix):
+                frame['file_path'] = f"{prefix}{Path(frame['file_path']).name}"
+
         # Add eval frame (copy of first frame)
-        if transforms_20['frames']:
-            eval_frame = transforms_20['frames'][0].copy()
-            eval_frame['file_path'] = 'images_20/eval_00.png'
-            transforms_20['frames'].append(eval_frame)
-        
-        transforms_20_file = output_dir / "transforms_20.json"
-        with open(transforms_20_file, 'w') as f:
-            json.dump(transforms_20, f, indent=2)
-        print(f"✓ Created {transforms_20_file}")
-    
+        if transforms_i['frames']:
+            eval_frame = transforms_i['frames'][0].copy()
+            eval_frame['file_path'] = f"{prefix}eval_00.png"
+            transforms_i['frames'].append(eval_frame)
+
+        with open(transforms_i_file, 'w') as f:
+            json.dump(transforms_i, f, indent=2)
+        print(f"✓ Created {transforms_i_file}")
+
     # transforms.json - aggregate all timesteps
     print("Aggregating transforms from all timesteps...")
-    
-    if 0 not in all_transforms:
+
+    if 0 not in rendered:
         raise RuntimeError("No transforms file found for timestep 0. Cannot create aggregated transforms.")
-    
+
     # Copy the whole JSON from transforms_00.json as the base
-    aggregated_transforms = all_transforms[0].copy()
-    
-    # Update timestep 0 frames to ensure correct paths and time
-    for frame in aggregated_transforms['frames']:
-        if not frame['file_path'].startswith('images_00/'):
-            frame['file_path'] = f"images_00/{Path(frame['file_path']).name}"
-        frame['time'] = 0.0
-    
-    # Add eval frame for timestep 0
-    if aggregated_transforms['frames']:
-        eval_frame = aggregated_transforms['frames'][0].copy()
-        eval_frame['file_path'] = 'images_00/eval_00.png'
-        aggregated_transforms['frames'].append(eval_frame)
-    
-    # Extend frames with frames from all other timesteps
-    for i in range(1, 21):
-        t = i * 0.05
-        if i in all_transforms:
-            for frame in all_transforms[i]['frames']:
+    with open(output_dir / f"transforms_{0:0{width}d}.json", 'r') as f:
+        base_transforms = json.load(f)
+
+    num_frames = 0
+    index_builder = FrameIndexBuilder() if FrameIndexBuilder is not None else None
+
+    def aggregated_frames():
+        # Frames of all timesteps with paths relative to output_dir and time, each followed
+        # by an eval frame; loaded one timestep at a time
+        nonlocal num_frames
+        for i in sorted(rendered):
+            t = float(times[i])
+            prefix = f"images_{i:0{width}d}/"
+            if i == 0:
+                frames = base_transforms['frames']
+            elif i == last:
+                with open(output_dir / f"transforms_{i:0{width}d}.json", 'r') as f:
+                    frames = json.load(f)['frames']
+            else:
+                with open(setups[i][0]['transforms_file'], 'r') as f:
+                    frames = json.load(f)['frames']
+            for frame in frames:
                 # Ensure path is relative to output_dir
-                if not frame['file_path'].startswith(f'images_{i:02d}/'):
-                    frame['file_path'] = f"images_{i:02d}/{Path(frame['file_path']).name}"
+                if not frame['file_path'].startswith(prefix):
+                    frame['file_path'] = f"{prefix}{Path(frame['file_path']).name}"
                 frame['time'] = t
-                aggregated_transforms['frames'].append(frame)
-            
+                num_frames += 1
+                if index_builder is not None:
+                    index_builder.add(frame)
+                yield frame
+
             # Add eval frame for this timestep (copy of first frame)
-            if all_transforms[i]['frames']:
-                eval_frame = all_transforms[i]['frames'][0].copy()
-                eval_frame['file_path'] = f"images_{i:02d}/eval_00.png"
+            if frames:
+                eval_frame = frames[0].copy()
+                eval_frame['file_path'] = f"{prefix}eval_00.png"
                 eval_frame['time'] = t
-                aggregated_transforms['frames'].append(eval_frame)
-    
-    # Save aggregated transforms as transforms_00_to_20.json
-    transforms_file = output_dir / "transforms_00_to_20.json"
-    with open(transforms_file, 'w') as f:
-        json.dump(aggregated_transforms, f, indent=2)
-    print(f"✓ Created {transforms_file} with {len(aggregated_transforms['frames'])} frames")
-    
-    # Clean up intermediate transforms files (keep only 00, 20, and aggregated)
-    print("\nCleaning up intermediate transforms files...")
-    for i in range(21):
-        if i != 0 and i != 20:
-            transforms_file = output_dir / f"transforms_{i:02d}.json"
-            if transforms_file.exists():
-                transforms_file.unlink()
-                print(f"  ✓ Removed {transforms_file}")
-    
-    # Save final deformed state as balls_20.yaml
-    if final_collection is not None:
-        balls_20_file = output_dir / "balls_20.yaml"
-        with open(balls_20_file, 'w') as f:
-            yaml.dump(final_collection, f, default_flow_style=False)
-        print(f"✓ Saved final deformed state to {balls_20_file}")
+                num_frames += 1
+                if index_builder is not None:
+                    index_builder.add(eval_frame)
+                yield eval_frame
+
+    # Save aggregated transforms as transforms_00_to_<last>.json
+    aggregated_name = f"transforms_{0:0{width}d}_to_{last:0{width}d}.json"
+    # rebuilt from the cached per-timestep transforms, only if a timestep changed
+    transforms_file = output_dir / aggregated_name
+    if todo or not transforms_file.exists():
+        with open(transforms_file, 'w') as f:
+            write_transforms(f, base_transforms, aggregated_frames())
+        print(f"✓ Created {transforms_file} with {num_frames} frames")
+        if index_builder is not None:
+            # columnar companion index, so loaders do not have to parse the JSON
+            index_file = write_index(transforms_file, index_builder.build(base_transforms))
+            print(f"✓ Created {index_file}")
     else:
-        print("⚠ Warning: Final collection not saved. balls_20.yaml will not be created.")
-    
+        print(f"✓ {transforms_file} is up to date")
+
+    # Clean up intermediate transforms files left by earlier versions (keep only first, last, and aggregated)
+    print("\nCleaning up intermediate transforms files...")
+    for i in range(1, last):
+        transforms_file = output_dir / f"transforms_{i:0{width}d}.json"
+        if transforms_file.exists():
+            transforms_file.unlink()
+            print(f"  ✓ Removed {transforms_file}")
+
+    # Save final deformed state as balls_<last>.yaml
+    balls_last_file = output_dir / f"balls_{last:0{width}d}.yaml"
+    with open(balls_last_file, 'w') as f:
+        write_collection(f, deformed[last], radii)
+    print(f"✓ Saved final deformed state to {balls_last_file}")
+
     # Clean up object.json if it was generated
     object_json_file = output_dir / "object.json"
     if object_json_file.exists():
         object_json_file.unlink()
         print(f"✓ Removed {object_json_file}")
-    
+
     print("\n✓ Data generation complete!")
     print(f"  Output directory: {output_dir}")
     print(f"  Config file: {config_file}")
-    print(f"  Transform files: transforms_00.json, transforms_20.json, transforms_00_to_20.json")
-    print(f"  Volume grid files: balls_00.yaml, balls_20.yaml")
+    print(f"  Transform files: transforms_{0:0{width}d}.json, transforms_{last:0{width}d}.json, {aggregated_name}")
+    print(f"  Volume grid files: {balls_00_file.name}, {balls_last_file.name}")
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of timesteps rendered concurrently, each worker with its own renderer')
+    parser.add_argument('--num-objects', type=int, default=8, help='Number of spheres')
+    parser.add_argument('--layout', choices=['grid', 'random'], default='grid',
+                        help='Initial sphere centers: regular lattice or uniform random')
+    parser.add_argument('--radius', type=float, default=0.15, help='(Mean) sphere radius')
+    parser.add_argument('--radius-distribution', choices=['constant', 'uniform', 'lognormal'], default='constant')
+    parser.add_argument('--radius-spread', type=float, default=0.0,
+                        help='Relative half-width (uniform) or log-standard deviation (lognormal) of the radii')
+    parser.add_argument('--num-timesteps', type=int, default=21)
+    parser.add_argument('--deformation', choices=list(DEFORMATIONS), default='default')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for random layouts and radii')
+    parser.add_argument('--output-dir', type=Path, default=None,
+                        help='Defaults to data/synthetic/balls in the workspace root')
+    parser.add_argument('--force', action='store_true',
+                        help=f'Re-render all timesteps instead of only those whose inputs changed since the last run '
+                             f'(recorded in {MANIFEST_FILE})')
+    args = parser.parse_args()
+    main(**vars(args))
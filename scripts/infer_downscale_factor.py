@@ -1,20 +1,205 @@
 import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
 from pathlib import Path
-import cv2 as cv
+import re
+import struct
+import time
+from typing import Dict, List, Optional
+
+# Image sizes are read from the file headers only (PNG IHDR chunk, first TIFF IFD), so a
+# dataset of thousands of projections can be inspected without decoding any pixels. Other
+# formats fall back to a full decode with OpenCV.
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# samples per pixel of the PNG colour types
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+IMAGE_SUFFIXES = ('.png', '.tif', '.tiff')
+# timestep folders; downscaled copies (images_00_4) are skipped
+TIMESTEP_FOLDER = re.compile(r'^images(_\d+)?$')
+
+def read_png_header(f) -> dict:
+    head = f.read(29)
+    if len(head) < 29 or head[:8] != PNG_SIGNATURE or head[12:16] != b'IHDR':
+        raise ValueError('not a PNG file')
+    width, height, bit_depth, color_type = struct.unpack('>IIBB', head[16:26])
+    if color_type not in PNG_CHANNELS:
+        raise ValueError(f'invalid PNG colour type {color_type}')
+    return {'format': 'png', 'width': width, 'height': height, 'bit_depth': bit_depth,
+            'channels': PNG_CHANNELS[color_type]}
+
+def read_tiff_header(f) -> dict:
+    head = f.read(16)
+    if head[:2] not in (b'II', b'MM'):
+        raise ValueError('not a TIFF file')
+    bo = '<' if head[:2] == b'II' else '>'
+    magic, = struct.unpack(bo + 'H', head[2:4])
+    if magic == 42:
+        offset, = struct.unpack(bo + 'I', head[4:8])
+        count_fmt, entry_fmt, entry_size, inline = 'H', 'HHI4s', 12, 4
+    elif magic == 43:
+        # BigTIFF
+        offset, = struct.unpack(bo + 'Q', head[8:16])
+        count_fmt, entry_fmt, entry_size, inline = 'Q', 'HHQ8s', 20, 8
+    else:
+        raise ValueError(f'invalid TIFF magic {magic}')
+    f.seek(offset)
+    n, = struct.unpack(bo + count_fmt, f.read(struct.calcsize(count_fmt)))
+    entries = f.read(n * entry_size)
+    if len(entries) < n * entry_size:
+        raise ValueError('truncated TIFF directory')
+    # field type -> struct code of SHORT, LONG and LONG8
+    codes = {3: 'H', 4: 'I', 16: 'Q'}
+    tags = {}
+    for i in range(n):
+        tag, typ, count, value = struct.unpack(bo + entry_fmt, entries[i*entry_size:(i+1)*entry_size])
+        if tag not in (256, 257, 258, 277) or typ not in codes:
+            continue
+        size = struct.calcsize(codes[typ]) * count
+        if size > inline:
+            f.seek(struct.unpack(bo + ('I' if magic == 42 else 'Q'), value[:inline])[0])
+            value = f.read(size)
+        tags[tag] = struct.unpack(bo + codes[typ] * count, value[:size])
+    if 256 not in tags or 257 not in tags:
+        raise ValueError('TIFF without image size')
+    return {'format': 'tiff', 'width': tags[256][0], 'height': tags[257][0],
+            'bit_depth': tags.get(258, (1,))[0], 'channels': tags.get(277, (1,))[0]}
+
+def read_image_header(image_path) -> dict:
+    # format, width, height, bit depth and channels of a PNG or TIFF image
+    with open(image_path, 'rb') as f:
+        magic = f.read(4)
+        f.seek(0)
+        if magic == PNG_SIGNATURE[:4]:
+            return read_png_header(f)
+        if magic[:2] in (b'II', b'MM'):
+            return read_tiff_header(f)
+    raise ValueError('unsupported image format')
+
+def image_size(image_path: str):
+    # (width, height) from the header, decoding the image only for other formats
+    try:
+        info = read_image_header(image_path)
+        return info['width'], info['height']
+    except (ValueError, struct.error):
+        import cv2 as cv
+        image = cv.imread(str(image_path))
+        assert image is not None, f"Could not read image {image_path}."
+        height, width = image.shape[:2]
+        return width, height
+
+def downscale_factor(width: int, height: int, target_size: int) -> int:
+    return int(round(max(width, height) / target_size))
 
 def infer_downscale_factor(image_path: str, target_size: int) -> int:
     assert Path(image_path).is_file(), f"Image path {image_path} does not exist."
-    image = cv.imread(image_path)
-    height, width = image.shape[:2]
-    downscale_factor = max(width, height) / target_size
-    downscale_factor = int(round(downscale_factor))
-    return downscale_factor
+    width, height = image_size(image_path)
+    return downscale_factor(width, height, target_size)
+
+def _inspect_files(files: List[Path]) -> List[dict]:
+    out = []
+    for fn in files:
+        try:
+            info = read_image_header(fn)
+        except (OSError, ValueError, struct.error) as e:
+            info = {'error': str(e) or type(e).__name__}
+        info['file'] = fn.name
+        out.append(info)
+    return out
+
+def _signature(info: dict):
+    return (info['width'], info['height'], info['bit_depth'], info['channels'])
+
+def inspect_dataset(dataset: Path, target_size: int = 250, workers: Optional[int] = None, chunk: int = 256) -> dict:
+    """Header summary of all images_* folders of a dataset.
+
+    Frames whose resolution, bit depth or channel count differ from the dataset's most common
+    one, or whose header cannot be read, are listed under 'inconsistent'.
+    """
+    dataset = Path(dataset)
+    folders = sorted(d for d in dataset.iterdir() if d.is_dir() and TIMESTEP_FOLDER.match(d.name))
+    tasks = []
+    for folder in folders:
+        files = sorted(fn for fn in folder.iterdir() if fn.suffix.lower() in IMAGE_SUFFIXES)
+        tasks.extend((folder.name, files[i:i+chunk]) for i in range(0, len(files), chunk))
+        if not files:
+            tasks.append((folder.name, []))
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_inspect_files, [files for _, files in tasks])
+        frames: Dict[str, List[dict]] = {folder.name: [] for folder in folders}
+        for (name, _), infos in zip(tasks, results):
+            frames[name].extend(infos)
+
+    counts = Counter(_signature(info) for infos in frames.values() for info in infos if 'error' not in info)
+    reference = counts.most_common(1)[0][0] if counts else None
+    timesteps = {}
+    inconsistent = []
+    for name, infos in frames.items():
+        signatures = Counter(_signature(info) for info in infos if 'error' not in info)
+        timesteps[name] = {
+            'frames': len(infos),
+            'formats': sorted({info['format'] for info in infos if 'error' not in info}),
+            'resolutions': sorted({f'{w}x{h}' for w, h, _, _ in signatures}),
+            'bit_depths': sorted({b for _, _, b, _ in signatures}),
+        }
+        for info in infos:
+            if 'error' in info:
+                inconsistent.append({'file': f"{name}/{info['file']}", 'reason': info['error']})
+            elif _signature(info) != reference:
+                w, h, b, c = _signature(info)
+                inconsistent.append({'file': f"{name}/{info['file']}",
+                                     'reason': f'{w}x{h} {b}-bit {c}ch'})
+    frame_counts = Counter(t['frames'] for t in timesteps.values())
+    report = {
+        'dataset': str(dataset),
+        'timesteps': timesteps,
+        'frames': sum(t['frames'] for t in timesteps.values()),
+        'inconsistent': inconsistent,
+        'frame_count_mismatch': [name for name, t in timesteps.items()
+                                 if frame_counts and t['frames'] != frame_counts.most_common(1)[0][0]],
+    }
+    if reference is not None:
+        w, h, b, c = reference
+        report.update({'width': w, 'height': h, 'bit_depth': b, 'channels': c,
+                       'target_size': target_size, 'downscale_factor': downscale_factor(w, h, target_size)})
+    return report
+
+def print_report(report: dict):
+    print(f"Dataset {report['dataset']}: {len(report['timesteps'])} timesteps, {report['frames']} frames")
+    for name, t in report['timesteps'].items():
+        print(f"  {name:<12} {t['frames']:>6} frames  {', '.join(t['resolutions']) or '-':<12} "
+              f"{'/'.join(str(b) for b in t['bit_depths']) or '-'}-bit  {', '.join(t['formats'])}")
+    for name in report['frame_count_mismatch']:
+        print(f"  ! {name} has {report['timesteps'][name]['frames']} frames")
+    if report['inconsistent']:
+        print(f"  ! {len(report['inconsistent'])} inconsistent frames:")
+        for frame in report['inconsistent'][:20]:
+            print(f"      {frame['file']}: {frame['reason']}")
+        if len(report['inconsistent']) > 20:
+            print(f"      ... and {len(report['inconsistent']) - 20} more")
+    if 'downscale_factor' in report:
+        print(f"Resolution {report['width']}x{report['height']} {report['bit_depth']}-bit {report['channels']}ch, "
+              f"downscale factor {report['downscale_factor']} for target size {report['target_size']}")
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Infer downscale factor for an image.")
-    parser.add_argument("image_path", type=str, help="Path to the input image.")
+    parser = argparse.ArgumentParser(description="Infer downscale factor for an image, or inspect a dataset folder.")
+    parser.add_argument("image_path", type=str, help="Path to the input image, or to a dataset with images_* folders.")
     parser.add_argument("--target_size", type=int, default=250, help="Target size for the largest dimension.")
+    parser.add_argument("--workers", type=int, default=None, help="Threads reading headers (dataset mode).")
+    parser.add_argument("--json", type=str, default=None, help="Write the dataset report to this JSON file.")
     args = parser.parse_args()
 
-    factor = infer_downscale_factor(args.image_path, args.target_size)
-    print(factor)
\ No newline at end of file
+    if Path(args.image_path).is_dir():
+        tic = time.perf_counter()
+        report = inspect_dataset(Path(args.image_path), args.target_size, args.workers)
+        report['time'] = time.perf_counter() - tic
+        print_report(report)
+        print(f"Inspected in {report['time']:.3f} s")
+        if args.json is not None:
+            Path(args.json).write_text(json.dumps(report, indent=2))
+    else:
+        factor = infer_downscale_factor(args.image_path, args.target_size)
+        print(factor)
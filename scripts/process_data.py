@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Preprocess raw experimental X-CT projections into a dataset folder.
+
+Each tar.gz archive holds the TIFF projections of one timestep. Members are streamed out of
+the archive without extracting it, every step-th frame is kept (selected by the frame number
+in the file name, before any decoding) and the frame with the highest number becomes the eval
+frame, whatever the order of the archive members. Kept frames are windowed to
+[thresh-min, thresh-max] and written as PNG by a process pool. Scan metadata (.xtekct,
+.ctinfo.xml, _ctdata*.txt, .ang) from the archive is stored in the dataset folder with the
+timestep label (_ctdata.txt -> _ctdata-00.txt), metadata of the archive stored next to it
+(kel-cont-0.xtekct for kel-cont-0.tar.gz) is copied as is, and compute_transforms.py can be
+run on the result.
+
+Example:
+    python scripts/process_data.py raw/kel-cont-0.tar.gz raw/kel-cont-1.tar.gz \\
+        --output-dir data/experimental/kel_Q --thresh-min 27000 --thresh-max 59000 --step 28 \\
+        --compute-transforms --transforms-args "--deblurring Gauss --flat-field 0.89"
+"""
+
+import sys
+import re
+import glob
+import shlex
+import shutil
+import tarfile
+import subprocess
+import argparse
+import time
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import cv2 as cv
+
+TIFF_SUFFIXES = ('.tif', '.tiff')
+METADATA_PATTERNS = ('*.xtekct', '*.ctinfo.xml', '_ctdata*.txt', '*.ang')
+DTYPES = {'uint8': np.uint8, 'uint16': np.uint16}
+# default location of compute_transforms.py in the nerf_data submodule
+COMPUTE_TRANSFORMS = Path(__file__).resolve().parent.parent / "nerf_data" / "scripts" / "compute_transforms.py"
+
+
+def frame_number(name):
+    """Trailing number of a file name (kel-cont-0_0123.tif -> 123), or None."""
+    match = re.search(r'(\d+)$', Path(name).stem)
+    return int(match.group(1)) if match else None
+
+
+def archive_stem(archive):
+    """Name of an archive without its .tar.gz/.tgz suffix (kel-cont-0.tar.gz -> kel-cont-0)."""
+    name = Path(archive).name
+    for suffix in ('.tar.gz', '.tgz'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return Path(name).stem
+
+
+def is_metadata(name):
+    return any(Path(name).match(pattern) for pattern in METADATA_PATTERNS)
+
+
+def convert_frame(data, out_path, thresh_min=None, thresh_max=None, dtype='uint8'):
+    """
+    Decode a TIFF, window it to [thresh_min, thresh_max] and write it as PNG.
+
+    Args:
+        data: Encoded TIFF bytes
+        out_path: Output PNG path
+        thresh_min: Raw value mapped to 0, defaults to the minimum of the input dtype
+        thresh_max: Raw value mapped to the maximum output value, defaults to the maximum of the input dtype
+
+    Returns:
+        out_path
+    """
+    image = cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f"Could not decode {out_path.name}")
+    if image.ndim == 3:
+        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    if np.issubdtype(image.dtype, np.integer):
+        info = np.iinfo(image.dtype)
+        lo = info.min if thresh_min is None else thresh_min
+        hi = info.max if thresh_max is None else thresh_max
+    else:
+        lo = float(image.min()) if thresh_min is None else thresh_min
+        hi = float(image.max()) if thresh_max is None else thresh_max
+    out_max = np.iinfo(DTYPES[dtype]).max
+    scaled = (image.astype(np.float32) - lo) * (out_max / max(hi - lo, 1e-12))
+    out = np.rint(np.clip(scaled, 0, out_max)).astype(DTYPES[dtype])
+    if not cv.imwrite(str(out_path), out):
+        raise OSError(f"Could not write {out_path}")
+    return out_path
+
+
+def process_archive(archive, output_dir, label, step=28, offset=1, thresh_min=None, thresh_max=None,
+                    dtype='uint8', name_width=4, pool=None, max_pending=16):
+    """
+    Stream the projections of one timestep out of a tar.gz archive.
+
+    Args:
+        archive: Path of the .tar.gz archive
+        output_dir: Dataset folder; frames go to output_dir/images_<label>
+        label: Timestep label of the images folder
+        step: Keep every step-th frame
+        offset: Frame number of the first kept frame (modulo step)
+        name_width: Digits of the frame number in file names
+        pool: Executor converting the frames
+        max_pending: Maximum number of frames held in memory for conversion
+
+    Returns:
+        Dictionary with frame counts and the names of the copied metadata files
+    """
+    images_dir = output_dir / f"images_{label}"
+    images_dir.mkdir(parents=True, exist_ok=True)
+    pending = set()
+    metadata = []
+    num_frames = 0
+    num_kept = 0
+    # the eval frame has the highest frame number, which is only known at the end of the stream:
+    # the highest-numbered frame so far is held back, and released as a train frame (if selected)
+    # once a higher number arrives
+    held = None
+
+    def submit(data, name):
+        nonlocal pending
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+        pending.add(pool.submit(convert_frame, data, images_dir / name, thresh_min, thresh_max, dtype))
+
+    # 'r|gz' reads the archive as a stream: members are decompressed in order and never
+    # extracted to disk
+    with tarfile.open(archive, mode='r|gz') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = Path(member.name).name
+            if Path(name).suffix.lower() in TIFF_SUFFIXES:
+                number = frame_number(name)
+                number = num_frames if number is None else number
+                num_frames += 1
+                keep = (number - offset) % step == 0
+                if held is None or number > held[0]:
+                    held, released = (number, tar.extractfile(member).read(), keep), held
+                elif keep:
+                    released = (number, tar.extractfile(member).read(), keep)
+                else:
+                    released = None
+                if released is not None and released[2]:
+                    submit(released[1], f"train_{released[0]:0{name_width}d}.png")
+                    num_kept += 1
+            elif is_metadata(name):
+                # labelled, so that metadata of different timesteps does not collide
+                stem, _, suffixes = name.partition('.')
+                name = f"{stem}-{label}.{suffixes}"
+                (output_dir / name).write_bytes(tar.extractfile(member).read())
+                metadata.append(name)
+    if held is not None:
+        submit(held[1], f"eval_{held[0]:0{name_width}d}.png")
+    for future in pending:
+        future.result()
+    return {'frames': num_frames, 'train': num_kept, 'eval': int(held is not None), 'metadata': metadata}
+
+
+def copy_metadata(archive, output_dir):
+    """Copy the scan metadata files of an archive stored next to it (kel-cont-0.xtekct, kel-cont-0_ctdata.txt)."""
+    copied = []
+    stem = glob.escape(archive_stem(archive))
+    for pattern in METADATA_PATTERNS:
+        for fn in sorted(Path(archive).parent.glob(stem + pattern.lstrip('*'))):
+            if fn.is_file():
+                shutil.copy2(fn, output_dir / fn.name)
+                copied.append(fn.name)
+    return copied
+
+
+def main(archives, output_dir, labels=None, step=28, offset=1, thresh_min=None, thresh_max=None,
+         dtype='uint8', name_width=4, workers=4, compute_transforms=False, transforms_script=COMPUTE_TRANSFORMS,
+         transforms_args=''):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if labels is None:
+        labels = [f"{i:02d}" for i in range(len(archives))]
+    if len(labels) != len(archives):
+        raise ValueError(f"Got {len(labels)} labels for {len(archives)} archives")
+
+    tic = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for archive, label in zip(archives, labels):
+            print(f"\nProcessing {archive} -> images_{label}...", flush=True)
+            tic_archive = time.perf_counter()
+            result = process_archive(archive, output_dir, label, step, offset, thresh_min, thresh_max,
+                                     dtype, name_width, pool, max_pending=4 * workers)
+            copied = copy_metadata(archive, output_dir)
+            print(f"  ✓ Kept {result['train']} train + {result['eval']} eval of {result['frames']} frames "
+                  f"in {time.perf_counter() - tic_archive:.2f} s")
+            if result['metadata'] or copied:
+                print(f"  ✓ Copied metadata {', '.join(result['metadata'] + copied)}")
+
+            if compute_transforms:
+                cmd = [sys.executable, str(transforms_script),
+                       '--folder', str(output_dir),
+                       '--images-folder', f"images_{label}",
+                       '--output-fname', str(output_dir / f"transforms_{label}.json"),
+                       *shlex.split(transforms_args.format(label=label))]
+                print(f"  Running {' '.join(cmd)}", flush=True)
+                subprocess.run(cmd, check=True)
+                print(f"  ✓ Created transforms_{label}.json")
+    print(f"\n✓ Processed {len(archives)} archives in {time.perf_counter() - tic:.2f} s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('archives', type=Path, nargs='+', help='tar.gz archives of TIFF projections, one per timestep')
+    parser.add_argument('--output-dir', type=Path, required=True, help='Dataset folder')
+    parser.add_argument('--labels', nargs='+', default=None,
+                        help='Timestep labels of the images_<label> folders, defaults to 00, 01, ...')
+    parser.add_argument('--step', type=int, default=28, help='Keep every step-th frame')
+    parser.add_argument('--offset', type=int, default=1, help='Frame number of the first kept frame (modulo step)')
+    parser.add_argument('--thresh-min', type=float, default=None, help='Raw value mapped to black')
+    parser.add_argument('--thresh-max', type=float, default=None, help='Raw value mapped to white')
+    parser.add_argument('--dtype', choices=list(DTYPES), default='uint8', help='PNG bit depth')
+    parser.add_argument('--name-width', type=int, default=4, help='Digits of the frame number in file names')
+    parser.add_argument('--workers', type=int, default=4, help='Processes converting frames')
+    parser.add_argument('--compute-transforms', action='store_true',
+                        help='Run compute_transforms.py on each timestep')
+    parser.add_argument('--transforms-script', type=Path, default=COMPUTE_TRANSFORMS)
+    parser.add_argument('--transforms-args', type=str, default='',
+                        help='Extra arguments of compute_transforms.py; {label} is replaced by the timestep label')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+# the benchmark tools and scripts are run as plain scripts from their directories, which
+# import each other as top-level modules
+ROOT = Path(__file__).resolve().parent.parent
+for d in ('benchmark', 'scripts'):
+    if str(ROOT/d) not in sys.path:
+        sys.path.insert(0, str(ROOT/d))
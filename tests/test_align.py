@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import torch
+
+from align import AlignedObject, apply_alignment, find_alignment, rotation_matrix
+from lazy_grid import LazyVoxelGrid, lazy_voxel_grid
+
+BOUNDS = [(-1, 1)]*3
+# an asymmetric arrangement of blobs, so that the best rigid match is unique
+BLOBS = np.array([
+    [0.3, -0.2, 0.1, 0.25, 1.0],
+    [-0.35, 0.25, -0.15, 0.18, 0.8],
+    [0.05, 0.4, 0.35, 0.12, 0.6],
+])
+
+
+class Blobs:
+    # sum of gaussian blobs, evaluated at R^T (pos - t) for a rigidly moved copy
+    def __init__(self, rotation=np.eye(3), translation=np.zeros(3)) -> None:
+        self.rotation = torch.as_tensor(rotation, dtype=torch.float32)
+        self.translation = torch.as_tensor(translation, dtype=torch.float32)
+
+    def density(self, pos: torch.Tensor) -> torch.Tensor:
+        pos = (pos - self.translation) @ self.rotation
+        out = torch.zeros(pos.shape[:-1])
+        for x, y, z, r, v in BLOBS:
+            out += v * torch.exp(-((pos - torch.tensor([x, y, z], dtype=torch.float32))**2).sum(-1) / r**2)
+        return out
+
+
+def positions(n=2000, seed=0):
+    return torch.from_numpy(np.random.default_rng(seed).uniform(-0.7, 0.7, (n, 3))).float()
+
+
+def test_recovers_translation():
+    # obj is the reference moved by a shift that is not a whole number of voxels
+    shift = np.array([0.087, -0.052, 0.031])
+    ref, obj = Blobs(), Blobs(translation=shift)
+    transform = find_alignment(obj, ref, BOUNDS, resolution=48)
+    spacing = 2 / 47
+    assert transform.is_translation()
+    np.testing.assert_allclose(transform.translation, shift, atol=0.2*spacing)
+    assert transform.correlation_after > 0.99 > transform.correlation_before
+    aligned = apply_alignment(obj, transform)
+    assert isinstance(aligned, AlignedObject)
+    pos = positions()
+    np.testing.assert_allclose(aligned.density(pos), ref.density(pos), atol=0.02)
+
+
+def test_recovers_rotation():
+    angles = (0.0, 4.0, -6.0)
+    shift = np.array([0.04, 0.0, -0.06])
+    ref, obj = Blobs(), Blobs(rotation_matrix(angles), shift)
+    transform = find_alignment(obj, ref, BOUNDS, resolution=64, max_rotation=8, rotation_step=2)
+    np.testing.assert_allclose(transform.angles, angles)
+    # obj is evaluated at R (p + translation), the rotation being about the centre of the bounds
+    np.testing.assert_allclose(transform.rotation @ transform.translation, shift, atol=0.3*2/63)
+    pos = positions()
+    np.testing.assert_allclose(apply_alignment(obj, transform).density(pos), ref.density(pos), atol=0.03)
+
+
+def test_translated_grid_stays_a_grid():
+    # a shifted voxel grid is resampled directly, as the generic wrapper would evaluate it
+    z, y, x = np.meshgrid(*[np.linspace(-1, 1, 40)]*3, indexing='ij')
+    obj = lazy_voxel_grid(Blobs().density(torch.from_numpy(np.stack([x, y, z], -1)).float()).numpy())
+    transform = find_alignment(obj, Blobs(translation=[-0.1, 0.05, 0.0]), BOUNDS, resolution=40)
+    aligned = apply_alignment(obj, transform)
+    assert isinstance(aligned, LazyVoxelGrid)
+    pos = positions()
+    np.testing.assert_allclose(aligned.density(pos), AlignedObject(obj, transform).density(pos), atol=1e-5)
+    np.testing.assert_allclose(transform.translation, [0.1, -0.05, 0.0], atol=0.2*2/39)
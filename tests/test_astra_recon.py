@@ -0,0 +1,87 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+import astra_recon
+import perf_suite
+import projection_pyramid
+from frame_index import FrameFilter
+
+SPHERES = np.array([
+    [0.4, -0.1, 0.2, 0.2, 1.0],
+    [-0.3, 0.35, -0.25, 0.15, 1.0],
+    [0.05, -0.45, -0.4, 0.12, 1.0],
+])
+
+
+@pytest.fixture(scope='module')
+def jsonfile(tmp_path_factory):
+    return perf_suite.write_dataset(tmp_path_factory.mktemp('data'), SPHERES, n_projections=12, image_size=64)
+
+
+@pytest.mark.parametrize('image_downscale', [2, 4, 8])
+def test_reduced_decode_is_bilinear(jsonfile, image_downscale):
+    # the reduced-resolution decode gives the bilinear resize of the full image
+    im = cv.imread((jsonfile.parent/'images/train_0003.png').as_posix(), cv.IMREAD_GRAYSCALE)
+    expected = np.flipud(1 - cv.resize(im, None, fx=1/image_downscale, fy=1/image_downscale).astype(np.float32)/255)
+    np.testing.assert_array_equal(
+        astra_recon.load_image(jsonfile.parent, 'images/train_0003.png', image_downscale), expected
+    )
+
+
+@pytest.mark.parametrize('image_downscale', [1, 2, 3, 1.5])
+@pytest.mark.parametrize('downsampling', ['bilinear', 'area'])
+def test_loaders_agree(jsonfile, image_downscale, downsampling):
+    # the sinogram does not depend on the worker count or executor
+    filepaths = [f'images/train_{i:04d}.png' for i in range(12)]
+    serial = astra_recon.read_sinogram(jsonfile.parent, filepaths, image_downscale, 0, 'thread', downsampling)
+    rows = int(64/image_downscale)
+    assert serial.shape == (rows, 12, rows)
+    for executor in ('thread', 'process'):
+        np.testing.assert_array_equal(
+            astra_recon.read_sinogram(jsonfile.parent, filepaths, image_downscale, 2, executor, downsampling), serial
+        )
+    if downsampling == 'area':
+        full = projection_pyramid.attenuation(jsonfile.parent, filepaths[5])
+        np.testing.assert_allclose(serial[:, 5], projection_pyramid.area_downsample(full, image_downscale), atol=1e-6)
+
+
+def test_pyramid_only_for_area(jsonfile):
+    projection_pyramid.build_pyramid(jsonfile, max_factor=2)
+    train = FrameFilter('train')
+    area, _, _ = astra_recon.load_projections(jsonfile, train, 2, downsampling='area')
+    decoded, _, _ = astra_recon.load_projections(jsonfile, train, 2, pyramid=False, downsampling='area')
+    np.testing.assert_allclose(area, decoded, atol=1e-6)
+    # the default bilinear resampling ignores the area-averaged pyramid
+    bilinear, _, _ = astra_recon.load_projections(jsonfile, train, 2)
+    np.testing.assert_array_equal(bilinear, astra_recon.load_projections(jsonfile, train, 2, pyramid=False)[0])
+
+
+def test_fdk_residual_is_optional(jsonfile):
+    # in voxel units of a 16^3 volume, as astra_recon.main scales the geometry
+    proj_data, proj_geom, _ = astra_recon.load_projections(jsonfile, FrameFilter('train'), 2, 8.0)
+    vol_geom = astra_recon.cpu_recon.create_vol_geom(16, 16, 16)
+    # without fdk_residual there is no residual to log, rather than a nan
+    solver = astra_recon.create_solver('FDK_CPU', proj_data, proj_geom, vol_geom)
+    assert astra_recon.iterate(solver, 1, 1, 1e-3) == []
+    solver = astra_recon.create_solver('FDK_CPU', proj_data, proj_geom, vol_geom, fdk_residual=True)
+    residual = astra_recon.iterate(solver, 1, 1, 1e-3)
+    assert len(residual) == 1 and np.isfinite(residual[0])
+
+
+def test_cached_load_selects_frames_once(jsonfile, tmp_path, monkeypatch):
+    calls = []
+    select_frames = astra_recon.select_frames
+    monkeypatch.setattr(astra_recon, 'select_frames', lambda *args: calls.append(args) or select_frames(*args))
+    train = FrameFilter('train', 0, 12, 2)
+    expected, geom, names = astra_recon.load_projections(jsonfile, train, 2)
+    calls.clear()
+    # a cache miss indexes the frames once and stores the loaded sinogram
+    miss = astra_recon.load_projections_cached(tmp_path/'cache', jsonfile, train, 2, key_params={'istep': 2})
+    assert len(calls) == 1
+    hit = astra_recon.load_projections_cached(tmp_path/'cache', jsonfile, train, 2, key_params={'istep': 2})
+    assert len(calls) == 2
+    for proj_data, proj_geom, image_filenames in (miss, hit):
+        np.testing.assert_array_equal(proj_data, expected)
+        np.testing.assert_array_equal(proj_geom['ProjectionAngles'], geom['ProjectionAngles'])
+        assert list(image_filenames) == names
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+import torch
+
+import cpu_recon
+
+
+def cone_geometry(n_angles=24, n_det=24, spacing=1.5, dso=48.0, dod=48.0):
+    return {
+        'type': 'cone',
+        'DetectorSpacingX': spacing,
+        'DetectorSpacingY': spacing,
+        'DetectorRowCount': n_det,
+        'DetectorColCount': n_det,
+        'ProjectionAngles': np.linspace(0, 2*np.pi, n_angles, endpoint=False),
+        'DistanceOriginSource': dso,
+        'DistanceOriginDetector': dod,
+    }
+
+
+def astra_cone_vectors(proj_geom):
+    # astra.functions.geom_2vec for a 'cone' geometry, written out per angle
+    vectors = np.zeros((len(proj_geom['ProjectionAngles']), 12))
+    for i, angle in enumerate(proj_geom['ProjectionAngles']):
+        # source
+        vectors[i, 0] = np.sin(angle) * proj_geom['DistanceOriginSource']
+        vectors[i, 1] = -np.cos(angle) * proj_geom['DistanceOriginSource']
+        vectors[i, 2] = 0
+        # centre of the detector
+        vectors[i, 3] = -np.sin(angle) * proj_geom['DistanceOriginDetector']
+        vectors[i, 4] = np.cos(angle) * proj_geom['DistanceOriginDetector']
+        vectors[i, 5] = 0
+        # from detector pixel (0, 0) to (0, 1)
+        vectors[i, 6] = np.cos(angle) * proj_geom['DetectorSpacingX']
+        vectors[i, 7] = np.sin(angle) * proj_geom['DetectorSpacingX']
+        vectors[i, 8] = 0
+        # from detector pixel (0, 0) to (1, 0)
+        vectors[i, 9] = 0
+        vectors[i, 10] = 0
+        vectors[i, 11] = proj_geom['DetectorSpacingY']
+    return vectors
+
+
+def test_cone_vectors_match_astra():
+    proj_geom = cone_geometry(n_angles=7, spacing=1.3, dso=30.0, dod=20.0)
+    vectors = cpu_recon.cone_vectors(proj_geom)
+    np.testing.assert_allclose(vectors, astra_cone_vectors(proj_geom), atol=1e-12)
+    vec_geom = cpu_recon.cone_vec_geom(proj_geom)
+    np.testing.assert_array_equal(cpu_recon.cone_vectors(vec_geom), vectors)
+    try:
+        import astra
+    except ImportError:
+        return
+    np.testing.assert_allclose(vectors, astra.geom_2vec(proj_geom)['Vectors'], atol=1e-12)
+
+
+def test_forward_projection_of_central_ray():
+    # the central ray of every projection crosses a centred cube of ones perpendicular to a face
+    n = 16
+    A = cpu_recon.ConeBeamProjector(cone_geometry(n_angles=4, n_det=25), cpu_recon.create_vol_geom(n, n, n))
+    vol = torch.zeros(A.vol_shape)
+    vol[4:12, 4:12, 4:12] = 1
+    sino = A.forward(vol)
+    np.testing.assert_allclose(sino[12, :, 12], 8, rtol=1e-3)
+
+
+@pytest.mark.parametrize('max_samples', [1 << 24, 4096])
+def test_backward_is_adjoint(max_samples):
+    # <A x, y> = <x, A^T y> for random x and y, also when the rays are split into many batches
+    A = cpu_recon.ConeBeamProjector(cone_geometry(), cpu_recon.create_vol_geom(16, 16, 16), max_samples=max_samples)
+    rng = np.random.default_rng(0)
+    x = torch.from_numpy(rng.random(A.vol_shape, dtype=np.float32))
+    y = torch.from_numpy(rng.random(A.sino_shape, dtype=np.float32))
+    lhs = float((A.forward(x).double() * y.double()).sum())
+    rhs = float((x.double() * A.backward(y).double()).sum())
+    assert lhs == pytest.approx(rhs, rel=1e-4)
+
+
+@pytest.mark.parametrize('algorithm', ['SIRT3D_CPU', 'CGLS3D_CPU'])
+def test_iterative_residual_decreases(algorithm):
+    proj_geom, vol_geom = cone_geometry(), cpu_recon.create_vol_geom(16, 16, 16)
+    A = cpu_recon.ConeBeamProjector(proj_geom, vol_geom)
+    phantom = torch.zeros(A.vol_shape)
+    phantom[4:12, 5:11, 3:9] = 1
+    proj_data = A.forward(phantom).numpy()
+    solver = cpu_recon.create_solver(algorithm, proj_data, proj_geom, vol_geom)
+    residuals = [np.linalg.norm(proj_data)]
+    for _ in range(5):
+        solver.run(2)
+        residuals.append(solver.res_norm())
+    assert np.all(np.diff(residuals) < 0)
+    assert residuals[-1] < 0.2*residuals[0]
+    # the residual norm is that of the current volume
+    assert residuals[-1] == pytest.approx(float(np.linalg.norm(proj_data - A.forward(torch.from_numpy(solver.get())).numpy())), rel=1e-3)
+
+
+def test_fdk_reconstructs_ball():
+    # FDK of the projections of a ball of ones: about one inside and zero outside, away from its edge
+    n = 32
+    proj_geom, vol_geom = cone_geometry(n_angles=96, n_det=48, spacing=1.5, dso=96.0, dod=96.0), cpu_recon.create_vol_geom(n, n, n)
+    z, y, x = np.meshgrid(*[np.arange(n) + 0.5 - n/2]*3, indexing='ij')
+    r = np.sqrt((x - 2)**2 + (y + 1)**2 + z**2)
+    A = cpu_recon.ConeBeamProjector(proj_geom, vol_geom)
+    rec = cpu_recon.fdk(A.forward(torch.from_numpy((r <= 9).astype(np.float32))).numpy(), proj_geom, vol_geom)
+    assert rec[r < 7].mean() == pytest.approx(1, abs=0.06)
+    assert abs(rec[(r > 11) & (r < 15)].mean()) < 0.02
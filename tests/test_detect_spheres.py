@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+import yaml
+
+from detect_spheres import detect_spheres, fit_spheres, load_volume, match_spheres, read_reference
+
+# spheres as centre xyz, radius and density in the normalized [-1, 1] coordinates of balls_XX.yaml,
+# placed asymmetrically so that a swapped or flipped axis moves them
+SPHERES = np.array([
+    [0.4, -0.1, 0.2, 0.2, 1.0],
+    [-0.3, 0.35, -0.25, 0.15, 1.0],
+    [0.05, -0.45, -0.4, 0.12, 1.0],
+])
+
+
+def voxelize(spheres, shape):
+    # XYZ volume sampled at voxel centres, as vol.npz is laid out
+    axes = [(np.arange(n) + 0.5) / n * 2 - 1 for n in shape]
+    x, y, z = np.meshgrid(*axes, indexing='ij')
+    vol = np.zeros(shape, dtype=np.float32)
+    for cx, cy, cz, r, rho in spheres:
+        vol[(x - cx)**2 + (y - cy)**2 + (z - cz)**2 <= r*r] += rho
+    return vol
+
+
+def write_reference(path, spheres):
+    objects = [
+        {'center': [float(c) for c in s[:3]], 'radius': float(s[3]), 'rho': float(s[4]), 'type': 'sphere'}
+        for s in spheres
+    ]
+    path.write_text(yaml.dump({'objects': objects, 'type': 'object_collection'}, default_flow_style=False))
+    return path
+
+
+def test_fit_spheres_recovers_voxel_spheres():
+    shape = (40, 40, 40)
+    labels = np.zeros(shape, dtype=np.int32)
+    x, y, z = np.meshgrid(*[np.arange(n) for n in shape], indexing='ij')
+    truth = [((12.3, 20.0, 25.6), 7.5), ((28.0, 11.4, 13.0), 5.2)]
+    for k, (c, r) in enumerate(truth):
+        labels[(x - c[0])**2 + (y - c[1])**2 + (z - c[2])**2 <= r*r] = k + 1
+    centers, radii, residuals = fit_spheres(labels, len(truth))
+    for (c, r), fc, fr in zip(truth, centers, radii):
+        np.testing.assert_allclose(fc, c, atol=0.2)
+        assert fr == pytest.approx(r, abs=0.5)
+    assert np.all(residuals < 0.6)
+
+
+def test_detect_spheres_normalized_coordinates(tmp_path):
+    vol = voxelize(SPHERES, (64, 64, 64))
+    spheres, threshold = detect_spheres(vol)
+    assert len(spheres) == len(SPHERES)
+    summary = match_spheres(spheres, *read_reference(write_reference(tmp_path/'balls_00.yaml', SPHERES)), 0.1)
+    assert summary['n_matched'] == len(SPHERES)
+    assert summary['max_center_error'] < 0.02
+    assert summary['max_radius_error'] < 0.02
+
+
+def test_touching_spheres_and_small_components():
+    vol = voxelize(np.array([[0.0, 0.0, 0.0, 0.3, 1.0], [0.55, 0.0, 0.0, 0.3, 1.0], [-0.7, -0.7, -0.7, 0.03, 1.0]]), (48, 48, 48))
+    spheres, _ = detect_spheres(vol, threshold=0.5)
+    # the touching pair is one component and the speck is below min_voxels
+    assert len(spheres) == 1
+
+
+def test_reconstruction_matches_reference_axes(tmp_path):
+    # end to end: projections of known spheres in the transforms convention, reconstructed by
+    # astra_recon and measured by detect_spheres, come out in balls_XX.yaml coordinates
+    import astra_recon
+    import perf_suite
+    jsonfile = perf_suite.write_dataset(tmp_path/'data', SPHERES, n_projections=60, image_size=64)
+    out = tmp_path/'out'
+    astra_recon.main(jsonfile, out, resolution=48, algorithm='FDK_CPU', preview_every=0)
+    vol = load_volume(out/'vol.chunks')
+    spheres, _ = detect_spheres(vol)
+    summary = match_spheres(spheres, *read_reference(write_reference(tmp_path/'balls_00.yaml', SPHERES)), 0.1)
+    assert summary['n_matched'] == len(SPHERES)
+    assert summary['max_center_error'] < 0.02
+
+
+def slice_circles(center, radius, position, shape):
+    # exact circles of a sphere (voxel units) in the slices at position, in the pixel coordinates
+    # of the images sphere_gui shows (SliceDetector.slice flips the rows)
+    nx, ny, nz = shape
+    cx, cy, cz = center
+    circles = {}
+    for k, i, (p0, p1) in [('x', position['x'], (cy, nz - 1 - cz)),
+                           ('y', position['y'], (cx, nz - 1 - cz)),
+                           ('z', position['z'], (cx, ny - 1 - cy))]:
+        r = np.sqrt(radius**2 - (i - center['xyz'.index(k)])**2)
+        circles[k] = np.array([[[p0, p1, r]]])
+    return circles
+
+
+def test_sphere_gui_fit_matches_detect_spheres():
+    # both tools report a sphere in the same normalized coordinates
+    from sphere_gui import SliceDetector, detect_circles, fit_sphere
+    shape = (96, 96, 96)
+    # spheres large enough for a stable Hough transform
+    for sphere in np.array([[0.2, -0.15, 0.1, 0.35, 1.0], [-0.3, 0.25, -0.2, 0.3, 1.0]]):
+        vol = voxelize(sphere[None], shape)
+        (detected,), _ = detect_spheres(vol)
+        position = {k: int(round(c)) for k, c in zip('xyz', detected['center_voxels'])}
+        # exact circles give the sphere centre
+        fit = fit_sphere(slice_circles(detected['center_voxels'], detected['radius_voxels'], position, shape),
+                         position, shape)
+        np.testing.assert_allclose(fit['center'], detected['center'], atol=1e-9)
+        assert fit['radius'] == pytest.approx(detected['radius'])
+        np.testing.assert_allclose(fit['center'], sphere[:3], atol=2/96)
+        # and so do the circles sphere_gui detects, to the accuracy of the Hough transform
+        detector = SliceDetector((vol*255).astype(np.uint8))
+        try:
+            circles = {k: detect_circles(detector.slice(k, i)) for k, i in position.items()}
+        finally:
+            detector.close()
+        fit = fit_sphere(circles, position, shape)
+        np.testing.assert_allclose(fit['center'], detected['center'], atol=2/96)
+        assert fit['radius'] == pytest.approx(detected['radius'], abs=2/96)
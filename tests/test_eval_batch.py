@@ -0,0 +1,69 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import eval_batch
+from eval_loss import DTYPES, eval_grid, evaluate, load_obj
+
+SHAPE = (12, 10, 14)
+
+
+@pytest.fixture
+def sequence(tmp_path):
+    # three uint16 reconstructions of one timestep each and a shared reference, as vol_zyx.raw files
+    rng = np.random.default_rng(0)
+    ref = rng.integers(0, 1000, SHAPE[::-1]).astype(np.uint16)
+    ref.tofile(tmp_path/'ref.raw')
+    for t in range(3):
+        d = tmp_path/f'recon_{t:02d}'
+        d.mkdir()
+        obj = np.clip(ref + rng.normal(0, 50*(t + 1), ref.shape), 0, 1000).astype(np.uint16)
+        obj.tofile(d/'vol_zyx.raw')
+    return tmp_path
+
+
+def expected_metrics(obj_path, ref_path, out_dir):
+    obj = load_obj(obj_path, SHAPE, DTYPES.UINT16)
+    ref = load_obj(ref_path, SHAPE, DTYPES.UINT16)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    return evaluate(obj, ref, eval_grid(9), out_dir)
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_batch_matches_single_evaluations(sequence, workers, monkeypatch):
+    loads = []
+    load = eval_batch.load_obj
+    monkeypatch.setattr(eval_batch, 'load_obj', lambda path, *args: loads.append(path) or load(path, *args))
+    out = sequence/'out'
+    eval_batch.main(
+        obj_glob=str(sequence/'recon_*'/'vol_zyx.raw'), ref_glob=str(sequence/'ref.raw'), out_dir=out,
+        eval_resolution=9, obj_resolution=SHAPE, obj_dtype=DTYPES.UINT16,
+        ref_resolution=SHAPE, ref_dtype=DTYPES.UINT16, workers=workers
+    )
+    # the shared reference is loaded once, in this process
+    assert loads.count(sequence/'ref.raw') == 1
+    table = pd.read_csv(out/'eval_batch.csv')
+    assert table['name'].tolist() == [f'{t:02d}_recon_{t:02d}' for t in range(3)]
+    summary = json.loads((out/'eval_batch.json').read_text())
+    assert summary['workers'] == workers and len(summary['pairs']) == 3
+    for row in summary['pairs']:
+        expected = expected_metrics(sequence/row['name'][3:]/'vol_zyx.raw', sequence/'ref.raw', sequence/'single')
+        assert {k: row[k] for k in expected} == pytest.approx(expected)
+        assert row['load_time'] >= 0 and row['eval_time'] > 0
+        assert json.loads((out/row['name']/'eval_loss.json').read_text()) == pytest.approx(expected)
+    # noisier reconstructions score worse
+    assert table['volumetric_loss'].is_monotonic_increasing
+
+
+def test_read_manifest_resolves_relative_paths(tmp_path):
+    pd.DataFrame({'obj_path': ['a/vol_zyx.raw', 'b/vol_zyx.raw'], 'ref_path': ['ref.raw']*2, 'name': ['t0', None]}) \
+        .to_csv(tmp_path/'pairs.csv', index=False)
+    (tmp_path/'pairs.json').write_text(json.dumps([{'obj_path': 'a/vol_zyx.raw', 'ref_path': 'ref.raw'}]))
+    pairs = eval_batch.read_manifest(tmp_path/'pairs.csv')
+    assert [p['obj_path'] for p in pairs] == [tmp_path/'a/vol_zyx.raw', tmp_path/'b/vol_zyx.raw']
+    assert pairs[0]['name'] == 't0'
+    assert eval_batch.read_manifest(tmp_path/'pairs.json')[0]['ref_path'] == tmp_path/'ref.raw'
+    with pytest.raises(ValueError):
+        eval_batch.read_manifest(tmp_path/'pairs.txt')
@@ -0,0 +1,122 @@
+import json
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+import eval_loss
+import lazy_grid
+from eval_loss import DTYPES, dense_eval, eval_grid, evaluate, sampled_eval
+from lazy_grid import LazyVoxelGrid, as_grid, lazy_voxel_grid
+
+
+class StubVoxelGrid:
+    # stands in for nerf_xray's VoxelGrid: rho (ZYX) sampled with grid_sample(align_corners=True)
+    def __init__(self, rho: torch.Tensor) -> None:
+        self.rho = rho
+
+    def density(self, pos: torch.Tensor) -> torch.Tensor:
+        return F.grid_sample(self.rho[None, None].to(pos.dtype), pos.view(1, -1, 1, 1, 3), align_corners=True).flatten()
+
+
+def volumes(shape=(20, 18, 22), seed=0):
+    # a reconstruction-like pair of ZYX volumes: a smooth blob and a noisy, slightly scaled copy
+    rng = np.random.default_rng(seed)
+    z, y, x = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+    ref = np.exp(-((x - 0.2)**2 + (y + 0.1)**2 + z**2) / 0.2)
+    obj = 0.9*ref + rng.normal(0, 0.05, shape)
+    return obj, ref
+
+
+@pytest.fixture
+def stub_voxel_grid(monkeypatch):
+    monkeypatch.setattr(lazy_grid, 'VoxelGrid', StubVoxelGrid)
+    return StubVoxelGrid
+
+
+@pytest.mark.parametrize('eval_resolution, extent', [
+    (22, None),
+    (31, None),
+    (17, [(-0.8, 0.9), (-1.1, 1.0), (-0.5, 0.5)]),
+])
+def test_grid_fast_path_matches_dense(tmp_path, stub_voxel_grid, eval_resolution, extent):
+    obj, ref = volumes()
+    obj, ref = stub_voxel_grid(torch.from_numpy(obj)), stub_voxel_grid(torch.from_numpy(ref))
+    # the stub is recognised as a voxel grid, so evaluate resamples it separably
+    assert isinstance(as_grid(obj), LazyVoxelGrid)
+    grid = eval_grid(eval_resolution, extent)
+    expected = dense_eval(obj, ref, *grid, tmp_path)
+    for block_slices in (16, 5):
+        out = evaluate(obj, ref, grid, tmp_path, block_slices=block_slices)
+        assert out == pytest.approx(expected, rel=1e-5)
+    # both voxel grids: block-wise by default
+    assert evaluate(obj, ref, grid, tmp_path) == pytest.approx(expected, rel=1e-5)
+    assert evaluate(obj, ref, grid, tmp_path, block_slices=16, grid_fast_path=False) == pytest.approx(expected, rel=1e-5)
+
+
+def test_lazy_grid_fast_path_matches_dense(tmp_path):
+    # memory-mapped style uint16 volumes through lazy_voxel_grid, as load_obj opens .raw files
+    obj, ref = volumes(seed=1)
+    obj = lazy_voxel_grid((np.clip(obj, 0, None)*1000).astype(np.uint16))
+    ref = lazy_voxel_grid((ref*1000).astype(np.uint16))
+    grid = eval_grid(25)
+    expected = dense_eval(obj, ref, *grid, tmp_path)
+    assert evaluate(obj, ref, grid, tmp_path, block_slices=16) == pytest.approx(expected, rel=1e-5)
+
+
+def test_mismatched_stub_is_not_a_grid(stub_voxel_grid):
+    # an object whose density disagrees with the VoxelGrid convention stays on the generic path
+    class Flipped(stub_voxel_grid):
+        def density(self, pos):
+            return super().density(-pos)
+    obj, _ = volumes()
+    assert as_grid(Flipped(torch.from_numpy(obj))) is None
+
+
+@pytest.fixture
+def lazy_pair():
+    obj, ref = volumes(seed=1)
+    return lazy_voxel_grid((np.clip(obj, 0, None)*1000).astype(np.uint16)), lazy_voxel_grid((ref*1000).astype(np.uint16))
+
+
+def test_sampled_eval_estimates_dense_metrics(tmp_path, lazy_pair):
+    obj, ref = lazy_pair
+    dense = dense_eval(obj, ref, *eval_grid(64), tmp_path)
+    bounds = [(-1, 1)]*3
+    small = sampled_eval(obj, ref, bounds, 5000, seed=0)
+    large = sampled_eval(obj, ref, bounds, 20000, seed=0)
+    for sampling in ('random', 'stratified'):
+        out = sampled_eval(obj, ref, bounds, 20000, sampling, seed=1)
+        assert out['n_samples'] == 20000 and out['confidence'] == 0.95
+        assert out['volumetric_loss'] == pytest.approx(dense['volumetric_loss'], rel=0.05)
+        assert out['normed_correlation'] == pytest.approx(dense['normed_correlation'], abs=0.005)
+        for k in ('volumetric_loss', 'scaled_volumetric_loss', 'normed_correlation'):
+            lo, hi = out[f'{k}_ci']
+            assert lo <= out[k] <= hi
+    # four times the points about halve the confidence interval
+    width = lambda out: out['volumetric_loss_ci'][1] - out['volumetric_loss_ci'][0]
+    assert 0.35 < width(large) / width(small) < 0.7
+    # the estimate is reproducible with a seed
+    assert sampled_eval(obj, ref, bounds, 5000, seed=0) == small
+
+
+def test_sampled_eval_time_budget(lazy_pair):
+    # a budget that is already spent stops after the first batch
+    out = sampled_eval(*lazy_pair, [(-1, 1)]*3, 4000, time_budget=0.0, batch_size=1000, seed=0)
+    assert out['n_samples'] == 1000
+
+
+def test_main_sampled_mode(tmp_path, lazy_pair):
+    # eval_loss.main with n_samples writes the sampled metrics and their intervals
+    obj, ref = lazy_pair
+    np.asarray(obj.rho).tofile(tmp_path/'obj.raw')
+    np.asarray(ref.rho).tofile(tmp_path/'ref.raw')
+    shape = obj.rho.shape[::-1]
+    eval_loss.main(tmp_path/'obj.raw', tmp_path/'ref.raw', tmp_path, obj_resolution=shape, obj_dtype=DTYPES.UINT16,
+                   ref_resolution=shape, ref_dtype=DTYPES.UINT16, n_samples=3000, n_bootstrap=50, seed=0)
+    out = json.loads((tmp_path/'eval_loss.json').read_text())
+    expected = sampled_eval(obj, ref, [(-1, 1)]*3, 3000, n_bootstrap=50, seed=0)
+    assert out['n_samples'] == 3000
+    assert out['volumetric_loss'] == pytest.approx(expected['volumetric_loss'])
+    assert out['normed_correlation_ci'] == pytest.approx(list(expected['normed_correlation_ci']))
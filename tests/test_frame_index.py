@@ -0,0 +1,85 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from frame_index import FrameFilter, FrameIndex, FrameIndexBuilder, filter_frames, index_path, load_index, write_index
+
+
+def make_transforms(n=12):
+    rng = np.random.default_rng(0)
+    frames = []
+    for i in range(n):
+        split = 'eval' if i % 5 == 4 else 'train'
+        frame = {'file_path': f'images_00/{split}_{i:02d}.png', 'transform_matrix': rng.random((4, 4)).tolist()}
+        if i % 3:
+            frame['time'] = i / n
+        frames.append(frame)
+    # out of order, as aggregated transforms can be
+    frames = frames[6:] + frames[:6]
+    return {'fl_x': 100.0, 'fl_y': 100.0, 'w': 64, 'h': 64, 'frames': frames}
+
+
+@pytest.fixture
+def jsonfile(tmp_path):
+    path = tmp_path/'transforms_00.json'
+    path.write_text(json.dumps(make_transforms(), indent=2))
+    return path
+
+
+def test_index_matches_json(jsonfile):
+    transforms = json.loads(jsonfile.read_text())
+    index = FrameIndex.from_json(jsonfile)
+    frames = transforms['frames']
+    assert len(index) == len(frames)
+    assert index.meta == {k: v for k, v in transforms.items() if k != 'frames'}
+    assert index.file_path.tolist() == [f['file_path'] for f in frames]
+    np.testing.assert_array_equal(index.poses, [f['transform_matrix'] for f in frames])
+    np.testing.assert_array_equal(index.time, [f.get('time', np.nan) for f in frames])
+    assert list(index.frames()) == frames
+
+
+@pytest.mark.parametrize('filter_name', [
+    FrameFilter(),
+    FrameFilter('eval'),
+    FrameFilter('train', imin=2, imax=9, istep=3),
+])
+def test_filter_matches_stem_predicate(jsonfile, filter_name):
+    frames = json.loads(jsonfile.read_text())['frames']
+    expected = sorted(f['file_path'] for f in frames if filter_name(Path(f['file_path']).stem))
+    index = FrameIndex.from_json(jsonfile)
+    assert filter_frames(index, filter_name).file_path.tolist() == expected
+    # a plain callable takes the per-stem path
+    assert filter_frames(index, lambda stem: filter_name(stem)).file_path.tolist() == expected
+
+
+def test_load_index_stores_and_reuses(jsonfile, monkeypatch):
+    index = load_index(jsonfile)
+    assert index_path(jsonfile).exists()
+    # a current index is read without parsing the JSON
+    monkeypatch.setattr(FrameIndex, 'from_json', classmethod(lambda cls, path: pytest.fail('JSON parsed')))
+    cached = load_index(jsonfile)
+    assert cached.file_path.tolist() == index.file_path.tolist()
+    np.testing.assert_array_equal(cached.poses, index.poses)
+
+
+def test_load_index_rebuilds_stale(jsonfile):
+    load_index(jsonfile)
+    transforms = make_transforms(7)
+    jsonfile.write_text(json.dumps(transforms))
+    os.utime(jsonfile, ns=(0, 0))
+    assert len(load_index(jsonfile)) == 7
+
+
+def test_builder_matches_from_json(jsonfile):
+    transforms = json.loads(jsonfile.read_text())
+    builder = FrameIndexBuilder()
+    for frame in transforms['frames']:
+        builder.add(frame)
+    write_index(jsonfile, builder.build(transforms))
+    index = load_index(jsonfile)
+    expected = FrameIndex.from_json(jsonfile)
+    for column in ('file_path', 'stem', 'split', 'frame_number'):
+        assert getattr(index, column).tolist() == getattr(expected, column).tolist()
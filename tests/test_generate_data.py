@@ -0,0 +1,85 @@
+import io
+import json
+import math
+
+import numpy as np
+import pytest
+import yaml
+
+from generate_data import (
+    apply_deformation, deform_centers, generate_centers, timing_summary, write_collection, write_transforms
+)
+
+
+def collection(centers, radii, rho=1.0):
+    # the dictionary write_collection streams
+    return {
+        'objects': [
+            {'center': [float(c) for c in center], 'radius': float(radius), 'rho': rho, 'type': 'sphere'}
+            for center, radius in zip(centers, radii)
+        ],
+        'type': 'object_collection',
+    }
+
+
+@pytest.mark.parametrize('centers, radii', [
+    (np.random.default_rng(0).uniform(-1, 1, (20, 3)), np.random.default_rng(1).uniform(0.05, 0.3, 20)),
+    # values whose repr needs yaml's float normalisation: exponents, integers, negative zero
+    ([[1e-20, 2.5e16, -0.0], [1.0, -3.0, 1e100]], [1e-7, 12.0]),
+    (np.zeros((0, 3)), np.zeros(0)),
+])
+def test_write_collection_matches_yaml_dump(centers, radii):
+    f = io.StringIO()
+    write_collection(f, centers, radii)
+    expected = io.StringIO()
+    yaml.dump(collection(centers, radii), expected, default_flow_style=False)
+    assert f.getvalue() == expected.getvalue()
+
+
+def test_write_collection_special_floats():
+    f = io.StringIO()
+    write_collection(f, [[math.nan, math.inf, -math.inf]], [0.5], rho=2)
+    expected = io.StringIO()
+    yaml.dump(collection([[math.nan, math.inf, -math.inf]], [0.5], 2.0), expected, default_flow_style=False)
+    assert f.getvalue() == expected.getvalue()
+
+
+@pytest.mark.parametrize('n_frames', [0, 1, 5])
+def test_write_transforms_matches_json_dump(n_frames):
+    rng = np.random.default_rng(0)
+    frames = [
+        {'file_path': f'images_00/train_{i:02d}.png', 'transform_matrix': rng.random((4, 4)).tolist(), 'time': 0.5}
+        for i in range(n_frames)
+    ]
+    transforms = {'camera_angle_x': 0.7, 'w': 500, 'h': 500, 'frames': frames, 'after': {'a': [1, 2]}}
+    f = io.StringIO()
+    write_transforms(f, transforms, iter(frames))
+    assert f.getvalue() == json.dumps(transforms, indent=2)
+
+
+def test_deform_centers_matches_pointwise():
+    centers = generate_centers(27)
+    times = np.linspace(0, 1, 4)
+    deformed = deform_centers(centers, times)
+    assert deformed.shape == (4, 27, 3)
+    for t, batch in zip(times, deformed):
+        for c, d in zip(centers, batch):
+            np.testing.assert_allclose(d, apply_deformation(*c, t))
+
+
+def test_grid_centers_are_cube_corners():
+    corners = generate_centers(8, extent=0.5)
+    assert sorted(map(tuple, corners)) == sorted((x, y, z) for x in (-0.5, 0.5) for y in (-0.5, 0.5) for z in (-0.5, 0.5))
+
+
+def test_timing_summary_labels_concurrency_and_speedup():
+    timings = {1: 4.0, 2: 4.0, 3: 4.0, 4: 4.0}
+    lines = timing_summary(timings, 5.0, 4)
+    assert '3.20 timesteps in flight on average' in lines[1]
+    # no speedup is claimed without a serial baseline
+    assert not any('Speedup' in line for line in lines)
+    assert 'render once with --workers 1' in lines[-1]
+    # four timesteps at 2.5 s each serially take 10 s, twice the wall-clock time
+    assert 'Speedup 2.00x' in timing_summary(timings, 5.0, 4, [2.0, 3.0])[-1]
+    # a serial run reports no speedup
+    assert len(timing_summary(timings, 16.0, 1, [4.0])) == 2
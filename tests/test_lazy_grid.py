@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from lazy_grid import VOXELGRID_CONVENTION, LazyVoxelGrid, density_blocks, lazy_voxel_grid, trilinear, trilinear_slabs
+
+
+@pytest.fixture
+def vol():
+    # uint16 ZYX volume with distinct sizes along every axis
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 1000, (9, 11, 13)).astype(np.uint16)
+
+
+def positions(n, seed=1, margin=1.1):
+    gen = torch.Generator().manual_seed(seed)
+    return torch.rand(n, 3, generator=gen, dtype=torch.float64) * 2*margin - margin
+
+
+def test_voxelgrid_convention():
+    # nerf_xray's VoxelGrid.density is grid_sample with align_corners=True and zeros padding
+    assert VOXELGRID_CONVENTION == (True, 'zeros')
+
+
+@pytest.mark.parametrize('align_corners', [True, False])
+@pytest.mark.parametrize('padding', ['zeros', 'border'])
+def test_lazy_voxel_grid_matches_grid_sample(vol, align_corners, padding):
+    pos = positions(2000)
+    ref = F.grid_sample(
+        torch.from_numpy(vol.astype(np.float64))[None, None], pos.view(1, -1, 1, 1, 3),
+        align_corners=align_corners, padding_mode=padding
+    ).flatten()
+    out = LazyVoxelGrid(vol, align_corners, padding).density(pos).flatten()
+    assert torch.allclose(out, ref, rtol=1e-9, atol=1e-9)
+
+
+def test_lazy_voxel_grid_matches_voxel_grid(vol):
+    VoxelGrid = pytest.importorskip('nerf_xray.objects').VoxelGrid
+    grid = lazy_voxel_grid(vol)
+    pos = positions(2000)
+    ref = VoxelGrid(torch.from_numpy(vol.astype(np.float64))).density(pos).detach().to(torch.float64).flatten()
+    out = grid.density(pos).flatten()
+    assert torch.allclose(out, ref, rtol=1e-6, atol=1e-6)
+
+
+def test_lazy_voxel_grid_keeps_memmap(vol, tmp_path):
+    path = tmp_path/'vol_zyx.raw'
+    vol.tofile(path)
+    mm = np.memmap(path, dtype=np.uint16, mode='r', shape=vol.shape)
+    grid = lazy_voxel_grid(mm)
+    assert grid.rho is mm
+    pos = positions(500)
+    assert torch.allclose(grid.density(pos), lazy_voxel_grid(vol).density(pos))
+
+
+def test_shifted_adds_offset(vol):
+    grid = lazy_voxel_grid(vol)
+    pos = positions(300, margin=0.8)
+    t = (0.1, -0.05, 0.2)
+    expected = grid.density(pos + torch.tensor(t, dtype=torch.float64))
+    assert torch.allclose(grid.shifted(t).density(pos), expected)
+
+
+@pytest.mark.parametrize('padding', ['zeros', 'border'])
+def test_trilinear_slabs_matches_trilinear(vol, padding):
+    idx = positions(3000).abs() * torch.tensor(vol.shape, dtype=torch.float64) - 1
+    expected = trilinear(vol, idx, padding)
+    # one z-plane per slab exercises the binning
+    out = trilinear_slabs(vol, idx, padding, max_voxels=vol.shape[1]*vol.shape[2])
+    assert torch.equal(out, expected)
+
+
+def test_trilinear_slabs_reads_bounded_boxes(vol):
+    # no slab read covers more than its own planes plus the next one
+    reads = []
+    class Recorder:
+        shape = vol.shape
+        def __getitem__(self, box):
+            reads.append(box)
+            return vol[box]
+    idx = positions(3000).abs() * torch.tensor(vol.shape, dtype=torch.float64) - 1
+    trilinear_slabs(Recorder(), idx, max_voxels=2*vol.shape[1]*vol.shape[2])
+    assert len(reads) > 1
+    assert max(box[0].stop - box[0].start for box in reads) <= 3
+
+
+@pytest.mark.parametrize('fast_path', [True, False])
+def test_density_blocks_matches_density(vol, fast_path):
+    grid = lazy_voxel_grid(vol)
+    xpos = torch.linspace(-1.05, 1.05, 7)
+    ypos = torch.linspace(-0.9, 0.9, 5)
+    zpos = torch.linspace(-1, 1, 6)
+    blocks = torch.cat(list(density_blocks(grid, xpos, ypos, zpos, 3, fast_path)))
+    pos = torch.stack(torch.meshgrid(xpos, ypos, zpos, indexing='ij'), dim=-1)
+    expected = grid.density(pos.view(-1, 3)).view(blocks.shape)
+    assert torch.allclose(blocks, expected, atol=1e-9)
+
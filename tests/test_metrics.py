@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+import torch
+
+from metrics import RunningStats, bootstrap_metrics, sample_points
+
+
+def dense_metrics(x, y):
+    # the metrics of eval_loss.dense_eval on whole arrays
+    x = torch.as_tensor(x, dtype=torch.float64).flatten()
+    y = torch.as_tensor(y, dtype=torch.float64).flatten()
+    xn = (x - x.min()) / (x.max() - x.min())
+    yn = (y - y.min()) / (y.max() - y.min())
+    dx, dy = x - x.mean(), y - y.mean()
+    return {
+        'volumetric_loss': torch.nn.functional.mse_loss(y, x).item(),
+        'scaled_volumetric_loss': torch.nn.functional.mse_loss(yn, xn).item(),
+        'normed_correlation': (torch.sum(dx*dy) / torch.sqrt(dx.pow(2).sum() * dy.pow(2).sum())).item(),
+    }
+
+
+@pytest.fixture
+def pair():
+    rng = np.random.default_rng(0)
+    y = rng.gamma(2.0, 50.0, (24, 20, 16))
+    x = 0.8*y + rng.normal(5.0, 10.0, y.shape)
+    return x, y
+
+
+def test_blockwise_matches_dense(pair):
+    x, y = pair
+    stats = RunningStats()
+    # uneven blocks, as slabs at the end of a volume are
+    for i in range(0, len(x), 7):
+        stats.update(x[i:i+7], y[i:i+7])
+    expected = dense_metrics(x, y)
+    for key, value in stats.metrics().items():
+        assert value == pytest.approx(expected[key], rel=1e-10), key
+
+
+def test_merge_is_order_independent(pair):
+    x, y = pair
+    a = RunningStats().update(x[:5], y[:5]).merge(RunningStats().update(x[5:], y[5:]))
+    b = RunningStats().update(x[5:], y[5:]).merge(RunningStats().update(x[:5], y[:5]))
+    assert a.n == b.n == x.size
+    for key, value in a.metrics().items():
+        assert value == pytest.approx(b.metrics()[key], rel=1e-12)
+
+
+def test_moments_match_numpy(pair):
+    x, y = pair
+    stats = RunningStats()
+    for i in range(len(x)):
+        stats.update(torch.from_numpy(x[i]), y[i])
+    assert stats.mean_x == pytest.approx(x.mean())
+    assert stats.var()[1] == pytest.approx(y.var())
+    assert stats.std()[0] == pytest.approx(x.std(ddof=1))
+    assert (stats.min_x, stats.max_y) == (x.min(), y.max())
+
+
+def test_empty_update_is_ignored(pair):
+    x, y = pair
+    stats = RunningStats().update(x, y)
+    before = stats.metrics()
+    stats.update(np.zeros(0), np.zeros(0))
+    assert stats.metrics() == before
+
+
+def test_shape_mismatch_raises():
+    with pytest.raises(AssertionError):
+        RunningStats().update(np.zeros(3), np.zeros(4))
+
+
+def test_bootstrap_interval_contains_estimate(pair):
+    x, y = pair
+    intervals = bootstrap_metrics(x, y, n_bootstrap=50, seed=0)
+    estimate = RunningStats().update(x, y).metrics()
+    for key, (lo, hi) in intervals.items():
+        assert lo <= estimate[key] <= hi, key
+
+
+@pytest.mark.parametrize('strategy', ['random', 'stratified'])
+def test_sample_points_within_bounds(strategy):
+    bounds = [(-1, 1), (0, 2), (-0.5, 0.5)]
+    points = sample_points(100, bounds, strategy, np.random.default_rng(0))
+    assert points.shape == (100, 3)
+    lo, hi = np.array(bounds).T
+    assert np.all(points >= lo) and np.all(points <= hi)
@@ -0,0 +1,56 @@
+import io
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from process_data import archive_stem, copy_metadata, process_archive
+
+
+def write_archive(path, numbers, metadata=()):
+    # tar.gz of 16-bit TIFF projections whose pixels hold the frame number, members in the given order
+    with tarfile.open(path, 'w:gz') as tar:
+        def add(name, data):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        for number in numbers:
+            ok, data = cv.imencode('.tif', np.full((8, 8), 1000*number, dtype=np.uint16))
+            assert ok
+            add(f'scan/kel-cont-0_{number:04d}.tif', data.tobytes())
+        for name in metadata:
+            add(f'scan/{name}', b'meta')
+    return path
+
+
+@pytest.mark.parametrize('order', ['sorted', 'shuffled', 'reversed'])
+def test_eval_is_highest_frame(tmp_path, order):
+    numbers = np.arange(30)
+    if order == 'shuffled':
+        numbers = np.random.default_rng(0).permutation(numbers)
+    elif order == 'reversed':
+        numbers = numbers[::-1]
+    archive = write_archive(tmp_path/'kel-cont-0.tar.gz', numbers, ['_ctdata.txt'])
+    out = tmp_path/'out'
+    with ThreadPoolExecutor(2) as pool:
+        result = process_archive(archive, out, '00', step=7, offset=1, thresh_max=65535, pool=pool, max_pending=2)
+    assert result == {'frames': 30, 'train': 4, 'eval': 1, 'metadata': ['_ctdata-00.txt']}
+    names = sorted(fn.name for fn in (out/'images_00').iterdir())
+    assert names == ['eval_0029.png', 'train_0001.png', 'train_0008.png', 'train_0015.png', 'train_0022.png']
+    for name in names:
+        im = cv.imread((out/'images_00'/name).as_posix(), cv.IMREAD_UNCHANGED)
+        assert np.all(im == round(1000*int(name[-8:-4]) * 255/65535))
+
+
+def test_copy_metadata_of_archive_only(tmp_path):
+    raw = tmp_path/'raw'
+    raw.mkdir()
+    for name in ['kel-cont-0.xtekct', 'kel-cont-0_ctdata.txt', 'kel-cont-1.xtekct', 'kel-cont-10.ang', 'other.ctinfo.xml']:
+        (raw/name).write_text(name)
+    out = tmp_path/'out'
+    out.mkdir()
+    assert archive_stem(raw/'kel-cont-0.tar.gz') == 'kel-cont-0'
+    assert copy_metadata(raw/'kel-cont-0.tar.gz', out) == ['kel-cont-0.xtekct', 'kel-cont-0_ctdata.txt']
+    assert sorted(fn.name for fn in out.iterdir()) == ['kel-cont-0.xtekct', 'kel-cont-0_ctdata.txt']
@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pytest
+
+import perf_suite
+import projection_pyramid
+from projection_pyramid import area_downsample, attenuation, build_pyramid, level_file, open_level, pyramid_dir
+
+SPHERES = np.array([
+    [0.3, -0.2, 0.1, 0.25, 1.0],
+    [-0.3, 0.3, -0.2, 0.15, 1.0],
+])
+
+
+@pytest.fixture
+def jsonfile(tmp_path):
+    # 50 pixels wide, so that level 4 drops the trailing row and column of level 2
+    return perf_suite.write_dataset(tmp_path, SPHERES, n_projections=6, image_size=50)
+
+
+def test_levels_match_area_downsample(jsonfile):
+    build_pyramid(jsonfile, max_factor=8, num_workers=2)
+    for factor, size in ((1, 50), (2, 25), (4, 12), (8, 6)):
+        level, file_paths = open_level(jsonfile, factor)
+        assert level.shape == (6, size, size)
+        for i, fn in enumerate(file_paths):
+            np.testing.assert_allclose(level[i], area_downsample(attenuation(jsonfile.parent, fn), factor), atol=1e-6)
+    assert open_level(jsonfile, 16) is None
+    # a frame subset is read in the order of the rows asked for
+    rows = np.array([4, 1, 2])
+    np.testing.assert_array_equal(projection_pyramid.read_sinogram(level, rows, chunk=2), level[rows].transpose(1, 0, 2))
+
+
+def test_rebuild_only_when_out_of_date(jsonfile, capsys):
+    out = build_pyramid(jsonfile, max_factor=4)
+    mtime = lambda f: (out/level_file(f)).stat().st_mtime_ns
+    built = mtime(2)
+    capsys.readouterr()
+    # same frames and enough levels: nothing is rewritten
+    assert build_pyramid(jsonfile, max_factor=2) == out
+    assert build_pyramid(jsonfile, max_factor=4) == out
+    assert capsys.readouterr().out.count('is up to date') == 2
+    assert mtime(2) == built
+    # a deeper pyramid is built when asked for
+    build_pyramid(jsonfile, max_factor=8)
+    assert 'Built pyramid' in capsys.readouterr().out and open_level(jsonfile, 8) is not None
+    # a changed image makes the pyramid stale until it is rebuilt
+    image = jsonfile.parent/open_level(jsonfile, 1)[1][3]
+    st = image.stat()
+    os.utime(image, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert open_level(jsonfile, 2) is None
+    assert open_level(jsonfile, 2, check=False) is not None
+    build_pyramid(jsonfile, max_factor=4)
+    assert 'Built pyramid' in capsys.readouterr().out
+    assert open_level(jsonfile, 2) is not None
+    # force rebuilds an up-to-date pyramid
+    build_pyramid(jsonfile, max_factor=4, force=True)
+    assert 'Built pyramid' in capsys.readouterr().out
+    assert pyramid_dir(jsonfile) == out
@@ -0,0 +1,114 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import astra_recon
+import cpu_recon
+import perf_suite
+import volume_io
+
+SPHERES = np.array([
+    [0.4, -0.1, 0.2, 0.2, 1.0],
+    [-0.3, 0.35, -0.25, 0.15, 1.0],
+    [0.05, -0.45, -0.4, 0.12, 1.0],
+])
+
+
+def circular_geometry(resolution, n_angles=36, size=64, R=4.0):
+    # cone geometry of a dataset written by perf_suite, in voxel units as astra_recon.main uses it
+    theta = np.linspace(0, 2*np.pi, n_angles, endpoint=False)
+    poses = np.tile(np.eye(4), (n_angles, 1, 1))
+    poses[:, 0, 3], poses[:, 1, 3] = R*np.cos(theta), R*np.sin(theta)
+    fl = size/2 * R / 1.5
+    meta = {'fl_x': fl, 'fl_y': fl, 'w': size, 'h': size}
+    return astra_recon.projection_geometry(poses, meta, 1.0, resolution/2)
+
+
+def detector_rows(proj_geom, points):
+    # fractional detector row of points (N, 3) in every projection, (n_angles, N)
+    vec = cpu_recon.cone_vectors(proj_geom)
+    src, det, u, v = vec[:, None, 0:3], vec[:, None, 3:6], vec[:, None, 6:9], vec[:, None, 9:12]
+    normal = np.cross(u, v)
+    ray = points[None] - src
+    t = np.sum((det - src)*normal, axis=-1) / np.sum(ray*normal, axis=-1)
+    hit = src + t[..., None]*ray - det
+    return np.sum(hit*v, axis=-1) / np.sum(v*v, axis=-1) + proj_geom['DetectorRowCount']/2 - 0.5
+
+
+def box_points(resolution, z0, z1, n=20000, seed=0):
+    # points of the voxels [z0, z1) in voxel units, volume centred at the origin
+    rng = np.random.default_rng(seed)
+    p = rng.uniform(-resolution/2, resolution/2, (n, 3))
+    p[:, 2] = rng.uniform(z0, z1, n) - resolution/2
+    return p
+
+
+@pytest.mark.parametrize('z0, z1', [(0, 8), (20, 28), (40, 48), (0, 48)])
+def test_slab_extent_covers_projections(z0, z1):
+    resolution = 48
+    proj_geom = circular_geometry(resolution)
+    r0, r1, e0, e1 = astra_recon.slab_extent(proj_geom, resolution, z0, z1)
+    assert 0 <= r0 < r1 <= proj_geom['DetectorRowCount']
+    assert 0 <= e0 <= z0 < z1 <= e1 <= resolution
+    # the core slab projects onto rows [r0, r1) (with the interpolation neighbour); the corners
+    # of the volume may project beyond the detector
+    rows = detector_rows(proj_geom, box_points(resolution, z0, z1))
+    rows = np.clip(rows, 0, proj_geom['DetectorRowCount'] - 1)
+    assert rows.min() >= r0 and rows.max() <= r1 - 1
+    # voxels outside the extended slab are not seen by those rows
+    for lo, hi in [(0, e0), (e1, resolution)]:
+        if lo < hi:
+            rows = detector_rows(proj_geom, box_points(resolution, lo, hi, seed=1))
+            assert np.all((rows < r0 - 0.5) | (rows > r1 - 0.5))
+
+
+def test_plan_slabs_respects_budget():
+    resolution = 48
+    proj_geom = circular_geometry(resolution)
+    slabs = astra_recon.plan_slabs(proj_geom, resolution, 0.002, 64, 36)
+    assert len(slabs) > 1
+    assert [s[0] for s in slabs[1:]] == [s[1] for s in slabs[:-1]]
+    assert (slabs[0][0], slabs[-1][1]) == (0, resolution)
+    # memory held for the whole run leaves less for the slabs
+    assert len(astra_recon.plan_slabs(proj_geom, resolution, 0.002, 64, 36, reserved=512*1024)) > len(slabs)
+    with pytest.raises(ValueError):
+        astra_recon.plan_slabs(proj_geom, resolution, 0.002, 64, 36, reserved=1024**2)
+
+
+def test_slab_reconstruction_matches_full(tmp_path):
+    jsonfile = perf_suite.write_dataset(tmp_path/'data', SPHERES, n_projections=60, image_size=64)
+    resolution = 48
+    astra_recon.main(jsonfile, tmp_path/'full', resolution=resolution, algorithm='FDK_CPU', preview_every=0)
+    astra_recon.main(jsonfile, tmp_path/'slab', resolution=resolution, algorithm='FDK_CPU', preview_every=0,
+                     memory_budget=0.004, compare_to=tmp_path/'full')
+    # no float32 volume is left behind
+    assert not list((tmp_path/'slab').glob('*.npy'))
+    full = np.fromfile(tmp_path/'full'/'vol_zyx.raw', dtype=np.uint16)
+    slab = np.fromfile(tmp_path/'slab'/'vol_zyx.raw', dtype=np.uint16)
+    # identical up to the rounding of the 8-bit normalization
+    assert np.abs(full.astype(np.int32) - slab).max() <= 1
+
+
+def test_slab_mode_save_within_budget(tmp_path):
+    # saving as reconstruct_slabs leaves the volume: a memory-mapped float32 (z, y, x) volume
+    # larger than the budget is converted to vol_zyx.raw, vol.npz and vol.chunks without holding it whole
+    resolution, budget = 128, 0.004
+    rec = np.lib.format.open_memmap(tmp_path/'rec.npy', mode='w+', dtype=np.float32, shape=(resolution,)*3)
+    for z0 in range(0, resolution, 16):
+        rec[z0:z0+16] = np.random.default_rng(z0).random((16, resolution, resolution), dtype=np.float32)
+    assert rec.nbytes > budget*1024**3
+    tracemalloc.start()
+    try:
+        vol = astra_recon.write_volume_slabs(rec, tmp_path)
+        volume_io.write_chunked(tmp_path/'vol.chunks', vol, num_workers=2, scratch=tmp_path)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < budget*1024**3
+    np.testing.assert_array_equal(volume_io.ChunkedVolume(tmp_path/'vol.chunks', level=1)[:, :, 5],
+                                  volume_io.downsample2(np.asarray(vol))[:, :, 5])
+    with np.load(tmp_path/'vol.npz') as npz:
+        np.testing.assert_array_equal(npz['vol'], vol)
+    # the memory-mapped pyramid levels are removed
+    assert not list(tmp_path.glob('.tmp-pyramid-*'))
@@ -0,0 +1,25 @@
+import os
+
+import numpy as np
+
+import astra_recon
+from sphere_gui import open_volume
+
+
+def test_open_volume_prefers_current_raw(tmp_path, capsys):
+    rec = np.random.default_rng(0).random((6, 7, 8), dtype=np.float32)
+    _, vol = astra_recon.save_volume(rec, tmp_path)
+    npz, raw = tmp_path/'vol.npz', tmp_path/'vol_zyx.raw'
+    # as written by astra_recon, vol_zyx.raw is memory-mapped in place of vol.npz
+    out = open_volume(npz)
+    assert isinstance(out, np.memmap) or isinstance(out.base, np.memmap)
+    np.testing.assert_array_equal(out, vol)
+    assert f'Opened {raw}' in capsys.readouterr().out
+    # a raw file older than the npz belongs to an earlier run and is ignored
+    stale = vol[::-1].copy()
+    stale.swapaxes(0, 2).tofile(raw)
+    os.utime(raw, (npz.stat().st_mtime - 10,)*2)
+    out = open_volume(npz)
+    assert not isinstance(out, np.memmap)
+    np.testing.assert_array_equal(out, vol)
+    assert f'Opened {npz}' in capsys.readouterr().out
@@ -0,0 +1,58 @@
+import json
+import types
+
+import pandas as pd
+import pytest
+
+import utils
+from utils import PhaseTimer
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # a perf_counter that only advances when the test says so
+    clock = types.SimpleNamespace(t=100.0)
+    clock.perf_counter = lambda: clock.t
+    monkeypatch.setattr(utils, 'time', clock)
+    return clock
+
+
+def test_nested_spans_total(clock, tmp_path, capsys):
+    timer = PhaseTimer()
+    with timer.span('load'):
+        clock.t += 2.0
+    for seconds in (1.0, 3.0):
+        with timer.span('iterate'):
+            clock.t += 0.5
+            with timer.span('forward'):
+                clock.t += seconds
+            with timer.span('backward'):
+                clock.t += 2*seconds
+    with pytest.raises(RuntimeError):
+        with timer.span('save'):
+            clock.t += 0.25
+            raise RuntimeError
+    phases = timer.to_dict()['phases']
+    assert list(phases) == ['load', 'iterate/forward', 'iterate/backward', 'iterate', 'save']
+    forward = {k: phases['iterate/forward'][k] for k in ('count', 'total', 'min', 'max', 'mean')}
+    assert forward == {'count': 2, 'total': 4.0, 'min': 1.0, 'max': 3.0, 'mean': 2.0}
+    assert phases['iterate/backward']['total'] == 8.0
+    # an outer span includes its inner spans and its own time
+    assert phases['iterate']['count'] == 2 and phases['iterate']['total'] == 13.0
+    assert phases['iterate']['total'] == 2*0.5 + phases['iterate/forward']['total'] + phases['iterate/backward']['total']
+    # a span that raised is still recorded, and the top-level spans add up to the wall time
+    assert phases['save']['total'] == 0.25
+    assert timer.to_dict()['wall_time'] == sum(phases[k]['total'] for k in ('load', 'iterate', 'save')) == 15.25
+    with timer.span('load'):
+        clock.t += 1.0
+    assert timer.to_dict()['phases']['load']['count'] == 2
+
+    timer.save(tmp_path/'timings')
+    saved = json.loads((tmp_path/'timings.json').read_text())
+    assert saved['phases']['iterate']['total'] == 13.0
+    table = pd.read_csv(tmp_path/'timings.csv')
+    assert table.set_index('phase')['total'].to_dict() == pytest.approx(
+        {'load': 3.0, 'iterate/forward': 4.0, 'iterate/backward': 8.0, 'iterate': 13.0, 'save': 0.25}
+    )
+    timer.summary()
+    assert 'iterate/forward' in capsys.readouterr().out
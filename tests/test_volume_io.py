@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from volume_io import ChunkedVolume, downsample2, write_chunked
+
+
+@pytest.fixture(params=[np.uint16, np.float32])
+def vol(request):
+    # sizes that are not multiples of the chunk size, odd along one axis
+    rng = np.random.default_rng(0)
+    return (rng.random((37, 20, 29)) * 1000).astype(request.param)
+
+
+def test_round_trip(vol, tmp_path):
+    path = write_chunked(tmp_path/'vol.chunks', vol, chunk=8, levels=3, num_workers=2)
+    cv = ChunkedVolume(path)
+    assert cv.shape == vol.shape and cv.dtype == vol.dtype
+    np.testing.assert_array_equal(np.asarray(cv), vol)
+
+
+@pytest.mark.parametrize('key', [
+    (slice(3, 17), slice(None), 5),
+    (10, slice(None, None, -1)),
+    (Ellipsis, slice(2, 27, 3)),
+    (slice(None, 8), -1, slice(5, 6)),
+    (slice(30, None, -4), slice(1, 19, 2), slice(None)),
+])
+def test_indexing_matches_numpy(vol, tmp_path, key):
+    cv = ChunkedVolume(write_chunked(tmp_path/'vol.chunks', vol, chunk=8, levels=1))
+    np.testing.assert_array_equal(cv[key], vol[key])
+
+
+def test_out_of_bounds_index_raises(vol, tmp_path):
+    cv = ChunkedVolume(write_chunked(tmp_path/'vol.chunks', vol, chunk=8, levels=1))
+    with pytest.raises(IndexError):
+        cv[vol.shape[0]]
+
+
+def test_pyramid_levels(vol, tmp_path):
+    cv = ChunkedVolume(write_chunked(tmp_path/'vol.chunks', vol, chunk=8, levels=3))
+    assert cv.num_levels == 3
+    expected = vol
+    for level in range(3):
+        lv = cv.pyramid_level(level)
+        assert lv.scale == 2**level
+        np.testing.assert_array_equal(np.asarray(lv), expected)
+        expected = downsample2(expected)
+    with pytest.raises(ValueError):
+        cv.pyramid_level(3)
+
+
+def test_downsample2_block_mean():
+    vol = np.arange(4*6*5, dtype=np.float32).reshape(4, 6, 5)
+    expected = vol[:, :, :4].reshape(2, 2, 3, 2, 2, 2).mean(axis=(1, 3, 5))
+    np.testing.assert_allclose(downsample2(vol), expected)
+
+
+def test_axis_view_matches_swapaxes(vol, tmp_path):
+    cv = ChunkedVolume(write_chunked(tmp_path/'vol.chunks', vol, chunk=8, levels=1))
+    view = cv.swapaxes(0, 2)
+    zyx = vol.swapaxes(0, 2)
+    assert view.shape == zyx.shape
+    np.testing.assert_array_equal(np.asarray(view), zyx)
+    np.testing.assert_array_equal(view[4:9, :, 3], zyx[4:9, :, 3])
+    np.testing.assert_array_equal(view.transpose()[..., 7], vol[..., 7])